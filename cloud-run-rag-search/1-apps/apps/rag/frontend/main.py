@@ -12,11 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import json
 import logging
 import os
 import sys
+from collections.abc import AsyncIterator
+from typing import NamedTuple
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 
 import google.api_core.exceptions as exceptions
 from google import genai
@@ -24,8 +29,12 @@ from google.genai import types
 
 import uvicorn
 
+from src import answer_cache
+from src import batcher
 from src import config
-from src.request_model import Prompt
+from src import embeddings
+from src.request_model import (MetadataFilters, Prompt, PromptBatch,
+                               PubSubPushRequest)
 from src import vector_search
 from src import storage
 
@@ -60,6 +69,9 @@ MODEL_CONFIG = types.GenerateContentConfig(
 @app.on_event("startup")
 async def startup_event():
     logging.info("Application startup...")
+    # Warm the document cache without delaying startup.
+    storage.start_background_refresh()
+    await vector_search.init_vector_search()
     if not genai_client:
         logging.error("GenAI client is not available. Predictions will fail.")
 
@@ -67,16 +79,13 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     logging.info("Application shutdown...")
+    await vector_search.close_vector_search()
 
 
 @app.get("/")
 async def root():
     """Basic health check / info endpoint."""
-    vs_config_ok = all([
-        config.VECTOR_SEARCH_INDEX_ENDPOINT_NAME,
-        config.VECTOR_SEARCH_DEPLOYED_INDEX_ID
-    ])
-    vs_status = "configured" if vs_config_ok else "not configured"
+    vs_status = vector_search.get_status()
     client_status = "initialized" if genai_client else "initialization failed"
     cache_status = storage.get_cache_status()
 
@@ -88,85 +97,21 @@ async def root():
         "generative_model_id": config.LLM_MODEL_NAME,
         "embedding_model_id": config.EMBEDDING_MODEL_NAME,
         "genai_client_status": client_status,
+        "embedding_cache": embeddings.get_cache_stats(),
+        "answer_cache": answer_cache.get_cache_stats(),
         "vector_search_status": vs_status,
         "document_cache_status": cache_status,
         "document_cache_ttl_seconds": config.DOCUMENT_CACHE_TTL_SECONDS
     }
 
 
-@app.post("/predict")
-async def predict_route(request: Prompt):
-    """Endpoint to make a prediction using Vertex AI, augmented with context from Vector Search."""
-
-    if not genai_client:
-        logging.error("GenAI client not initialized.")
-        raise HTTPException(status_code=503,
-                            detail="GenAI client not available.")
-
-    logging.info("Received prediction request with prompt: '%s...'",
-                 request.prompt[:100])
-
-    context_str = ""
-    augmented_prompt = request.prompt
-
-    rag_is_configured = all([
-        config.PROJECT_ID, config.REGION,
-        config.VECTOR_SEARCH_INDEX_ENDPOINT_NAME,
-        config.VECTOR_SEARCH_DEPLOYED_INDEX_ID, config.GCS_SOURCE_BUCKET,
-        config.GCS_SOURCE_BLOB_NAME
-    ])
-
-    if rag_is_configured:
-        try:
-            # Step 1: Generate embedding for the user's prompt
-            logging.info(
-                f"Generating embedding for prompt using model: {config.EMBEDDING_MODEL_NAME}"
-            )
-            embedding_response = genai_client.models.embed_content(
-                model=config.EMBEDDING_MODEL_NAME,
-                contents=[request.prompt]).embeddings[0].values
-
-            # Step 2: Query Vector Search to get the IDs of similar documents
-            similar_doc_ids = vector_search.find_similar_document_ids(
-                embedding_response, config.RETRIEVER_TOP_K)
-
-            if similar_doc_ids:
-                # Step 3: Look up the full content of the documents using their IDs.
-                # The storage module handles the TTL caching logic internally.
-                logging.info(
-                    f"Looking up content for {len(similar_doc_ids)} document IDs."
-                )
-                similar_docs_content = storage.get_documents_by_ids(
-                    similar_doc_ids)
-
-                if similar_docs_content:
-                    context_str = "\n\n".join(similar_docs_content)
-                    augmented_prompt = (
-                        f"Based on the following context, answer the question.\n\n"
-                        f"Context:\n{context_str}\n\n"
-                        f"Question: {request.prompt}")
-                    logging.info(
-                        "Augmented prompt with context from Vector Search and GCS."
-                    )
-            else:
-                logging.info(
-                    "No relevant document IDs found in Vector Search, using original prompt."
-                )
-
-        except exceptions.GoogleAPIError as e:
-            logging.error(
-                f"Failed to generate embedding or search Vector Search: {e}",
-                exc_info=True)
-        except Exception as e:
-            logging.error(f"Unexpected error in RAG pipeline: {e}",
-                          exc_info=True)
-    else:
-        logging.warning(
-            "RAG retrieval is not configured, using original prompt.")
-
+async def generate_prediction(augmented_prompt: str) -> tuple[str, bool]:
+    """
+    Calls the LLM with the (potentially augmented) prompt. Returns the
+    prediction text and whether it is a real answer worth caching.
+    """
     try:
-        # Step 4: Call the LLM with the (potentially augmented) prompt
-        response = genai_client.models.generate_content(
+        response = await genai_client.aio.models.generate_content(
             model=MODEL_NAME,
             contents=[augmented_prompt],
             config=MODEL_CONFIG,
@@ -181,28 +126,344 @@ async def predict_route(request: Prompt):
 
         if not prediction_text:
             logging.warning("Received an empty prediction from Vertex AI.")
-            prediction_text = "I could not generate a response based on the input."
+            return "I could not generate a response based on the input.", False
 
         logging.info("Successfully received prediction from Vertex AI: %s...",
                      prediction_text[:100])
+        return prediction_text, True
 
     except exceptions.GoogleAPIError as e:
         logging.error(f"Vertex AI API call failed: {e}", exc_info=True)
-        prediction_text = f"Failed to get an answer from the model: {e}"
+        return f"Failed to get an answer from the model: {e}", False
     except Exception as e:
         logging.error(f"Unexpected error during model generation: {e}",
                       exc_info=True)
-        prediction_text = "An unexpected error occurred while trying to get an answer."
+        return "An unexpected error occurred while trying to get an answer.", False
+
+
+@app.post("/notifications/gcs")
+async def gcs_notification_route(request: PubSubPushRequest):
+    """
+    Push endpoint for GCS object change notifications delivered by Pub/Sub.
+    A change of the source object reloads the document cache right away.
+    """
+    attributes = request.message.attributes
+    if (attributes.get("bucketId") == config.GCS_SOURCE_BUCKET
+            and attributes.get("objectId") == config.GCS_SOURCE_BLOB_NAME
+            and attributes.get("eventType")
+            in ("OBJECT_FINALIZE", "OBJECT_DELETE")):
+        generation = attributes.get("objectGeneration")
+        if attributes["eventType"] == "OBJECT_DELETE":
+            # The refresh finds out whether the object was deleted or
+            # replaced; a failed refresh keeps the current snapshot.
+            generation = None
+        storage.notify_object_changed(int(generation) if generation else None)
+    # Any 2xx response acknowledges the message, including unrelated ones.
+    return {"status": "ok"}
+
+
+class RetrievedContext(NamedTuple):
+    """The outcome of the retrieval for a prompt."""
+    augmented_prompt: str
+    context: str
+    context_ids: list[str]
+    embedding: list[float] | None
+    # Why the prompt is answered without context, or None if it is not.
+    fallback_reason: str | None = None
+
+
+async def retrieve_batch(
+    queries: list[tuple[str, MetadataFilters | None]]
+) -> list[tuple[list[float], list[str]]]:
+    """
+    Embeds prompts with a single embedding request and finds their similar
+    documents with a single Vector Search request. Each query is a (prompt,
+    metadata filters) pair. Returns an (embedding, document IDs) pair per
+    query. Each request has its own deadline.
+    """
+    prompts = [prompt for prompt, _ in queries]
+    logging.info(f"Generating embeddings for {len(prompts)} prompts "
+                 f"using model: {config.EMBEDDING_MODEL_NAME}")
+    async with asyncio.timeout(config.EMBEDDING_TIMEOUT_SECONDS):
+        query_embeddings = await embeddings.get_query_embeddings(
+            genai_client, prompts)
+    async with asyncio.timeout(config.SEARCH_TIMEOUT_SECONDS):
+        similar_doc_ids = await vector_search.find_similar_document_ids_batch(
+            query_embeddings, config.RETRIEVER_TOP_K,
+            [filters for _, filters in queries])
+    return list(zip(query_embeddings, similar_doc_ids))
+
+
+# Coalesces the retrieval of concurrent requests into batches.
+retrieval_batcher = batcher.MicroBatcher(
+    retrieve_batch,
+    max_batch_size=config.RETRIEVAL_BATCH_MAX_SIZE,
+    max_wait_seconds=config.RETRIEVAL_BATCH_MAX_WAIT_MS / 1000)
+
+
+async def retrieve_context(
+        prompt: str,
+        filters: MetadataFilters | None = None) -> RetrievedContext:
+    """
+    Retrieves the documents most similar to the prompt with Vector Search
+    and the document store, among the documents that match the metadata
+    filters.
+
+    Retrieval runs within a total latency budget (RETRIEVAL_TIMEOUT_SECONDS)
+    and each stage has its own timeout. If a stage fails or misses its
+    deadline, the prompt is answered without context and the fallback
+    reason says why.
+    """
+    rag_is_configured = all([
+        config.PROJECT_ID, config.REGION,
+        config.VECTOR_SEARCH_INDEX_ENDPOINT_NAME,
+        config.VECTOR_SEARCH_DEPLOYED_INDEX_ID, config.GCS_SOURCE_BUCKET,
+        config.GCS_SOURCE_BLOB_NAME
+    ])
+    if not rag_is_configured:
+        logging.warning(
+            "RAG retrieval is not configured, using original prompt.")
+        return RetrievedContext(prompt, "", [], None, "not configured")
+
+    embedding_response = None
+    stage = "embedding and search"
+    try:
+        async with asyncio.timeout(config.RETRIEVAL_TIMEOUT_SECONDS):
+            # Steps 1 and 2: Embed the prompt and query Vector Search for the
+            # IDs of similar documents, batched with concurrent requests
+            embedding_response, similar_doc_ids = await retrieval_batcher.submit(
+                (prompt, filters))
+
+            if not similar_doc_ids:
+                logging.info(
+                    "No relevant document IDs found in Vector Search, using original prompt."
+                )
+                return RetrievedContext(prompt, "", [], embedding_response,
+                                        "no documents found")
 
+            # Step 3: Look up the full content of the documents using their IDs.
+            # The storage module handles the TTL caching logic internally, and
+            # may block on the initial load, so it runs in a thread.
+            stage = "document lookup"
+            logging.info(
+                f"Looking up content for {len(similar_doc_ids)} document IDs.")
+            async with asyncio.timeout(config.DOCUMENT_LOOKUP_TIMEOUT_SECONDS):
+                similar_docs_content = await asyncio.to_thread(
+                    storage.get_documents_by_ids, similar_doc_ids)
+
+    except TimeoutError:
+        logging.warning(
+            f"Retrieval timed out during {stage}, using original prompt.")
+        return RetrievedContext(prompt, "", [], embedding_response,
+                                f"{stage} timed out")
+    except exceptions.GoogleAPIError as e:
+        logging.error(
+            f"Failed to generate embedding or search Vector Search: {e}",
+            exc_info=True)
+        return RetrievedContext(prompt, "", [], embedding_response,
+                                f"{stage} failed")
+    except Exception as e:
+        logging.error(f"Unexpected error in RAG pipeline: {e}", exc_info=True)
+        return RetrievedContext(prompt, "", [], embedding_response,
+                                f"{stage} failed")
+
+    if not similar_docs_content:
+        return RetrievedContext(prompt, "", [], embedding_response,
+                                "no documents found")
+
+    context_str = "\n\n".join(similar_docs_content)
+    # Bump ANSWER_CACHE_PROMPT_VERSION when changing this template.
+    augmented_prompt = (
+        f"Based on the following context, answer the question.\n\n"
+        f"Context:\n{context_str}\n\n"
+        f"Question: {prompt}")
+    logging.info("Augmented prompt with context from Vector Search and GCS.")
+    return RetrievedContext(augmented_prompt, context_str, similar_doc_ids,
+                            embedding_response)
+
+
+def format_context(prompt: str, retrieved: RetrievedContext) -> dict:
+    """Describes the context a prompt is answered with, for responses."""
     return {
-        "prompt": request.prompt,
-        "augmented_prompt":
-        augmented_prompt if context_str else request.prompt,
-        "retrieved_context": context_str,
-        "prediction": prediction_text
+        "prompt": prompt,
+        "augmented_prompt": retrieved.augmented_prompt,
+        "retrieved_context": retrieved.context,
+        "context_fallback": retrieved.fallback_reason is not None,
+        "fallback_reason": retrieved.fallback_reason,
     }
 
 
+async def answer_prompt(prompt: str,
+                        filters: MetadataFilters | None = None) -> dict:
+    """Answers a prompt, augmented with context from Vector Search."""
+    logging.info("Received prediction request with prompt: '%s...'",
+                 prompt[:100])
+
+    # With speculative generation, the prompt is answered without context
+    # while retrieval runs. The answer is used if retrieval falls back, and
+    # cancelled otherwise.
+    speculative_prediction = None
+    if config.SPECULATIVE_GENERATION:
+        speculative_prediction = asyncio.create_task(
+            generate_prediction(prompt))
+    try:
+        retrieved = await retrieve_context(prompt, filters)
+
+        # Step 4: Reuse the answer to a near-identical prompt over the same
+        # context, or call the LLM with the (potentially augmented) prompt
+        prediction_text = answer_cache.get_answer(retrieved.embedding,
+                                                  retrieved.context)
+        if prediction_text is None:
+            if speculative_prediction and retrieved.fallback_reason:
+                logging.info("Using the speculative answer without context.")
+                prediction_text, _ = await speculative_prediction
+            else:
+                prediction_text, valid = await generate_prediction(
+                    retrieved.augmented_prompt)
+                if valid:
+                    answer_cache.set_answer(retrieved.embedding,
+                                            retrieved.context, prediction_text)
+    finally:
+        if speculative_prediction and not speculative_prediction.done():
+            speculative_prediction.cancel()
+
+    return {**format_context(prompt, retrieved), "prediction": prediction_text}
+
+
+def format_sse_event(event: str, data: dict) -> str:
+    """Formats a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_prediction_events(
+        prompt: str, retrieved: RetrievedContext) -> AsyncIterator[str]:
+    """
+    Streams a prediction as Server-Sent Events: a `context` event with the
+    retrieved context first, then `token` events with the text deltas as
+    the model generates them, and a final `done` (or `error`) event.
+    """
+    context = format_context(prompt, retrieved)
+    context["context_ids"] = retrieved.context_ids
+    yield format_sse_event("context", context)
+    augmented_prompt = retrieved.augmented_prompt
+    embedding_response = retrieved.embedding
+
+    prediction_text = answer_cache.get_answer(embedding_response,
+                                              retrieved.context)
+    if prediction_text is not None:
+        yield format_sse_event("token", {"text": prediction_text})
+        yield format_sse_event("done", {
+            "prediction": prediction_text,
+            "cached": True
+        })
+        return
+
+    chunks = []
+    try:
+        async for chunk in await genai_client.aio.models.generate_content_stream(
+                model=MODEL_NAME,
+                contents=[augmented_prompt],
+                config=MODEL_CONFIG,
+        ):
+            if chunk.text:
+                chunks.append(chunk.text)
+                yield format_sse_event("token", {"text": chunk.text})
+    except exceptions.GoogleAPIError as e:
+        logging.error(f"Vertex AI API call failed: {e}", exc_info=True)
+        yield format_sse_event(
+            "error",
+            {"detail": f"Failed to get an answer from the model: {e}"})
+        return
+    except Exception as e:
+        logging.error(f"Unexpected error during model generation: {e}",
+                      exc_info=True)
+        yield format_sse_event(
+            "error", {
+                "detail":
+                "An unexpected error occurred while trying to get an answer."
+            })
+        return
+
+    prediction_text = "".join(chunks)
+    if prediction_text:
+        logging.info("Successfully streamed prediction from Vertex AI: %s...",
+                     prediction_text[:100])
+        answer_cache.set_answer(embedding_response, retrieved.context,
+                                prediction_text)
+    else:
+        logging.warning("Received an empty prediction from Vertex AI.")
+    yield format_sse_event("done", {
+        "prediction": prediction_text,
+        "cached": False
+    })
+
+
+@app.post("/predict")
+async def predict_route(request: Prompt):
+    """Endpoint to make a prediction using Vertex AI, augmented with context from Vector Search."""
+
+    if not genai_client:
+        logging.error("GenAI client not initialized.")
+        raise HTTPException(status_code=503,
+                            detail="GenAI client not available.")
+
+    return await answer_prompt(request.prompt, request.filters)
+
+
+@app.post("/predict_batch")
+async def predict_batch_route(request: PromptBatch):
+    """
+    Endpoint to make predictions for several prompts. Retrieval is batched
+    (one embedding and one Vector Search request per batch) and the LLM
+    calls run concurrently.
+    """
+
+    if not genai_client:
+        logging.error("GenAI client not initialized.")
+        raise HTTPException(status_code=503,
+                            detail="GenAI client not available.")
+    if len(request.prompts) > config.PREDICT_BATCH_MAX_PROMPTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {config.PREDICT_BATCH_MAX_PROMPTS} prompts "
+            "are allowed per batch.")
+
+    # Prompts submitted together fill the retrieval batches right away.
+    semaphore = asyncio.Semaphore(config.PREDICT_BATCH_CONCURRENCY)
+
+    async def answer_with_limit(prompt: str) -> dict:
+        async with semaphore:
+            return await answer_prompt(prompt, request.filters)
+
+    predictions = await asyncio.gather(*(answer_with_limit(prompt)
+                                         for prompt in request.prompts))
+    return {"predictions": predictions}
+
+
+@app.post("/predict_stream")
+async def predict_stream_route(request: Prompt):
+    """
+    Endpoint to stream a prediction from Vertex AI as Server-Sent Events,
+    augmented with context from Vector Search.
+    """
+
+    if not genai_client:
+        logging.error("GenAI client not initialized.")
+        raise HTTPException(status_code=503,
+                            detail="GenAI client not available.")
+
+    logging.info("Received streaming prediction request with prompt: '%s...'",
+                 request.prompt[:100])
+
+    # Retrieval completes before the response starts, so the context is
+    # always the first event.
+    retrieved = await retrieve_context(request.prompt, request.filters)
+    return StreamingResponse(stream_prediction_events(request.prompt,
+                                                      retrieved),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
 if __name__ == "__main__":
     server_port = int(os.environ.get("PORT", 8080))
     # uvicorn.run("main:app", host="0.0.0.0", port=server_port, log_level="info", reload=True) # For local dev
@@ -0,0 +1,121 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import math
+import sys
+
+from src import cache
+from src import config
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(name)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+# Answers are grouped by the exact retrieved context, so a prompt is only
+# compared with prompts that were answered from the same documents. The key
+# is the content of the documents rather than their ids: ids can be reused
+# for other rows when the data is reloaded, and an edited document must not
+# serve answers generated from its previous content. Each group keeps the
+# most recent prompts only.
+_MAX_ANSWERS_PER_CONTEXT = 8
+
+_answer_cache = cache.TTLCache(max_size=config.ANSWER_CACHE_MAX_SIZE,
+                               ttl_seconds=config.ANSWER_CACHE_TTL_SECONDS)
+_hits = 0
+_misses = 0
+
+# Everything besides the context that shapes an answer: answers generated
+# with other settings or another prompt template are not reused.
+_ANSWER_SETTINGS = "\n".join(
+    str(setting)
+    for setting in (config.LLM_MODEL_NAME, config.LLM_TEMPERATURE,
+                    config.LLM_TOP_P, config.LLM_TOP_K,
+                    config.LLM_CANDIDATE_COUNT, config.LLM_MAX_OUTPUT_TOKENS,
+                    config.ANSWER_CACHE_PROMPT_VERSION))
+
+
+def _context_key(context: str) -> str:
+    """
+    Builds the cache key from the LLM, its generation settings, the prompt
+    template version and the retrieved context.
+    """
+    return hashlib.sha256(
+        f"{_ANSWER_SETTINGS}\n{context}".encode("utf-8")).hexdigest()
+
+
+def _unit_vector(embedding: list[float]) -> list[float]:
+    """Scales an embedding to unit length, so a dot product is the cosine."""
+    norm = math.sqrt(sum(value * value for value in embedding))
+    if norm == 0:
+        return list(embedding)
+    return [value / norm for value in embedding]
+
+
+def get_answer(embedding: list[float], context: str) -> str | None:
+    """
+    Returns a cached prediction for a prompt whose embedding is within
+    ANSWER_CACHE_SIMILARITY_THRESHOLD (cosine similarity) of a prompt
+    answered from the same retrieved context (the text of the documents),
+    or None.
+    """
+    global _hits, _misses
+    if not config.ANSWER_CACHE_ENABLED or not context:
+        return None
+    answers = _answer_cache.get(_context_key(context))
+    if not answers:
+        _misses += 1
+        return None
+
+    query = _unit_vector(embedding)
+    best_similarity, best_prediction = -1.0, None
+    for cached_embedding, prediction in answers:
+        similarity = math.fsum(a * b for a, b in zip(query, cached_embedding))
+        if similarity > best_similarity:
+            best_similarity, best_prediction = similarity, prediction
+    if best_similarity < config.ANSWER_CACHE_SIMILARITY_THRESHOLD:
+        _misses += 1
+        return None
+    _hits += 1
+    logging.info(
+        f"Answer cache hit (cosine similarity {best_similarity:.4f}).")
+    return best_prediction
+
+
+def set_answer(embedding: list[float], context: str, prediction: str):
+    """Stores the prediction of a prompt answered from the given context."""
+    if not config.ANSWER_CACHE_ENABLED or not context:
+        return
+    key = _context_key(context)
+    # The list is replaced rather than mutated, so concurrent readers never
+    # see a partially updated group.
+    answers = list(_answer_cache.get(key) or [])
+    answers.append((_unit_vector(embedding), prediction))
+    _answer_cache.set(key, answers[-_MAX_ANSWERS_PER_CONTEXT:])
+
+
+def get_cache_stats() -> dict:
+    """Returns the answer cache counters for the status endpoint."""
+    # The underlying cache counts lookups per context group; report the
+    # prompt-level hits instead.
+    lookups = _hits + _misses
+    stats = _answer_cache.stats()
+    stats["hits"] = _hits
+    stats["misses"] = _misses
+    stats["hit_rate"] = round(_hits / lookups, 3) if lookups else 0.0
+    stats["enabled"] = config.ANSWER_CACHE_ENABLED
+    stats["similarity_threshold"] = config.ANSWER_CACHE_SIMILARITY_THRESHOLD
+    return stats
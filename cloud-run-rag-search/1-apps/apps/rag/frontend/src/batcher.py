@@ -0,0 +1,89 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import sys
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(name)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+
+class MicroBatcher:
+    """
+    Collects items submitted by concurrent requests and processes them
+    together with one call to `process_batch`.
+
+    A batch is processed when it reaches `max_batch_size` items, or
+    `max_wait_seconds` after its first item arrived, whichever comes
+    first. `process_batch` must return one result per item, in order.
+    If it raises, every request of the batch gets the exception.
+
+    All methods must be called from the same event loop.
+    """
+
+    def __init__(self, process_batch: Callable[[list[Any]],
+                                               Awaitable[list[Any]]],
+                 max_batch_size: int, max_wait_seconds: float):
+        self._process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_seconds = max_wait_seconds
+        self._pending: list[tuple[Any, asyncio.Future]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        # Keeps references to running batches so they are not
+        # garbage-collected before they finish.
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, item: Any) -> Any:
+        """Adds an item to the next batch and returns its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait_seconds,
+                                                 self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[Any, asyncio.Future]]):
+        try:
+            results = await self._process_batch([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"Batch of {len(batch)} items returned "
+                                 f"{len(results)} results.")
+        except Exception as e:
+            logging.error(f"Batch of {len(batch)} items failed: {e}")
+            for _, future in batch:
+                # A request may have been cancelled while it waited.
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
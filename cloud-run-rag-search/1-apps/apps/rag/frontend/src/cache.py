@@ -0,0 +1,108 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+from src import config
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(name)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+_redis_client = None
+_redis_client_initialized = False
+
+
+class TTLCache:
+    """
+    A bounded, in-process LRU cache whose entries expire after a TTL.
+    It keeps hit / miss counters for the status endpoint.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        """Returns the cached value, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, value: Any):
+        """Stores a value, evicting the least recently used entries if full."""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes all the entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Returns the size and hit / miss counters of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+def get_redis_client():
+    """
+    Returns the async Redis (Memorystore) client shared by the caches,
+    or None if CACHE_REDIS_URL is not set. Without it, caches are local
+    to each instance.
+    """
+    global _redis_client, _redis_client_initialized
+    if not _redis_client_initialized:
+        _redis_client_initialized = True
+        if config.CACHE_REDIS_URL:
+            try:
+                import redis.asyncio as redis
+                _redis_client = redis.from_url(
+                    config.CACHE_REDIS_URL,
+                    socket_timeout=config.CACHE_REDIS_TIMEOUT_SECONDS,
+                    socket_connect_timeout=config.CACHE_REDIS_TIMEOUT_SECONDS)
+                logging.info("Shared Redis cache backend configured.")
+            except Exception as e:
+                logging.error(f"Failed to configure Redis cache backend: {e}",
+                              exc_info=True)
+    return _redis_client
@@ -30,6 +30,31 @@ EMBEDDING_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_NAME",
                                       "text-multilingual-embedding-002")
 EMBEDDING_TASK_TYPE = "RETRIEVAL_QUERY"
 
+# Cache Configuration
+EMBEDDING_CACHE_MAX_SIZE = int(
+    os.environ.get("EMBEDDING_CACHE_MAX_SIZE", 10000))
+EMBEDDING_CACHE_TTL_SECONDS = int(
+    os.environ.get("EMBEDDING_CACHE_TTL_SECONDS", 3600))
+# Optional Redis / Memorystore URL (e.g. redis://10.0.0.3:6379/0) to share
+# cache entries across instances. Caches are in-process only if unset.
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL")
+CACHE_REDIS_TIMEOUT_SECONDS = float(
+    os.environ.get("CACHE_REDIS_TIMEOUT_SECONDS", 0.2))
+# Semantic answer cache: a prediction is reused for a new prompt whose
+# embedding is at least this cosine-similar to an answered prompt with the
+# same retrieved context.
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED",
+                                      "true").lower() == "true"
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(
+    os.environ.get("ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.95))
+ANSWER_CACHE_MAX_SIZE = int(os.environ.get("ANSWER_CACHE_MAX_SIZE", 1000))
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", 600))
+# Part of the answer cache key, with the model and its generation settings.
+# Bump it when the prompt template changes, or to stop serving the answers
+# cached so far.
+ANSWER_CACHE_PROMPT_VERSION = os.environ.get("ANSWER_CACHE_PROMPT_VERSION",
+                                             "1")
+
 # Vertex AI Vector Search Configuration
 VECTOR_SEARCH_INDEX_ENDPOINT_NAME = os.environ.get(
     "VECTOR_SEARCH_INDEX_ENDPOINT_NAME")
@@ -37,12 +62,45 @@ VECTOR_SEARCH_DEPLOYED_INDEX_ID = os.environ.get(
     "VECTOR_SEARCH_DEPLOYED_INDEX_ID")
 VECTOR_SEARCH_ENDPOINT_IP_ADDRESS = os.environ.get(
     "VECTOR_SEARCH_ENDPOINT_IP_ADDRESS")
+VECTOR_SEARCH_TIMEOUT_SECONDS = float(
+    os.environ.get("VECTOR_SEARCH_TIMEOUT_SECONDS", 5))
 
 # GCS Source for Document Lookup
 GCS_SOURCE_BUCKET = os.environ.get("GCS_SOURCE_BUCKET")
 GCS_SOURCE_BLOB_NAME = os.environ.get("GCS_SOURCE_BLOB_NAME", "data.jsonl")
 DOCUMENT_CACHE_TTL_SECONDS = int(
     os.environ.get("DOCUMENT_CACHE_TTL_SECONDS", 600))
+# Minimum delay between refresh attempts after a failed refresh
+DOCUMENT_CACHE_RETRY_SECONDS = int(
+    os.environ.get("DOCUMENT_CACHE_RETRY_SECONDS", 30))
+# Optional directory (local disk or tmpfs, e.g. /dev/shm/documents) for a
+# memory-mapped document store shared by all the uvicorn workers of an
+# instance (see WEB_CONCURRENCY). Each worker holds its own copy if unset.
+DOCUMENT_CACHE_DIR = os.environ.get("DOCUMENT_CACHE_DIR")
 
 # Retriever Configuration
 RETRIEVER_TOP_K = int(os.environ.get("RETRIEVER_TOP_K", 10))
+# Latency budget for the whole retrieval, and timeouts of its stages. A
+# prompt is answered without context when retrieval misses its deadline.
+RETRIEVAL_TIMEOUT_SECONDS = float(
+    os.environ.get("RETRIEVAL_TIMEOUT_SECONDS", 2))
+EMBEDDING_TIMEOUT_SECONDS = float(
+    os.environ.get("EMBEDDING_TIMEOUT_SECONDS", 1))
+SEARCH_TIMEOUT_SECONDS = float(os.environ.get("SEARCH_TIMEOUT_SECONDS", 1))
+DOCUMENT_LOOKUP_TIMEOUT_SECONDS = float(
+    os.environ.get("DOCUMENT_LOOKUP_TIMEOUT_SECONDS", 0.5))
+# Answer the prompt without context while retrieval runs, and use that
+# answer if retrieval falls back. Costs an extra LLM call per request.
+SPECULATIVE_GENERATION = os.environ.get("SPECULATIVE_GENERATION",
+                                        "false").lower() == "true"
+# Concurrent requests are retrieved in batches of up to this many prompts,
+# waiting at most this long for a batch to fill.
+RETRIEVAL_BATCH_MAX_SIZE = int(os.environ.get("RETRIEVAL_BATCH_MAX_SIZE", 32))
+RETRIEVAL_BATCH_MAX_WAIT_MS = float(
+    os.environ.get("RETRIEVAL_BATCH_MAX_WAIT_MS", 5))
+
+# Batch prediction endpoint
+PREDICT_BATCH_MAX_PROMPTS = int(
+    os.environ.get("PREDICT_BATCH_MAX_PROMPTS", 100))
+PREDICT_BATCH_CONCURRENCY = int(os.environ.get("PREDICT_BATCH_CONCURRENCY",
+                                               32))
@@ -0,0 +1,157 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+from collections.abc import Iterable
+
+# File layout: header, hashes, offsets, ID lengths, text lengths, buffer.
+# The 8-byte arrays come first so every array is naturally aligned.
+_FILE_MAGIC = b"RAGDOCS1"
+_FILE_HEADER = struct.Struct("<8sQQ")  # magic, document count, buffer size
+
+
+def _id_hash(doc_id: bytes) -> int:
+    """Returns a stable signed 64-bit hash of a document ID."""
+    return int.from_bytes(hashlib.blake2b(doc_id, digest_size=8).digest(),
+                          "little",
+                          signed=True)
+
+
+class DocumentStore:
+    """
+    An immutable, compact id -> prompt text lookup table.
+
+    Every document is stored as its UTF-8 ID followed by its pre-rendered
+    prompt text in one contiguous buffer. The index is a set of flat arrays
+    sorted by a 64-bit hash of the ID and searched with bisect: the hashes,
+    the entry offsets in the buffer, and the ID and text lengths. This
+    costs 24 bytes per document on top of the text itself, instead of a
+    Python dict per document.
+    """
+
+    def __init__(self, buffer, hashes, offsets, id_lengths, text_lengths):
+        # Arrays are array.array objects when built in memory, or
+        # memoryviews of a memory-mapped file when loaded from disk.
+        self._buffer = buffer
+        self._hashes = hashes
+        self._offsets = offsets
+        self._id_lengths = id_lengths
+        self._text_lengths = text_lengths
+
+    @classmethod
+    def build(cls, documents: Iterable[tuple[str, str]]) -> "DocumentStore":
+        """
+        Builds a store from (id, prompt text) pairs. If an ID appears more
+        than once, the last text wins, like with a dict.
+        """
+        buffer = bytearray()
+        hashes = array.array("q")
+        offsets = array.array("Q")
+        id_lengths = array.array("I")
+        text_lengths = array.array("I")
+        for doc_id, text in documents:
+            encoded_id = doc_id.encode("utf-8")
+            encoded_text = text.encode("utf-8")
+            hashes.append(_id_hash(encoded_id))
+            offsets.append(len(buffer))
+            id_lengths.append(len(encoded_id))
+            text_lengths.append(len(encoded_text))
+            buffer += encoded_id
+            buffer += encoded_text
+
+        # Sort the index by hash; entries stay where they are in the buffer.
+        # The sort is stable, so duplicate IDs keep their input order.
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+
+        def reorder(values: array.array) -> array.array:
+            return array.array(values.typecode, (values[i] for i in order))
+
+        return cls(buffer, reorder(hashes), reorder(offsets),
+                   reorder(id_lengths), reorder(text_lengths))
+
+    def save(self, path: str):
+        """
+        Writes the store to a file that `load` can memory-map. The file is
+        written under a temporary name and renamed, so readers never see a
+        partial file.
+        """
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(
+                _FILE_HEADER.pack(_FILE_MAGIC, len(self), len(self._buffer)))
+            for values in (self._hashes, self._offsets, self._id_lengths,
+                           self._text_lengths):
+                f.write(values)
+            f.write(self._buffer)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "DocumentStore":
+        """
+        Memory-maps a file written by `save`. The pages are shared by all
+        the processes that map the same file, and loaded lazily by the OS.
+        """
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, buffer_size = _FILE_HEADER.unpack_from(mapped)
+        if magic != _FILE_MAGIC:
+            raise ValueError(f"{path} is not a document store file.")
+
+        view = memoryview(mapped)
+        position = _FILE_HEADER.size
+        arrays = []
+        for typecode in ("q", "Q", "I", "I"):
+            size = count * array.array(typecode).itemsize
+            arrays.append(view[position:position + size].cast(typecode))
+            position += size
+        if position + buffer_size != len(mapped):
+            raise ValueError(f"{path} is truncated or corrupted.")
+        return cls(view[position:], *arrays)
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    @property
+    def nbytes(self) -> int:
+        """The memory used by the buffer and the index, in bytes."""
+        return len(self._buffer) + sum(
+            values.itemsize * len(values)
+            for values in (self._hashes, self._offsets, self._id_lengths,
+                           self._text_lengths))
+
+    def get(self, doc_id: str) -> str | None:
+        """Returns the prompt text of a document, or None if it is unknown."""
+        encoded_id = doc_id.encode("utf-8")
+        target = _id_hash(encoded_id)
+        position = bisect.bisect_left(self._hashes, target)
+        found = None
+        # Scan every entry with this hash: hash collisions and duplicate
+        # IDs both land here. The last matching entry wins.
+        while (position < len(self._hashes)
+               and self._hashes[position] == target):
+            start = self._offsets[position]
+            if self._buffer[start:start +
+                            self._id_lengths[position]] == encoded_id:
+                found = position
+            position += 1
+        if found is None:
+            return None
+        start = self._offsets[found] + self._id_lengths[found]
+        return str(self._buffer[start:start + self._text_lengths[found]],
+                   "utf-8")
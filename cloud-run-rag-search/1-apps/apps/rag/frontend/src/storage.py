@@ -12,108 +12,267 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fcntl
+import glob
 import json
 import logging
+import os
 import sys
 import threading
 import time
+from collections.abc import Iterator
 from typing import Any, List, Dict
 
 from google.cloud import storage as gcs
 import google.api_core.exceptions as exceptions
 
 from src import config
+from src.document_store import DocumentStore
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
                     format='%(name)s - %(levelname)s - %(message)s',
                     handlers=[logging.StreamHandler(sys.stdout)])
 
-# --- In-memory cache with TTL logic ---
-_document_lookup_cache: Dict[str, Dict] = {}
+# --- In-memory cache with stale-while-revalidate TTL logic ---
+# The store is immutable: a refresh builds a new one and swaps the
+# reference, so readers always see a complete snapshot without locking.
+# Documents are kept pre-rendered for the prompt, not as raw records.
+_document_lookup_cache = DocumentStore.build([])
 _cache_load_time: float = 0.0
+# GCS generation of the object the current snapshot was parsed from
+_cache_generation: int | None = None
+_last_refresh_attempt_time: float = 0.0
+_last_refresh_error: str | None = None
+# Serializes refreshes. Readers never wait on it once the cache is loaded.
 _cache_lock = threading.Lock()
+# Set by change notifications that arrive while a refresh is running.
+_refresh_requested = threading.Event()
+_storage_client: gcs.Client | None = None
 
 
-def _load_documents_from_gcs():
+def _get_storage_client() -> gcs.Client:
+    """Returns the GCS client, creating it on first use."""
+    global _storage_client
+    if _storage_client is None:
+        _storage_client = gcs.Client(project=config.PROJECT_ID)
+    return _storage_client
+
+
+def _load_documents_from_gcs(
+        known_generation: int | None) -> tuple[DocumentStore | None, int]:
     """
-    Internal function to download a JSONL file from GCS and load it into
-    the in-memory dictionary. This is the slow operation.
+    Internal function to download a JSONL file from GCS and parse it into
+    a new document store keyed by document ID. This is the slow operation, so
+    the object metadata is checked first: if its generation matches
+    `known_generation`, nothing is downloaded and None is returned.
+
+    Returns:
+        The new store (or None if unchanged) and the object generation.
+
+    Raises:
+        google.api_core.exceptions.GoogleAPIError: If the download fails.
+        ValueError: If the file contains invalid JSON.
     """
-    global _document_lookup_cache, _cache_load_time
     bucket_name = config.GCS_SOURCE_BUCKET
     blob_name = config.GCS_SOURCE_BLOB_NAME
 
-    if not bucket_name:
+    bucket = _get_storage_client().bucket(bucket_name)
+    blob = bucket.get_blob(blob_name)
+    if blob is None:
+        raise exceptions.NotFound(f"gs://{bucket_name}/{blob_name}")
+    if blob.generation == known_generation:
+        return None, blob.generation
+
+    if config.DOCUMENT_CACHE_DIR:
+        return _load_shared_document_store(blob), blob.generation
+    new_cache = _build_document_store(blob)
+    logging.info(f"Document store uses {new_cache.nbytes / 2**20:.1f} MiB.")
+    return new_cache, blob.generation
+
+
+def _build_document_store(blob: gcs.Blob) -> DocumentStore:
+    """Downloads and parses the JSONL blob into a new document store."""
+    logging.info(f"Refreshing document cache from gs://{blob.bucket.name}/"
+                 f"{blob.name} (generation {blob.generation})...")
+    # The blob carries its generation, so the download reads exactly the
+    # version checked above even if the object is replaced meanwhile.
+    with blob.open("r") as f:
+        return DocumentStore.build(_iter_rendered_records(f))
+
+
+def _load_shared_document_store(blob: gcs.Blob) -> DocumentStore:
+    """
+    Memory-maps the document store file of the blob's generation from
+    DOCUMENT_CACHE_DIR, building it first if no process has done so yet.
+
+    All the uvicorn workers of an instance map the same read-only file, so
+    the corpus is held in memory once per instance instead of once per
+    worker. A file lock ensures a single worker downloads each generation
+    while the others wait for it and then map the result.
+    """
+    os.makedirs(config.DOCUMENT_CACHE_DIR, exist_ok=True)
+    path = os.path.join(config.DOCUMENT_CACHE_DIR,
+                        f"documents-{blob.generation}.bin")
+    lock_path = os.path.join(config.DOCUMENT_CACHE_DIR, "documents.lock")
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            _build_document_store(blob).save(path)
+            logging.info(f"Wrote document store file {path}.")
+        # Mapped while holding the lock, so that no other worker deletes
+        # the file in between.
+        store = DocumentStore.load(path)
+        # Only older generations are deleted: a worker that lags behind
+        # must not delete the newer file the others use. Unlinking mapped
+        # files is safe: their pages stay valid until they are unmapped.
+        for old_path in glob.glob(
+                os.path.join(config.DOCUMENT_CACHE_DIR, "documents-*.bin")):
+            generation = os.path.basename(old_path).removeprefix(
+                "documents-").removesuffix(".bin")
+            if generation.isdigit() and int(generation) < blob.generation:
+                os.remove(old_path)
+    logging.info(f"Mapped {len(store)} documents from {path} "
+                 f"({store.nbytes / 2**20:.1f} MiB).")
+    return store
+
+
+def _iter_rendered_records(lines) -> Iterator[tuple[str, str]]:
+    """Parses JSONL records into (id, prompt text) pairs."""
+    for line in lines:
+        record = json.loads(line)
+        record_id = record.get("id")
+        if record_id:
+            # Ensure ID is a string for consistent key lookup
+            yield str(record_id), _format_record_for_prompt(record)
+        else:
+            logging.warning(f"Skipping record with missing 'id': {record}")
+
+
+def _refresh_cache():
+    """
+    Reloads the documents and swaps them in. On failure the current
+    snapshot is kept, so a GCS hiccup never empties the cache.
+    Must be called with _cache_lock held.
+    """
+    global _document_lookup_cache, _cache_load_time, _cache_generation
+    global _last_refresh_attempt_time, _last_refresh_error
+    _refresh_requested.clear()
+    _last_refresh_attempt_time = time.time()
+    if not config.GCS_SOURCE_BUCKET:
         logging.warning("GCS_SOURCE_BUCKET not set. "
                         "Document lookup will be disabled.")
         return
 
     try:
-        logging.info(
-            f"Refreshing document cache from gs://{bucket_name}/{blob_name}..."
-        )
-        storage_client = gcs.Client(project=config.PROJECT_ID)
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-
-        new_cache = {}
-        with blob.open("r") as f:
-            for line in f:
-                record = json.loads(line)
-                record_id = record.get("id")
-                if record_id:
-                    # Ensure ID is a string for consistent key lookup
-                    new_cache[str(record_id)] = record
-                else:
-                    logging.warning(
-                        f"Skipping record with missing 'id': {record}")
-
-        _document_lookup_cache = new_cache
+        known_generation = _cache_generation if _document_lookup_cache else None
+        new_cache, generation = _load_documents_from_gcs(known_generation)
+    except exceptions.NotFound:
+        _last_refresh_error = "source object not found"
+        logging.error(
+            f"GCS object gs://{config.GCS_SOURCE_BUCKET}/"
+            f"{config.GCS_SOURCE_BLOB_NAME} not found. "
+            f"Keeping {len(_document_lookup_cache)} cached documents.")
+        return
+    except Exception as e:
+        _last_refresh_error = str(e)
+        logging.error(
+            f"Failed to load documents from GCS: {e}. "
+            f"Keeping {len(_document_lookup_cache)} cached documents.",
+            exc_info=True)
+        return
+
+    _last_refresh_error = None
+    if new_cache is None:
+        # Unchanged since the last load: the snapshot is fresh for a new TTL.
         _cache_load_time = time.time()
         logging.info(
-            f"Successfully loaded {len(_document_lookup_cache)} documents into memory cache."
-        )
+            f"Document cache is up to date (generation {generation}).")
+        return
+
+    _document_lookup_cache = new_cache
+    _cache_load_time = time.time()
+    _cache_generation = generation
+    logging.info(
+        f"Successfully loaded {len(new_cache)} documents into memory cache.")
 
-    except exceptions.NotFound:
-        logging.error(f"GCS object gs://{bucket_name}/{blob_name} not found.")
-        _document_lookup_cache = {}
-    except Exception as e:
-        logging.error(f"Failed to load documents from GCS: {e}", exc_info=True)
-        _document_lookup_cache = {}
+
+def _refresh_in_background():
+    """Runs a refresh unless one is already in progress."""
+    if not _cache_lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            _refresh_cache()
+        finally:
+            _cache_lock.release()
+        if _refresh_requested.is_set():
+            # A change was notified after this refresh read the metadata.
+            _refresh_in_background()
+
+    threading.Thread(target=run, name="document-cache-refresh",
+                     daemon=True).start()
 
 
 def _is_cache_stale() -> bool:
-    """Checks if the cache is empty or if its TTL has expired."""
-    if not _document_lookup_cache:
-        return True
+    """Checks if the cache TTL has expired."""
     return (time.time() - _cache_load_time) > config.DOCUMENT_CACHE_TTL_SECONDS
 
 
+def _should_retry_refresh() -> bool:
+    """Rate-limits refresh attempts after a failure."""
+    return (time.time() -
+            _last_refresh_attempt_time) > config.DOCUMENT_CACHE_RETRY_SECONDS
+
+
+def start_background_refresh():
+    """Starts loading the documents without blocking, e.g. at startup."""
+    _refresh_in_background()
+
+
+def notify_object_changed(generation: int | None = None):
+    """
+    Handles a change notification for the source object (e.g. a GCS
+    Pub/Sub notification) by refreshing the cache right away instead of
+    waiting for the TTL. Notifications for the cached generation are
+    ignored.
+    """
+    if generation is not None and generation == _cache_generation:
+        return
+    logging.info(f"Source object changed (generation {generation}).")
+    _refresh_requested.set()
+    _refresh_in_background()
+
+
 def get_documents_by_ids(ids: List[str]) -> List[str]:
     """
     Retrieves the full content for a list of document IDs.
-    If the cache is stale, it safely triggers a refresh from GCS.
+
+    Once the cache is loaded, an expired TTL triggers a background refresh
+    and the current snapshot keeps being served until the new one is
+    swapped in (stale-while-revalidate). Only the very first load blocks.
     """
-    if _is_cache_stale():
-        # Use a lock to prevent multiple concurrent requests from all
-        # trying to refresh the cache at once (cache stampede problem).
+    if not _document_lookup_cache:
+        # Nothing to serve yet: wait for the initial load (possibly the one
+        # started at startup). The lock makes concurrent requests share a
+        # single download.
         with _cache_lock:
-            # Double-check if another thread already refreshed the cache
-            # while this thread was waiting for the lock.
-            if _is_cache_stale():
-                _load_documents_from_gcs()
+            if not _document_lookup_cache and _should_retry_refresh():
+                _refresh_cache()
+    elif _is_cache_stale() and _should_retry_refresh():
+        _refresh_in_background()
 
-    if not _document_lookup_cache:
+    documents = _document_lookup_cache
+    if not documents:
         logging.warning(
             "Document cache is not populated. Cannot retrieve documents.")
         return []
 
     found_docs = []
     for doc_id in ids:
-        record = _document_lookup_cache.get(str(doc_id))
-        if record:
-            formatted_content = _format_record_for_prompt(record)
+        formatted_content = documents.get(str(doc_id))
+        if formatted_content is not None:
             found_docs.append(formatted_content)
         else:
             logging.warning(f"Document ID '{doc_id}' not found in cache.")
@@ -123,10 +282,18 @@ def get_documents_by_ids(ids: List[str]) -> List[str]:
 
 def get_cache_status() -> str:
     """Returns a string describing the current state of the cache."""
+    status = "Not loaded or empty"
     if _document_lookup_cache:
         age_seconds = int(time.time() - _cache_load_time)
-        return f"Loaded {len(_document_lookup_cache)} documents ({age_seconds}s ago)"
-    return "Not loaded or empty"
+        status = (
+            f"Loaded {len(_document_lookup_cache)} documents "
+            f"({_document_lookup_cache.nbytes / 2**20:.1f} MiB, "
+            f"generation {_cache_generation}, checked {age_seconds}s ago)")
+    if _cache_lock.locked():
+        status += ", refreshing"
+    if _last_refresh_error:
+        status += f", last refresh failed: {_last_refresh_error}"
+    return status
 
 
 def _format_json_value_for_embedding(value: Any) -> str:
@@ -12,14 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import logging
 import sys
 from typing import List
 
-from google.cloud import aiplatform
-import google.api_core.exceptions as exceptions
+import grpc
+from google.api_core import exceptions as core_exceptions
+from google.cloud import aiplatform_v1
+from google.cloud.aiplatform_v1.services.match_service.transports import (
+    MatchServiceGrpcAsyncIOTransport)
+
+try:
+    # The match service protos are bundled with the Vertex AI SDK, which uses
+    # them for private endpoint queries. The module is private: if an SDK
+    # version moves it, queries go through the public match API instead.
+    from google.cloud.aiplatform.matching_engine._protos import (
+        match_service_pb2, match_service_pb2_grpc)
+except ImportError:
+    match_service_pb2 = None
+    match_service_pb2_grpc = None
 
 from src import config
+from src.request_model import MetadataFilters
 
 # Note: You may need to install the library:
 # pip install google-cloud-aiplatform
@@ -30,9 +45,193 @@ logging.basicConfig(
     format='%(name)s - %(levelname)s - %(message)s',
     handlers=[logging.StreamHandler(sys.stdout)])
 
+# Private Service Connect endpoints serve the match API on this port.
+_MATCH_SERVICE_PORT = 10000
+
+# Long-lived channel and stub, created once per process. The stub is a
+# public MatchServiceAsyncClient when the private protos are missing.
+_channel: grpc.aio.Channel | None = None
+_match_stub = None
+
+
+def _is_configured() -> bool:
+    return all([
+        config.VECTOR_SEARCH_DEPLOYED_INDEX_ID,
+        config.VECTOR_SEARCH_ENDPOINT_IP_ADDRESS
+    ])
+
+
+def _get_match_stub():
+    """
+    Returns the match service stub, opening the gRPC channel to the
+    index endpoint on first use. gRPC reconnects the channel by itself
+    after a failure, so it is kept for the life of the process.
+    """
+    global _channel, _match_stub
+    if _match_stub is None:
+        target = f"{config.VECTOR_SEARCH_ENDPOINT_IP_ADDRESS}:{_MATCH_SERVICE_PORT}"
+        logging.info(
+            f"Opening Vector Search channel to {target} (private service connect)."
+        )
+        _channel = grpc.aio.insecure_channel(target)
+        if match_service_pb2_grpc is not None:
+            _match_stub = match_service_pb2_grpc.MatchServiceStub(_channel)
+        else:
+            logging.warning(
+                "The match service protos are not in this Vertex AI SDK "
+                "version. Using the public match API (FindNeighbors).")
+            _match_stub = aiplatform_v1.MatchServiceAsyncClient(
+                transport=MatchServiceGrpcAsyncIOTransport(channel=_channel))
+    return _match_stub
+
+
+async def init_vector_search():
+    """
+    Opens the channel to the index endpoint at startup and checks that it
+    connects, so the first query does not pay for the connection setup.
+    A failed check is logged only: the channel keeps trying to connect.
+    """
+    if not _is_configured():
+        logging.warning(
+            "Vector Search is not configured. Skipping client initialization.")
+        return
+    _get_match_stub()
+    try:
+        await asyncio.wait_for(_channel.channel_ready(),
+                               timeout=config.VECTOR_SEARCH_TIMEOUT_SECONDS)
+        logging.info("Vector Search channel is ready.")
+    except asyncio.TimeoutError:
+        logging.error(
+            "Vector Search channel is not ready after "
+            f"{config.VECTOR_SEARCH_TIMEOUT_SECONDS}s. Queries may fail.")
+
+
+async def close_vector_search():
+    """Closes the channel to the index endpoint."""
+    global _channel, _match_stub
+    if _channel is not None:
+        await _channel.close()
+        logging.info("Vector Search channel closed.")
+    _channel = None
+    _match_stub = None
+
+
+def get_status() -> str:
+    """Returns a string describing the state of the Vector Search client."""
+    if not _is_configured():
+        return "not configured"
+    if _channel is None:
+        return "configured (not connected)"
+    state = _channel.get_state(try_to_connect=False)
+    return f"configured (channel {state.name.lower()})"
 
-def find_similar_document_ids(query_embedding: List[float],
-                              num_neighbors: int) -> List[str]:
+
+def _numeric_bounds(filters: MetadataFilters):
+    """
+    Returns the (name, value field, minimum, maximum) numeric restrict
+    bounds of the metadata filters.
+    """
+    return (
+        ("rank", "value_int", filters.min_rank, filters.max_rank),
+        ("rating", "value_float", filters.min_rating, filters.max_rating),
+        ("year", "value_int", filters.min_year, filters.max_year),
+    )
+
+
+def _build_match_request(
+        query_embedding: List[float], num_neighbors: int,
+        filters: MetadataFilters | None) -> "match_service_pb2.MatchRequest":
+    """
+    Builds the match request of a query. Metadata filters become token
+    restricts (genre) and numeric restricts (rank, rating, year), which
+    the ingestion job sets on every datapoint, so Vector Search only
+    ranks the matching datapoints.
+    """
+    request = match_service_pb2.MatchRequest(
+        deployed_index_id=config.VECTOR_SEARCH_DEPLOYED_INDEX_ID,
+        float_val=query_embedding,
+        num_neighbors=num_neighbors)
+    if filters is None:
+        return request
+    if filters.genres:
+        request.restricts.add(
+            name="genre",
+            allow_tokens=[genre.strip().lower() for genre in filters.genres])
+    operator = match_service_pb2.NumericNamespace.Operator
+    for name, value_field, minimum, maximum in _numeric_bounds(filters):
+        if minimum is not None:
+            request.numeric_restricts.add(name=name,
+                                          op=operator.GREATER_EQUAL,
+                                          **{value_field: minimum})
+        if maximum is not None:
+            request.numeric_restricts.add(name=name,
+                                          op=operator.LESS_EQUAL,
+                                          **{value_field: maximum})
+    return request
+
+
+def _build_query(
+    query_embedding: List[float], num_neighbors: int,
+    filters: MetadataFilters | None
+) -> aiplatform_v1.FindNeighborsRequest.Query:
+    """
+    Builds the public match API query of a query embedding, with the same
+    restricts as `_build_match_request`.
+    """
+    datapoint = aiplatform_v1.IndexDatapoint(feature_vector=query_embedding)
+    if filters is not None:
+        if filters.genres:
+            datapoint.restricts.append(
+                aiplatform_v1.IndexDatapoint.Restriction(
+                    namespace="genre",
+                    allow_list=[
+                        genre.strip().lower() for genre in filters.genres
+                    ]))
+        operator = aiplatform_v1.IndexDatapoint.NumericRestriction.Operator
+        for name, value_field, minimum, maximum in _numeric_bounds(filters):
+            for value, op in ((minimum, operator.GREATER_EQUAL),
+                              (maximum, operator.LESS_EQUAL)):
+                if value is not None:
+                    datapoint.numeric_restricts.append(
+                        aiplatform_v1.IndexDatapoint.NumericRestriction(
+                            namespace=name, op=op, **{value_field: value}))
+    return aiplatform_v1.FindNeighborsRequest.Query(
+        datapoint=datapoint, neighbor_count=num_neighbors)
+
+
+def _index_endpoint_resource_name() -> str:
+    """Returns the full resource name of the index endpoint."""
+    name = config.VECTOR_SEARCH_INDEX_ENDPOINT_NAME or ""
+    if name.startswith("projects/"):
+        return name
+    return (f"projects/{config.PROJECT_ID}/locations/{config.REGION}"
+            f"/indexEndpoints/{name}")
+
+
+async def _find_neighbors(
+        query_embeddings: List[List[float]], num_neighbors: int,
+        filters: List[MetadataFilters | None]) -> List[List[str]]:
+    """
+    Searches for the neighbors of the query embeddings with a single
+    request to the public match API.
+    """
+    request = aiplatform_v1.FindNeighborsRequest(
+        index_endpoint=_index_endpoint_resource_name(),
+        deployed_index_id=config.VECTOR_SEARCH_DEPLOYED_INDEX_ID,
+        queries=[
+            _build_query(query_embedding, num_neighbors, query_filters) for
+            query_embedding, query_filters in zip(query_embeddings, filters)
+        ])
+    response = await _get_match_stub().find_neighbors(
+        request=request, timeout=config.VECTOR_SEARCH_TIMEOUT_SECONDS)
+    return [[neighbor.datapoint.datapoint_id for neighbor in result.neighbors]
+            for result in response.nearest_neighbors]
+
+
+async def find_similar_document_ids(
+        query_embedding: List[float],
+        num_neighbors: int,
+        filters: MetadataFilters | None = None) -> List[str]:
     """
     Searches for documents with embeddings similar to the query_embedding
     using Vertex AI Vector Search and returns their IDs.
@@ -40,57 +239,98 @@ def find_similar_document_ids(query_embedding: List[float],
     Args:
         query_embedding: A list of floats representing the query embedding.
         num_neighbors: The number of nearest neighbors to retrieve.
+        filters: Optional metadata filters the neighbors must match.
 
     Returns:
         A list of strings, where each string is the ID of a similar document.
     """
-    if not all([
-            config.VECTOR_SEARCH_INDEX_ENDPOINT_NAME,
-            config.VECTOR_SEARCH_DEPLOYED_INDEX_ID
-    ]):
-        logging.warning(
-            "Vector Search is not configured. Skipping document search.")
-        return []
+    return (await find_similar_document_ids_batch([query_embedding],
+                                                  num_neighbors, [filters]))[0]
 
-    try:
-        logging.info("Initializing Vertex AI Platform client.")
-        aiplatform.init(project=config.PROJECT_ID, location=config.REGION)
 
-        index_endpoint = aiplatform.MatchingEngineIndexEndpoint(
-            index_endpoint_name=config.VECTOR_SEARCH_INDEX_ENDPOINT_NAME)
+async def find_similar_document_ids_batch(
+        query_embeddings: List[List[float]],
+        num_neighbors: int,
+        filters: List[MetadataFilters | None] | None = None
+) -> List[List[str]]:
+    """
+    Searches for the neighbors of several query embeddings in a single
+    Vector Search request.
 
-        index_endpoint.private_service_connect_ip_address = config.VECTOR_SEARCH_ENDPOINT_IP_ADDRESS
-        logging.info(
-            f"Using private service connect with IP: {config.VECTOR_SEARCH_ENDPOINT_IP_ADDRESS}"
-        )
+    Args:
+        query_embeddings: The query embeddings.
+        num_neighbors: The number of nearest neighbors to retrieve per query.
+        filters: Optional metadata filters per query, in query order.
 
-        logging.info(
-            f"Querying Vector Search index for {num_neighbors} neighbors.")
+    Returns:
+        One list of similar document IDs per query, in query order. Queries
+        get an empty list if the search fails.
+    """
+    no_results: List[List[str]] = [[] for _ in query_embeddings]
+    if not _is_configured():
+        logging.warning(
+            "Vector Search is not configured. Skipping document search.")
+        return no_results
+    if not query_embeddings:
+        return no_results
 
-        # The match method expects a list of queries.
-        # We are sending a single query.
-        response = index_endpoint.match(
-            deployed_index_id=config.VECTOR_SEARCH_DEPLOYED_INDEX_ID,
-            queries=[query_embedding],
-            num_neighbors=num_neighbors)
+    try:
+        logging.info(f"Querying Vector Search index for {num_neighbors} "
+                     f"neighbors of {len(query_embeddings)} queries.")
 
-        # The response is a list of lists of MatchNeighbor objects.
-        neighbors = response[0] if response else []
+        if filters is None:
+            filters = [None] * len(query_embeddings)
+        if match_service_pb2 is None:
+            document_ids = await _find_neighbors(query_embeddings,
+                                                 num_neighbors, filters)
+            logging.info(
+                f"Retrieved {sum(len(ids) for ids in document_ids)} similar document IDs from Vector Search."
+            )
+            return document_ids
+        requests = [
+            _build_match_request(query_embedding, num_neighbors, query_filters)
+            for query_embedding, query_filters in zip(query_embeddings,
+                                                      filters)
+        ]
+        if len(requests) == 1:
+            responses = [
+                await _get_match_stub().Match(
+                    requests[0], timeout=config.VECTOR_SEARCH_TIMEOUT_SECONDS)
+            ]
+        else:
+            batch_request = match_service_pb2.BatchMatchRequest()
+            batch_request.requests.add(
+                deployed_index_id=config.VECTOR_SEARCH_DEPLOYED_INDEX_ID,
+                requests=requests)
+            batch_response = await _get_match_stub().BatchMatch(
+                batch_request, timeout=config.VECTOR_SEARCH_TIMEOUT_SECONDS)
+            index_response = batch_response.responses[0]
+            if index_response.status.code != grpc.StatusCode.OK.value[0]:
+                logging.error("Vector Search batch query failed: "
+                              f"{index_response.status.message}")
+                return no_results
+            responses = list(index_response.responses)
 
         # Return only the IDs of the neighbors.
         # The calling function will be responsible for looking up the content.
-        document_ids = [neighbor.id for neighbor in neighbors]
+        document_ids = [[neighbor.id for neighbor in response.neighbor]
+                        for response in responses]
 
         logging.info(
-            f"Retrieved {len(document_ids)} similar document IDs from Vector Search."
+            f"Retrieved {sum(len(ids) for ids in document_ids)} similar document IDs from Vector Search."
         )
         return document_ids
 
-    except exceptions.GoogleAPICallError as e:
+    except grpc.aio.AioRpcError as e:
+        logging.error(
+            f"Vector Search API call failed: {e.code().name}: {e.details()}",
+            exc_info=True)
+        return no_results
+    except core_exceptions.GoogleAPICallError as e:
         logging.error(f"Vector Search API call failed: {e}", exc_info=True)
-        return []
+        return no_results
     except Exception as e:
         logging.error(
             f"An unexpected error occurred during Vector Search query: {e}",
             exc_info=True)
-        return []
+        return no_results
@@ -12,16 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ast
 import os
 import logging
 import sys
 import json
+import time
 from typing import Any, List, Dict
 
-from vertexai.language_models import TextEmbeddingModel
 from google.cloud import aiplatform
 
+from src import batch_update
+from src import checkpoint
 from src import config
+from src import embeddings
 from src import storage
 from src import vector_search
 
@@ -34,14 +38,16 @@ try:
     if not config.VECTOR_SEARCH_INDEX_NAME:
         raise KeyError(
             "VECTOR_SEARCH_INDEX_NAME environment variable must be set.")
+    if config.INDEX_UPDATE_MODE not in ("stream", "batch"):
+        raise ValueError(
+            f"INDEX_UPDATE_MODE must be 'stream' or 'batch', not '{config.INDEX_UPDATE_MODE}'."
+        )
 
 except KeyError as e:
     logging.error(f"Missing required environment variable: {e}")
     sys.exit(1)
 except ValueError as e:
-    logging.error(
-        f"Error parsing numeric environment variable (e.g., BATCH_SIZE_*, EMBEDDING_DIMENSIONS): {e}"
-    )
+    logging.error(f"Invalid environment variable: {e}")
     sys.exit(1)
 
 # --- Logging Setup ---
@@ -60,6 +66,14 @@ except Exception as e:
     logger.error(f"Error initializing Vertex AI SDK: {e}")
     sys.exit(1)
 
+# Numeric restricts set on every datapoint: (field, value type, cast).
+# The frontend filters use the same namespaces and value types.
+NUMERIC_RESTRICTS = (
+    ("rank", "value_int", int),
+    ("rating", "value_float", float),
+    ("year", "value_int", int),
+)
+
 
 def format_json_value_for_embedding(value: Any) -> str:
     """
@@ -72,36 +86,134 @@ def format_json_value_for_embedding(value: Any) -> str:
     return str(value).strip()
 
 
-def get_embeddings_batch_vertexai(texts: list[str]) -> list[list[float]]:
-    """Gets embeddings for a batch of texts using Vertex AI TextEmbeddingModel."""
-    if not texts:
-        return []
-    try:
-        model = TextEmbeddingModel.from_pretrained(config.EMBEDDING_MODEL_NAME)
-        response = model.get_embeddings(texts)
-        return [embedding.values for embedding in response]
-    except Exception as e:
-        logger.error(
-            f"Error getting embeddings from Vertex AI (model: {config.EMBEDDING_MODEL_NAME}): {e}"
-        )
+def parse_genres(value: Any) -> list[str]:
+    """
+    Returns the genres of a record as lowercase tokens. The source stores
+    them as a list, or as the text of a Python list ("['Action', 'Drama']").
+    """
+    if value is None:
         return []
+    if isinstance(value, str):
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            value = value.split(",")
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    return [
+        str(genre).strip().lower() for genre in value if str(genre).strip()
+    ]
+
+
+def create_restricts(record: dict) -> dict:
+    """
+    Creates the restricts of a datapoint from the record metadata, so that
+    queries can filter on genre (tokens) and on rank, rating and year
+    (numeric). Missing or invalid values are left out.
+    """
+    restricts = {}
+    genres = parse_genres(record.get("genre"))
+    if genres:
+        restricts["restricts"] = [{"namespace": "genre", "allow_list": genres}]
+    numeric_restricts = []
+    for name, value_field, cast in NUMERIC_RESTRICTS:
+        try:
+            value = cast(record[name])
+        except (KeyError, TypeError, ValueError):
+            continue
+        numeric_restricts.append({"namespace": name, value_field: value})
+    if numeric_restricts:
+        restricts["numeric_restricts"] = numeric_restricts
+    return restricts
 
 
-def create_datapoint(record_id: str, embedding: list[float]) -> dict:
+def create_datapoint(record_id: str,
+                     embedding: list[float],
+                     restricts: dict | None = None) -> dict:
     """
-    Creates a simple datapoint dictionary for the Vector Search upsert API,
-    containing only the ID and the feature vector.
+    Creates a datapoint dictionary for the Vector Search upsert API,
+    containing the ID, the feature vector and the optional restricts.
     """
     return {
         "datapoint_id": record_id,
         "feature_vector": embedding,
+        **(restricts or {}),
     }
 
 
+def embed_batch(batch: list[dict]) -> list[dict]:
+    """
+    Embeds a batch of records and returns their Vector Search datapoints.
+    Records the embedding API rejects are left out.
+    """
+    texts = [item['text_to_embed'] for item in batch]
+    datapoints = []
+    for item, embedding in zip(batch, embeddings.get_embeddings(texts)):
+        if embedding is None:
+            logger.error(f"No embedding for record ID {item['id']}, skipping.")
+            continue
+        datapoints.append(
+            create_datapoint(item['id'], embedding, item.get('restricts')))
+    return datapoints
+
+
+def create_datapoint_writer(import_file_count: int = 0):
+    """
+    Returns the object the datapoints are added to, depending on
+    INDEX_UPDATE_MODE: a streaming upserter, or an import file writer that
+    updates the index in one batch operation at the end of the job.
+    A resumed import file writer starts after `import_file_count` files.
+    """
+    if config.INDEX_UPDATE_MODE == "stream":
+        return vector_search.DatapointUpserter(
+            project=config.PROJECT_ID,
+            location=config.REGION,
+            index_name=config.VECTOR_SEARCH_INDEX_NAME)
+    run_id = config.BATCH_UPDATE_RUN_ID or time.strftime("%Y%m%d-%H%M%S")
+    return batch_update.ImportFileWriter(
+        project=config.PROJECT_ID,
+        location=config.REGION,
+        index_name=config.VECTOR_SEARCH_INDEX_NAME,
+        output_uri=config.BATCH_UPDATE_URI,
+        run_id=run_id,
+        task_index=config.TASK_INDEX,
+        task_count=config.TASK_COUNT,
+        max_datapoints_per_file=config.BATCH_UPDATE_FILE_MAX_DATAPOINTS,
+        complete_overwrite=config.BATCH_UPDATE_COMPLETE_OVERWRITE,
+        file_count=import_file_count,
+        task_attempt=config.TASK_ATTEMPT)
+
+
+def load_resume_checkpoint(store: checkpoint.CheckpointStore | None,
+                           source_uri: str) -> dict | None:
+    """
+    Returns the checkpoint a retried task resumes from, or None if the
+    task starts from the beginning.
+    """
+    if store is None or config.TASK_ATTEMPT == 0:
+        return None
+    state = store.load()
+    if state is None:
+        logger.info(
+            f"Attempt {config.TASK_ATTEMPT} found no checkpoint, starting from the beginning."
+        )
+        return None
+    if (state.get("source") != source_uri
+            or state.get("mode") != config.INDEX_UPDATE_MODE):
+        logger.warning(
+            f"Ignoring checkpoint {state}: it was saved for another source or mode."
+        )
+        return None
+    logger.info(
+        f"Attempt {config.TASK_ATTEMPT} resumes from checkpoint {state}.")
+    return state
+
+
 def run_indexer():
     """
     Streams data from a GCS JSONL file, generates embeddings, and upserts
-    them into a Vertex AI Vector Search index.
+    them into a Vertex AI Vector Search index, or writes them to import
+    files for a batch index update.
     """
     logger.info("Starting indexer job...")
     logger.info(f"Project ID: {config.PROJECT_ID}, Region: {config.REGION}")
@@ -109,117 +221,145 @@ def run_indexer():
         f"GCS source: gs://{config.GCS_SOURCE_BUCKET}/{config.GCS_SOURCE_BLOB_NAME}"
     )
     logger.info(f"Vector Search Index: {config.VECTOR_SEARCH_INDEX_NAME}")
+    logger.info(f"Shard: task {config.TASK_INDEX} of {config.TASK_COUNT}")
     logger.info(
         f"Embedding Model: {config.EMBEDDING_MODEL_NAME} ({config.EMBEDDING_DIMENSIONS} dims)"
     )
+    logger.info(f"Index update mode: {config.INDEX_UPDATE_MODE}")
     logger.info(
-        f"Batch sizes: Embedding Request={config.EMBEDDING_BATCH_SIZE}, Vector Search Upsert={config.VECTOR_SEARCH_UPSERT_BATCH_SIZE}"
+        f"Batch sizes: Embedding Request={config.EMBEDDING_BATCH_SIZE}, Vector Search Upsert={config.VECTOR_SEARCH_UPSERT_BATCH_SIZE} (adaptive, {config.VECTOR_SEARCH_UPSERT_CONCURRENCY} concurrent)"
     )
 
+    source_uri = f"gs://{config.GCS_SOURCE_BUCKET}/{config.GCS_SOURCE_BLOB_NAME}"
+    checkpoint_store = None
+    if config.RUN_ID and config.CHECKPOINT_INTERVAL_SECONDS > 0:
+        checkpoint_blob_name = f"{config.CHECKPOINT_PREFIX}/{config.RUN_ID}/task-{config.TASK_INDEX:05d}.json"
+        checkpoint_store = checkpoint.CheckpointStore(
+            bucket_name=config.CHECKPOINT_BUCKET,
+            blob_name=checkpoint_blob_name,
+            project_id=config.PROJECT_ID)
+    else:
+        logger.info("Checkpoints are disabled.")
+    state = load_resume_checkpoint(checkpoint_store, source_uri) or {}
+
     batch_for_embedding = []
-    batch_for_upsert = []
     total_processed_count = 0
-    total_upserted_count = 0
+    # Datapoints are upserted or written in the background while the next
+    # batches are embedded.
+    writer = create_datapoint_writer(state.get("import_files", 0))
+    # The source position after the last record passed to the writer
+    progress = {"position": state.get("position", 0)}
+
+    def commit_checkpoint() -> dict:
+        # Every record before the position must be stored before saving it.
+        writer.flush()
+        new_state = {
+            "source": source_uri,
+            "mode": config.INDEX_UPDATE_MODE,
+            "position": progress["position"],
+        }
+        if config.INDEX_UPDATE_MODE == "batch":
+            new_state["import_files"] = writer.file_count
+        return new_state
+
+    checkpointer = None
+    if checkpoint_store:
+        checkpointer = checkpoint.Checkpointer(
+            commit_checkpoint, checkpoint_store.save,
+            config.CHECKPOINT_INTERVAL_SECONDS)
+
+    def send_batch(batch: list[dict]):
+        writer.add(embed_batch(batch))
+        progress["position"] = batch[-1]["position"]
+        if checkpointer:
+            checkpointer.update()
 
     # Stream the source file line by line
     source_iterator = storage.stream_gcs_jsonl_file(
         project_id=config.PROJECT_ID,
         bucket_name=config.GCS_SOURCE_BUCKET,
-        blob_name=config.GCS_SOURCE_BLOB_NAME)
-
-    for record in source_iterator:
-        total_processed_count += 1
+        blob_name=config.GCS_SOURCE_BLOB_NAME,
+        shard_index=config.TASK_INDEX,
+        shard_count=config.TASK_COUNT,
+        chunk_size=config.GCS_READ_CHUNK_SIZE_MB * 1024 * 1024,
+        num_workers=config.GCS_READ_WORKERS,
+        compression=config.GCS_SOURCE_COMPRESSION,
+        resume_position=progress["position"])
 
-        # 1. Extract the ID and prepare text for embedding
-        record_id = record.get("id")
-        if not record_id:
-            logger.warning(
-                f"Skipping record number {total_processed_count} due to missing 'id' field. Record: {record}"
-            )
-            continue
-        record_id = str(record_id)  # Ensure ID is a string for Vector Search
-
-        content_parts = []
-        # Dynamically iterate over all keys in the record, except for 'id'
-        for key, value in record.items():
-            if key == "id":
+    try:
+        for position, record in source_iterator:
+            total_processed_count += 1
+
+            # 1. Extract the ID and prepare text for embedding
+            record_id = record.get("id")
+            if not record_id:
+                logger.warning(
+                    f"Skipping record number {total_processed_count} due to missing 'id' field. Record: {record}"
+                )
+                continue
+            record_id = str(
+                record_id)  # Ensure ID is a string for Vector Search
+
+            content_parts = []
+            # Dynamically iterate over all keys in the record, except for 'id'
+            for key, value in record.items():
+                if key == "id":
+                    continue
+                formatted_value = format_json_value_for_embedding(value)
+                content_parts.append(f"{key}: {formatted_value}")
+
+            # Sort parts by key for deterministic embedding generation
+            text_to_embed = "; ".join(sorted(content_parts))
+
+            if not text_to_embed.strip():
+                logger.warning(
+                    f"Skipping record with ID {record_id} due to empty content."
+                )
                 continue
-            formatted_value = format_json_value_for_embedding(value)
-            content_parts.append(f"{key}: {formatted_value}")
-
-        # Sort parts by key for deterministic embedding generation
-        text_to_embed = "; ".join(sorted(content_parts))
-
-        if not text_to_embed.strip():
-            logger.warning(
-                f"Skipping record with ID {record_id} due to empty content.")
-            continue
-
-        batch_for_embedding.append({
-            "id": record_id,
-            "text_to_embed": text_to_embed
-        })
-
-        # 2. Process batch for embeddings when full
-        if len(batch_for_embedding) >= config.EMBEDDING_BATCH_SIZE:
-            logger.info(
-                f"Requesting embeddings for a batch of {len(batch_for_embedding)} records..."
-            )
-            texts = [item['text_to_embed'] for item in batch_for_embedding]
-            embeddings = get_embeddings_batch_vertexai(texts)
-
-            if embeddings and len(embeddings) == len(batch_for_embedding):
-                for item, embedding in zip(batch_for_embedding, embeddings):
-                    datapoint = create_datapoint(item['id'], embedding)
-                    batch_for_upsert.append(datapoint)
-            else:
-                logger.error("Failed to get embeddings for a batch, skipping.")
-
-            batch_for_embedding = []  # Clear the batch
 
-        # 3. Process batch for Vector Search upsert when full
-        if len(batch_for_upsert) >= config.VECTOR_SEARCH_UPSERT_BATCH_SIZE:
+            batch_for_embedding.append({
+                "id": record_id,
+                "text_to_embed": text_to_embed,
+                "restricts": create_restricts(record),
+                "position": position
+            })
+
+            # 2. Process batch for embeddings when full
+            if len(batch_for_embedding) >= config.EMBEDDING_BATCH_SIZE:
+                logger.info(
+                    f"Requesting embeddings for a batch of {len(batch_for_embedding)} records..."
+                )
+                # 3. Queue the datapoints for Vector Search
+                send_batch(batch_for_embedding)
+
+                batch_for_embedding = []  # Clear the batch
+
+        # Process any remaining items in the embedding batch
+        if batch_for_embedding:
             logger.info(
-                f"Upserting a batch of {len(batch_for_upsert)} datapoints to Vector Search..."
+                f"Requesting embeddings for the final batch of {len(batch_for_embedding)} records..."
             )
-            vector_search.upsert_datapoints_to_index(
-                project=config.PROJECT_ID,
-                location=config.REGION,
-                index_name=config.VECTOR_SEARCH_INDEX_NAME,
-                datapoints=batch_for_upsert)
-            total_upserted_count += len(batch_for_upsert)
-            batch_for_upsert = []  # Clear the batch
-
-    # Process any remaining items in the embedding batch
-    if batch_for_embedding:
-        logger.info(
-            f"Requesting embeddings for the final batch of {len(batch_for_embedding)} records..."
-        )
-        texts = [item['text_to_embed'] for item in batch_for_embedding]
-        embeddings = get_embeddings_batch_vertexai(texts)
-        if embeddings and len(embeddings) == len(batch_for_embedding):
-            for item, embedding in zip(batch_for_embedding, embeddings):
-                datapoint = create_datapoint(item['id'], embedding)
-                batch_for_upsert.append(datapoint)
-
-    # Upsert any remaining datapoints
-    if batch_for_upsert:
-        logger.info(
-            f"Upserting the final batch of {len(batch_for_upsert)} datapoints to Vector Search..."
-        )
-        vector_search.upsert_datapoints_to_index(
-            project=config.PROJECT_ID,
-            location=config.REGION,
-            index_name=config.VECTOR_SEARCH_INDEX_NAME,
-            datapoints=batch_for_upsert)
-        total_upserted_count += len(batch_for_upsert)
+            send_batch(batch_for_embedding)
+    except Exception:
+        # Save the progress made before the failure, for the next attempt.
+        if checkpointer:
+            checkpointer.flush()
+        raise
+
+    # Upsert or write any remaining datapoints and wait for them
+    total_upserted_count = writer.close()
+    if checkpoint_store:
+        checkpoint_store.delete()
 
     logger.info("Indexer job finished.")
     logger.info(
         f"Total records processed from GCS file: {total_processed_count}.")
     logger.info(
-        f"Total datapoints successfully upserted to Vector Search: {total_upserted_count}."
+        f"Total datapoints successfully sent to Vector Search ({config.INDEX_UPDATE_MODE} mode): {total_upserted_count}."
     )
+    if writer.failed:
+        logger.warning(
+            f"Total datapoints that failed to upsert: {writer.failed}.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import time
+from collections.abc import Callable
+from typing import Any, Dict, Optional
+
+from google.cloud import storage
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+    """Stores the checkpoint of a task as a small JSON object in GCS."""
+
+    def __init__(self,
+                 bucket_name: str,
+                 blob_name: str,
+                 project_id: Optional[str] = None):
+        self.uri = f"gs://{bucket_name}/{blob_name}"
+        self._blob = storage.Client(
+            project=project_id).bucket(bucket_name).blob(blob_name)
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """Returns the saved checkpoint, or None if there is none."""
+        try:
+            return json.loads(self._blob.download_as_bytes())
+        except Exception as e:
+            # NotFound when the task never saved one.
+            logger.info(f"No checkpoint loaded from {self.uri}: {e}")
+            return None
+
+    def save(self, state: Dict[str, Any]):
+        self._blob.upload_from_string(json.dumps(state),
+                                      content_type="application/json")
+
+    def delete(self):
+        try:
+            self._blob.delete()
+        except Exception as e:
+            logger.warning(f"Failed to delete checkpoint {self.uri}: {e}")
+
+
+class Checkpointer:
+    """
+    Saves the progress of a task at most every `interval_seconds`, so that
+    a retry of the task can resume from it instead of starting over.
+
+    `update` is called as the task goes. When a checkpoint is due, it calls
+    `commit`, which must wait until the work done so far is stored and
+    return the state to save; then it saves that state with `save`. Saving
+    is best effort: a failed save is logged, and the next one tries again.
+    """
+
+    def __init__(self, commit: Callable[[], Dict[str, Any]],
+                 save: Callable[[Dict[str, Any]],
+                                None], interval_seconds: float):
+        self._commit = commit
+        self._save = save
+        self.interval_seconds = interval_seconds
+        self._last_save = time.monotonic()
+
+    def update(self):
+        """Saves a checkpoint if the interval has elapsed."""
+        if time.monotonic() - self._last_save >= self.interval_seconds:
+            self.flush()
+
+    def flush(self):
+        """Saves a checkpoint now."""
+        self._last_save = time.monotonic()
+        state = self._commit()
+        try:
+            self._save(state)
+            logger.info(f"Saved checkpoint {state}.")
+        except Exception as e:
+            logger.warning(f"Failed to save checkpoint {state}: {e}")
@@ -20,6 +20,31 @@ REGION = os.environ.get("REGION", "europe-west1")
 # Google Cloud Storage Configuration (for the SOURCE file)
 GCS_SOURCE_BUCKET = os.environ.get("GCS_SOURCE_BUCKET")
 GCS_SOURCE_BLOB_NAME = os.environ.get("GCS_SOURCE_BLOB_NAME", "data.jsonl")
+# "auto" detects gzip or zstd from the Content-Encoding or the name suffix
+# (.gz, .zst); "none", "gzip" or "zstd" force it
+GCS_SOURCE_COMPRESSION = os.environ.get("GCS_SOURCE_COMPRESSION",
+                                        "auto").lower()
+# The source is downloaded in byte ranges of this size, several at a time
+GCS_READ_CHUNK_SIZE_MB = int(os.environ.get("GCS_READ_CHUNK_SIZE_MB", 16))
+GCS_READ_WORKERS = int(os.environ.get("GCS_READ_WORKERS", 4))
+
+# Cloud Run Job Configuration (set by Cloud Run, used to shard the source file)
+TASK_INDEX = int(os.environ.get("CLOUD_RUN_TASK_INDEX", 0))
+TASK_COUNT = int(os.environ.get("CLOUD_RUN_TASK_COUNT", 1))
+# 0 for the first attempt of a task, higher for its retries
+TASK_ATTEMPT = int(os.environ.get("CLOUD_RUN_TASK_ATTEMPT", 0))
+# Set by Cloud Run, shared by every task (and attempt) of a job execution
+RUN_ID = os.environ.get("CLOUD_RUN_EXECUTION")
+
+# Checkpoint Configuration
+# Each task saves its position in the source at most this often, and its
+# retries resume from it. 0 disables checkpoints. They are only saved
+# within a Cloud Run Job execution (when CLOUD_RUN_EXECUTION is set).
+CHECKPOINT_INTERVAL_SECONDS = float(
+    os.environ.get("CHECKPOINT_INTERVAL_SECONDS", 60))
+# Checkpoints are stored as gs://CHECKPOINT_BUCKET/CHECKPOINT_PREFIX/<execution>/task-<index>.json
+CHECKPOINT_BUCKET = os.environ.get("CHECKPOINT_BUCKET", GCS_SOURCE_BUCKET)
+CHECKPOINT_PREFIX = os.environ.get("CHECKPOINT_PREFIX", "checkpoints")
 
 # Embedding Model Configuration
 EMBEDDING_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_NAME",
@@ -27,9 +52,49 @@ EMBEDDING_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_NAME",
 EMBEDDING_DIMENSIONS = int(os.environ.get("EMBEDDING_DIMENSIONS", 768))
 EMBEDDING_BATCH_SIZE = int(os.environ.get(
     "EMBEDDING_BATCH_SIZE", 200))  # Batch for calling the embedding model API
+EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", 5))
+EMBEDDING_RETRY_BASE_DELAY_SECONDS = float(
+    os.environ.get("EMBEDDING_RETRY_BASE_DELAY_SECONDS", 1.0))
+EMBEDDING_RETRY_MAX_DELAY_SECONDS = float(
+    os.environ.get("EMBEDDING_RETRY_MAX_DELAY_SECONDS", 60.0))
 
 # Vector Search Configuration
 VECTOR_SEARCH_INDEX_NAME = os.environ.get("VECTOR_SEARCH_INDEX_NAME")
-# Batch size for the upsert_datapoints API call (max 1000, recommended 100-200)
+# Initial batch size for the upsert_datapoints API call. It then adapts
+# between the min and max (API limit 1000) to the observed latency and quota.
 VECTOR_SEARCH_UPSERT_BATCH_SIZE = int(
     os.environ.get("VECTOR_SEARCH_UPSERT_BATCH_SIZE", 100))
+VECTOR_SEARCH_UPSERT_MIN_BATCH_SIZE = int(
+    os.environ.get("VECTOR_SEARCH_UPSERT_MIN_BATCH_SIZE", 10))
+VECTOR_SEARCH_UPSERT_MAX_BATCH_SIZE = int(
+    os.environ.get("VECTOR_SEARCH_UPSERT_MAX_BATCH_SIZE", 1000))
+# Batches grow while upserts are faster than this, and shrink otherwise
+VECTOR_SEARCH_UPSERT_TARGET_LATENCY_SECONDS = float(
+    os.environ.get("VECTOR_SEARCH_UPSERT_TARGET_LATENCY_SECONDS", 5.0))
+# Number of upsert requests in flight at the same time
+VECTOR_SEARCH_UPSERT_CONCURRENCY = int(
+    os.environ.get("VECTOR_SEARCH_UPSERT_CONCURRENCY", 4))
+VECTOR_SEARCH_UPSERT_MAX_RETRIES = int(
+    os.environ.get("VECTOR_SEARCH_UPSERT_MAX_RETRIES", 5))
+VECTOR_SEARCH_UPSERT_RETRY_BASE_DELAY_SECONDS = float(
+    os.environ.get("VECTOR_SEARCH_UPSERT_RETRY_BASE_DELAY_SECONDS", 1.0))
+VECTOR_SEARCH_UPSERT_RETRY_MAX_DELAY_SECONDS = float(
+    os.environ.get("VECTOR_SEARCH_UPSERT_RETRY_MAX_DELAY_SECONDS", 60.0))
+
+# Index update mode: "stream" upserts datapoints as they are embedded, for
+# small deltas; "batch" writes import files and updates the index from them
+# once every task is done, for full rebuilds. The index must accept batch
+# updates for "batch".
+INDEX_UPDATE_MODE = os.environ.get("INDEX_UPDATE_MODE", "stream").lower()
+# Where batch mode writes its import files (gs://... or a local directory),
+# in a subdirectory per job execution
+BATCH_UPDATE_URI = os.environ.get(
+    "BATCH_UPDATE_URI",
+    f"gs://{GCS_SOURCE_BUCKET}/index-updates" if GCS_SOURCE_BUCKET else None)
+# Identifies the run, shared by every task of a Cloud Run Job execution
+BATCH_UPDATE_RUN_ID = os.environ.get("BATCH_UPDATE_RUN_ID", RUN_ID)
+BATCH_UPDATE_FILE_MAX_DATAPOINTS = int(
+    os.environ.get("BATCH_UPDATE_FILE_MAX_DATAPOINTS", 100000))
+# Replace the whole index content ("true"), or add and update datapoints
+BATCH_UPDATE_COMPLETE_OVERWRITE = os.environ.get(
+    "BATCH_UPDATE_COMPLETE_OVERWRITE", "true").lower() == "true"
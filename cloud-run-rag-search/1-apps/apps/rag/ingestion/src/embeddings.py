@@ -0,0 +1,117 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import random
+import threading
+import time
+
+import google.api_core.exceptions as exceptions
+from vertexai.language_models import TextEmbeddingModel
+
+from src import config
+
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying as is: quota (429) and server-side (5xx) failures.
+_RETRYABLE_ERRORS = (exceptions.TooManyRequests, exceptions.ServerError)
+
+_model: TextEmbeddingModel | None = None
+_model_lock = threading.Lock()
+
+
+def get_model() -> TextEmbeddingModel:
+    """Returns the process-wide embedding model, loading it on first use."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                logger.info(
+                    f"Loading embedding model '{config.EMBEDDING_MODEL_NAME}'."
+                )
+                _model = TextEmbeddingModel.from_pretrained(
+                    config.EMBEDDING_MODEL_NAME)
+    return _model
+
+
+def _get_embeddings_with_retry(texts: list[str]) -> list[list[float]]:
+    """Calls the embedding API, retrying with jittered exponential backoff."""
+    attempt = 0
+    while True:
+        try:
+            response = get_model().get_embeddings(texts)
+            return [embedding.values for embedding in response]
+        except _RETRYABLE_ERRORS as e:
+            attempt += 1
+            if attempt > config.EMBEDDING_MAX_RETRIES:
+                raise
+            # Full jitter: sleep a random time up to the exponential backoff.
+            delay = random.uniform(
+                0,
+                min(config.EMBEDDING_RETRY_MAX_DELAY_SECONDS,
+                    config.EMBEDDING_RETRY_BASE_DELAY_SECONDS * 2**attempt))
+            logger.warning(
+                f"Embedding request for {len(texts)} texts failed ({e}). Retry {attempt}/{config.EMBEDDING_MAX_RETRIES} in {delay:.1f}s."
+            )
+            time.sleep(delay)
+
+
+def get_embeddings(texts: list[str]) -> list[list[float] | None]:
+    """
+    Gets embeddings for a batch of texts using the shared embedding model.
+
+    Quota and server errors are retried. If the API rejects the batch as
+    invalid (e.g. too many instances or tokens), the batch is split in half
+    and each half is embedded separately, down to single texts. Texts that
+    are rejected on their own get None instead of an embedding, so callers
+    only lose the rows that really cannot be embedded.
+
+    Args:
+        texts: The texts to embed.
+
+    Returns:
+        A list with one embedding (or None) per input text, in input order.
+
+    Raises:
+        google.api_core.exceptions.GoogleAPIError: If the request still fails
+            after all retries.
+        ValueError: If the model returns embeddings of an unexpected size.
+    """
+    if not texts:
+        return []
+    try:
+        embeddings: list[list[float] | None] = list(
+            _get_embeddings_with_retry(texts))
+    except exceptions.InvalidArgument as e:
+        if len(texts) == 1:
+            logger.error(
+                f"Embedding API rejected text '{texts[0][:50]}...': {e}. Skipping it."
+            )
+            return [None]
+        middle = len(texts) // 2
+        logger.warning(
+            f"Embedding API rejected a batch of {len(texts)} texts ({e}). Splitting it into {middle} and {len(texts) - middle}."
+        )
+        return get_embeddings(texts[:middle]) + get_embeddings(texts[middle:])
+
+    if len(embeddings) != len(texts):
+        raise ValueError(
+            f"Embedding count mismatch! Model '{config.EMBEDDING_MODEL_NAME}' returned {len(embeddings)} embeddings for {len(texts)} texts."
+        )
+    for embedding in embeddings:
+        if embedding and len(embedding) != config.EMBEDDING_DIMENSIONS:
+            raise ValueError(
+                f"Embedding dimension mismatch! Model '{config.EMBEDDING_MODEL_NAME}' returned {len(embedding)} dims, expected {config.EMBEDDING_DIMENSIONS}."
+            )
+    return embeddings
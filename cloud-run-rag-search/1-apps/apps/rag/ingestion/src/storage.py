@@ -12,44 +12,296 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import logging
 import json
-from typing import Generator, Dict, Any, Optional
+import zlib
+from collections import deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Generator, Dict, Any, List, Optional
 from google.cloud import storage
 
+try:
+    import orjson
+except ImportError:  # Falls back to the standard library parser.
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+# Once past the end of its shard, a reader only needs the rest of the last
+# line, so it downloads small ranges one at a time.
+_TAIL_CHUNK_SIZE = 1024 * 1024
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _get_compression(blob: storage.Blob, compression: str) -> Optional[str]:
+    """
+    Returns the compression of the object: "gzip", "zstd" or None.
+    With "auto", it is detected from the Content-Encoding or the name suffix.
+    """
+    if compression != "auto":
+        return None if compression == "none" else compression
+    encoding = (blob.content_encoding or "").lower()
+    if encoding == "gzip" or blob.name.endswith(".gz"):
+        return "gzip"
+    if encoding == "zstd" or blob.name.endswith((".zst", ".zstd")):
+        return "zstd"
+    return None
+
+
+def _iter_chunks(blob: storage.Blob, start: int, prefetch_end: int,
+                 chunk_size: int,
+                 num_workers: int) -> Generator[bytes, None, None]:
+    """
+    Downloads the object from `start` in byte ranges and yields them in
+    order. Up to `num_workers` ranges of `chunk_size` bytes are downloaded
+    concurrently until `prefetch_end`, then small ranges one at a time
+    until the consumer stops or the object ends.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        next_start = start
+        try:
+            while pending or next_start < blob.size:
+                while next_start < blob.size:
+                    if next_start < prefetch_end:
+                        in_flight, size = num_workers, chunk_size
+                    else:
+                        in_flight, size = 1, _TAIL_CHUNK_SIZE
+                    if len(pending) >= in_flight:
+                        break
+                    end = min(next_start + size, blob.size)
+                    # raw_download returns the stored bytes: compressed
+                    # objects are not transcoded, so ranges stay valid.
+                    pending.append(
+                        executor.submit(blob.download_as_bytes,
+                                        start=next_start,
+                                        end=end - 1,
+                                        raw_download=True,
+                                        checksum=None))
+                    next_start = end
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _decompress(
+        chunks: Iterable[bytes],
+        new_decompressor: Callable[[], Any]) -> Generator[bytes, None, None]:
+    """
+    Decompresses a stream of chunks. A new decompressor is started at the
+    end of each frame, so concatenated gzip members or zstd frames work.
+    """
+    decompressor = new_decompressor()
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = new_decompressor()
+            else:
+                chunk = b""
+
 
-def stream_gcs_jsonl_file(bucket_name: str,
-                          blob_name: str,
-                          project_id: Optional[str] = None
-                          ) -> Generator[Dict[str, Any], None, None]:
+def _get_decompressor_factory(compression: str) -> Callable[[], Any]:
+    if compression == "gzip":
+        return lambda: zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(
+                "The zstandard package is required to read zstd sources."
+            ) from e
+        return lambda: zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unsupported compression: {compression}")
+
+
+def _iter_line_batches(
+    chunks: Iterable[bytes],
+    offset: int,
+    start: int = 0,
+    end: Optional[int] = None
+) -> Generator[tuple[int, List[bytes]], None, None]:
+    """
+    Splits a stream of chunks into lines, yielding the lines of each chunk
+    as one batch, with the position of its first line in the file.
+    `offset` is the position of the first chunk in the file.
+
+    Only the lines that start in [start, end) are yielded. If `offset` is
+    before `start`, the data up to the first newline belongs to a line of
+    the previous range, and is skipped.
+    """
+    pending = b""
+    pending_offset = offset
+    skip_first_line = offset < start
+    for chunk in chunks:
+        pending += chunk
+        last_newline = pending.rfind(b"\n")
+        if last_newline < 0:
+            continue
+        complete = pending[:last_newline + 1]
+        complete_offset = pending_offset
+        pending = pending[last_newline + 1:]
+        pending_offset += len(complete)
+
+        if skip_first_line:
+            first_newline = complete.find(b"\n")
+            complete_offset += first_newline + 1
+            complete = complete[first_newline + 1:]
+            skip_first_line = False
+        if end is not None and complete_offset >= end:
+            return
+        finished = False
+        if end is not None and complete_offset + len(complete) > end:
+            # Keep the lines starting before `end`, the last one included.
+            cut = complete.find(b"\n", end - complete_offset - 1)
+            complete = complete[:cut + 1]
+            finished = True
+        # `complete` ends with a newline: drop the empty string after it.
+        yield complete_offset, complete.split(b"\n")[:-1]
+        if finished:
+            return
+
+    if pending and not skip_first_line and (end is None
+                                            or pending_offset < end):
+        yield pending_offset, [pending]
+
+
+def _parse_json_lines_indexed(lines: List[bytes]) -> List[tuple[int, Any]]:
+    """
+    Parses a batch of JSON lines into (line index, record) pairs, skipping
+    blank and malformed lines.
+    """
+    indexes = [i for i, line in enumerate(lines) if line.strip()]
+    if not indexes:
+        return []
+    try:
+        records = _loads(b"[" + b",".join(lines[i] for i in indexes) + b"]")
+        # A malformed line such as `{...},{...}` would add records.
+        if len(records) == len(indexes):
+            return list(zip(indexes, records))
+    except ValueError:
+        pass
+    indexed_records = []
+    for i in indexes:
+        try:
+            indexed_records.append((i, _loads(lines[i])))
+        except ValueError:
+            logger.warning(
+                f"Skipping malformed JSON line: {lines[i].strip()!r}")
+    return indexed_records
+
+
+def parse_json_lines(lines: List[bytes]) -> List[Any]:
+    """
+    Parses a batch of JSON lines, skipping blank and malformed lines. The
+    batch is parsed as one JSON array, which is much faster than parsing
+    the lines one by one; if that fails, the lines are parsed one by one.
+    Uses orjson when it is installed.
+    """
+    return [record for _, record in _parse_json_lines_indexed(lines)]
+
+
+def stream_gcs_jsonl_file(
+    bucket_name: str,
+    blob_name: str,
+    project_id: Optional[str] = None,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    chunk_size: int = 16 * 1024 * 1024,
+    num_workers: int = 4,
+    compression: str = "auto",
+    resume_position: int = 0
+) -> Generator[tuple[int, Dict[str, Any]], None, None]:
     """
     Streams a JSONL file from GCS and yields each line as a parsed JSON object.
     This is memory-efficient for large files.
 
+    Each record comes with the position to resume from to read the records
+    after it: the byte offset of the next line, or for compressed files,
+    the number of lines read. Passing it as `resume_position` to the same
+    shard skips every line before it.
+
+    The object is downloaded in byte ranges of `chunk_size`, `num_workers`
+    at a time, ahead of the parser. Lines are parsed a chunk at a time.
+
+    The file can be split in `shard_count` contiguous byte ranges of similar
+    size, one per Cloud Run Job task. Each line is yielded by exactly one
+    shard: the one whose byte range contains the start of the line.
+    Compressed files (gzip or zstd) cannot be split: every shard reads the
+    whole file and keeps every `shard_count`-th line.
+
     Args:
         bucket_name (str): The name of the GCS bucket.
         blob_name (str): The name of the object (file) in GCS.
         project_id (str, optional): The GCP project ID. Defaults to None.
+        shard_index (int, optional): The shard to read. Defaults to 0.
+        shard_count (int, optional): The number of shards. Defaults to 1.
+        chunk_size (int, optional): The size of each downloaded range.
+        num_workers (int, optional): The number of concurrent downloads.
+        compression (str, optional): "auto", "none", "gzip" or "zstd".
+        resume_position (int, optional): A position yielded by a previous
+            read of the shard. Defaults to 0.
 
     Yields:
-        A dictionary parsed from a line in the JSONL file.
+        The resume position after the line and a dictionary parsed from the
+        line in the JSONL file.
     """
     try:
         storage_client = storage.Client(project=project_id)
         bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-
-        logger.info(f"Streaming file gs://{bucket_name}/{blob_name}...")
-        with blob.open("rt", encoding="utf-8") as f:
-            for line in f:
-                if line.strip():
-                    try:
-                        yield json.loads(line)
-                    except json.JSONDecodeError:
-                        logger.warning(
-                            f"Skipping malformed JSON line: {line.strip()}")
+        blob = bucket.get_blob(blob_name)
+        if blob is None:
+            raise FileNotFoundError(
+                f"Object gs://{bucket_name}/{blob_name} not found.")
+
+        num_workers = max(1, num_workers)
+        source_compression = _get_compression(blob, compression)
+        if source_compression:
+            logger.info(
+                f"Streaming {source_compression} file gs://{bucket_name}/{blob_name} (shard {shard_index} of {shard_count}, every {shard_count}th line from line {resume_position})..."
+            )
+            chunks = _decompress(
+                _iter_chunks(blob, 0, blob.size, chunk_size, num_workers),
+                _get_decompressor_factory(source_compression))
+            line_number = 0
+            for _, lines in _iter_line_batches(chunks, 0):
+                # Keep the lines of this shard that were not read yet.
+                first = max(0, resume_position - line_number)
+                first += (shard_index - line_number - first) % shard_count
+                indexes = range(first, len(lines), shard_count)
+                shard_lines = [lines[i] for i in indexes]
+                for i, record in _parse_json_lines_indexed(shard_lines):
+                    yield line_number + indexes[i] + 1, record
+                line_number += len(lines)
+            return
+
+        start = blob.size * shard_index // shard_count
+        end = blob.size * (shard_index + 1) // shard_count
+        # Resume positions are line starts within the shard.
+        start = max(start, resume_position)
+        logger.info(
+            f"Streaming file gs://{bucket_name}/{blob_name} (shard {shard_index} of {shard_count}, bytes {start}-{end} of {blob.size})..."
+        )
+        if start >= end:
+            return
+        # Start one byte early to find out whether `start` begins a line.
+        read_start = max(0, start - 1)
+        chunks = _iter_chunks(blob, read_start, end, chunk_size, num_workers)
+        for offset, lines in _iter_line_batches(chunks, read_start, start,
+                                                end):
+            # The position after each line is the start of the next one.
+            positions = list(
+                itertools.accumulate((len(line) + 1 for line in lines),
+                                     initial=offset))
+            for i, record in _parse_json_lines_indexed(lines):
+                yield positions[i + 1], record
     except Exception as e:
         logger.error(
             f"Failed to stream file 'gs://{bucket_name}/{blob_name}'. Error: {e}"
@@ -13,53 +13,185 @@
 # limitations under the License.
 
 import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
+
+import google.api_core.exceptions as exceptions
 from google.cloud.aiplatform import MatchingEngineIndex
 
+from src import config
+
 logger = logging.getLogger(__name__)
 
+# Quota errors (429) also shrink the batch size; server-side errors (5xx)
+# are retried as is.
+_QUOTA_ERRORS = (exceptions.TooManyRequests, )
+_RETRYABLE_ERRORS = (exceptions.TooManyRequests, exceptions.ServerError)
 
-def upsert_datapoints_to_index(
-    project: str,
-    location: str,
-    index_name: str,
-    datapoints: List[Dict[str, Any]],
-) -> None:
+
+class DatapointUpserter:
     """
-    Upserts a list of datapoints into a Vertex AI Vector Search index.
-    This method is suitable for streaming-enabled indexes.
-
-    Args:
-        project (str): The GCP project ID.
-        location (str): The region where the index is located.
-        index_name (str): The ID or full resource name of the Vector Search index.
-        datapoints (List[Dict[str, Any]]): A list of datapoint dictionaries.
-            Each dict must have 'datapoint_id' and 'feature_vector'.
+    Upserts datapoints into a streaming Vertex AI Vector Search index with
+    concurrent requests over a single index client.
+
+    Datapoints passed to `add` are buffered and sent in batches, with up to
+    VECTOR_SEARCH_UPSERT_CONCURRENCY requests in flight; `add` blocks while
+    they are all busy. The batch size adapts between its configured bounds:
+    it grows while requests are faster than the target latency, and
+    shrinks when they are slower or hit the quota.
+
+    Each batch is retried on its own. A batch the API rejects as invalid
+    is split in half to isolate the bad datapoints. Datapoints that still
+    fail are logged and counted in `failed`, and the run goes on.
     """
-    if not datapoints:
-        logger.warning("No datapoints provided to upsert.")
-        return
-
-    logger.info(
-        f"Sending {len(datapoints)} datapoints to be upserted into index '{index_name}'."
-    )
-    try:
-        # Initialize the MatchingEngineIndex object
-        index = MatchingEngineIndex(index_name=index_name,
-                                    project=project,
-                                    location=location)
-
-        # Call the method for streaming updates
-        index.upsert_datapoints(datapoints=datapoints)
-
-        logger.info(
-            f"Successfully sent {len(datapoints)} datapoints to index '{index_name}'."
-        )
-
-    except Exception as e:
-        logger.error(
-            f"Failed to upsert to Vector Search index '{index_name}'. Error: {e}"
-        )
-        # Depending on the desired behavior, you might want to retry or handle this error.
-        # For a batch job, raising the exception will cause the job to fail.
-        raise
+
+    def __init__(self, project: str, location: str, index_name: str):
+        """
+        Args:
+            project (str): The GCP project ID.
+            location (str): The region where the index is located.
+            index_name (str): The ID or full resource name of the Vector Search index.
+        """
+        self.index_name = index_name
+        self._index = MatchingEngineIndex(index_name=index_name,
+                                          project=project,
+                                          location=location)
+        concurrency = max(1, config.VECTOR_SEARCH_UPSERT_CONCURRENCY)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency,
+                                            thread_name_prefix="upsert")
+        self._concurrency = concurrency
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._pending: List[Dict[str, Any]] = []
+        self.min_batch_size = max(1,
+                                  config.VECTOR_SEARCH_UPSERT_MIN_BATCH_SIZE)
+        self.max_batch_size = max(self.min_batch_size,
+                                  config.VECTOR_SEARCH_UPSERT_MAX_BATCH_SIZE)
+        self.batch_size = self._clamp(config.VECTOR_SEARCH_UPSERT_BATCH_SIZE)
+        self.upserted = 0
+        self.failed = 0
+
+    def _clamp(self, batch_size: float) -> int:
+        return int(
+            min(self.max_batch_size, max(self.min_batch_size, batch_size)))
+
+    def add(self, datapoints: List[Dict[str, Any]]):
+        """Buffers datapoints, sending every full batch."""
+        self._pending.extend(datapoints)
+        while len(self._pending) >= self.batch_size:
+            batch_size = self.batch_size
+            self._submit(self._pending[:batch_size])
+            self._pending = self._pending[batch_size:]
+
+    def flush(self):
+        """
+        Sends the buffered datapoints and waits for every request in flight,
+        so that every datapoint added so far is upserted or counted failed.
+        """
+        self._send_pending()
+        # Holding every slot means that no request is in flight.
+        for _ in range(self._concurrency):
+            self._slots.acquire()
+        for _ in range(self._concurrency):
+            self._slots.release()
+
+    def close(self) -> int:
+        """
+        Sends the buffered datapoints, waits for every request to finish and
+        returns the number of datapoints upserted.
+        """
+        self._send_pending()
+        self._executor.shutdown(wait=True)
+        if self.failed:
+            logger.error(
+                f"{self.failed} datapoints could not be upserted into index '{self.index_name}'."
+            )
+        return self.upserted
+
+    def _send_pending(self):
+        while self._pending:
+            batch_size = self.batch_size
+            self._submit(self._pending[:batch_size])
+            self._pending = self._pending[batch_size:]
+
+    def _submit(self, batch: List[Dict[str, Any]]):
+        # Waits for a free slot, so the caller cannot run ahead of the API.
+        self._slots.acquire()
+        future = self._executor.submit(self._upsert_batch, batch)
+        future.add_done_callback(lambda _: self._slots.release())
+
+    def _adapt_batch_size(self, latency: float | None):
+        """Grows or shrinks the batch size after a request."""
+        with self._lock:
+            if latency is None:  # Quota error
+                new_size = self._clamp(self.batch_size // 2)
+            elif latency > config.VECTOR_SEARCH_UPSERT_TARGET_LATENCY_SECONDS:
+                new_size = self._clamp(self.batch_size * 3 // 4)
+            else:
+                new_size = self._clamp(self.batch_size * 5 // 4 + 1)
+            if new_size != self.batch_size:
+                logger.info(
+                    f"Upsert batch size {self.batch_size} -> {new_size}.")
+                self.batch_size = new_size
+
+    def _upsert_batch(self, batch: List[Dict[str, Any]]):
+        try:
+            self._upsert_with_retry(batch)
+        except exceptions.InvalidArgument as e:
+            if len(batch) == 1:
+                logger.error(
+                    f"Vector Search rejected datapoint '{batch[0].get('datapoint_id')}': {e}. Skipping it."
+                )
+                self._count_failed(1)
+                return
+            middle = len(batch) // 2
+            logger.warning(
+                f"Vector Search rejected a batch of {len(batch)} datapoints ({e}). Splitting it into {middle} and {len(batch) - middle}."
+            )
+            self._upsert_batch(batch[:middle])
+            self._upsert_batch(batch[middle:])
+        except Exception as e:
+            logger.error(
+                f"Failed to upsert a batch of {len(batch)} datapoints into index '{self.index_name}' (first ID: {batch[0].get('datapoint_id')}). Error: {e}"
+            )
+            self._count_failed(len(batch))
+
+    def _count_failed(self, count: int):
+        with self._lock:
+            self.failed += count
+
+    def _upsert_with_retry(self, batch: List[Dict[str, Any]]):
+        """Upserts a batch, retrying with jittered exponential backoff."""
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                self._index.upsert_datapoints(datapoints=batch)
+            except _RETRYABLE_ERRORS as e:
+                if isinstance(e, _QUOTA_ERRORS):
+                    self._adapt_batch_size(None)
+                attempt += 1
+                if attempt > config.VECTOR_SEARCH_UPSERT_MAX_RETRIES:
+                    raise
+                # Full jitter: sleep a random time up to the exponential backoff.
+                delay = random.uniform(
+                    0,
+                    min(
+                        config.VECTOR_SEARCH_UPSERT_RETRY_MAX_DELAY_SECONDS,
+                        config.VECTOR_SEARCH_UPSERT_RETRY_BASE_DELAY_SECONDS *
+                        2**attempt))
+                logger.warning(
+                    f"Upsert of {len(batch)} datapoints failed ({e}). Retry {attempt}/{config.VECTOR_SEARCH_UPSERT_MAX_RETRIES} in {delay:.1f}s."
+                )
+                time.sleep(delay)
+                continue
+            self._adapt_batch_size(time.monotonic() - started)
+            with self._lock:
+                self.upserted += len(batch)
+            logger.info(
+                f"Successfully sent {len(batch)} datapoints to index '{self.index_name}'."
+            )
+            return
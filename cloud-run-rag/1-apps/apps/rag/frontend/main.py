@@ -12,22 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import json
 import logging
 import os
 import sys
+from collections.abc import AsyncIterator
+from typing import NamedTuple
 
 from fastapi import FastAPI, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 
 import google.api_core.exceptions as exceptions
 from google import genai
 from google.genai import types
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import uvicorn
 
+from src import answer_cache
 from src import config
-from src.request_model import Prompt
+from src import embeddings
+from src.request_model import MetadataFilters, Prompt
 from src import db as database
 
 app = FastAPI(title=__name__)
@@ -70,7 +77,7 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     logging.info("Application shutdown...")
-    database.close_db_connection_pool()
+    await database.close_db_connection_pool()
 
 
 @app.get("/")
@@ -86,71 +93,19 @@ async def root():
         "generative_model_id": config.LLM_MODEL_NAME,
         "embedding_model_id": config.EMBEDDING_MODEL_NAME,
         "genai_client_status": client_status,
+        "embedding_cache": embeddings.get_cache_stats(),
+        "answer_cache": answer_cache.get_cache_stats(),
         "database_status": db_status,
     }
 
 
-@app.post("/predict")
-async def predict_route(request: Prompt,
-                        db: Session = Depends(database.get_db_session)):
-    """Endpoint to make a prediction using Vertex AI, augmented with context from Cloud SQL."""
-
-    if not genai_client:
-        logging.error("GenAI client not initialized.")
-        raise HTTPException(status_code=503,
-                            detail="GenAI client not available.")
-    if config.LLM_MODEL_NAME is None or MODEL_CONFIG is None:
-        logging.error("Vertex AI model or config not initialized.")
-        raise HTTPException(
-            status_code=500,
-            detail="Internal server error: Model or config not initialized.")
-
-    logging.info("Received prediction request with prompt: '%s...'",
-                 request.prompt[:100])
-
-    context_str = ""
-    augmented_prompt = request.prompt
-
-    if database.engine:
-        try:
-            logging.info(
-                f"Generating embedding for prompt using model: {config.EMBEDDING_MODEL_NAME}"
-            )
-            embedding_response = genai_client.models.embed_content(
-                model=config.EMBEDDING_MODEL_NAME,
-                contents=[request.prompt]).embeddings[0].values
-
-            logging.info(
-                f"Generated query embedding (first 3 dimensions): {embedding_response[:3]}..."
-            )
-
-            similar_docs = database.search_similar_documents(
-                db, embedding_response, config.RETRIEVER_TOP_K)
-
-            if similar_docs:
-                context_str = "\n\n".join(similar_docs)
-                augmented_prompt = (
-                    f"Based on the following context, answer the question.\n\n"
-                    f"Context:\n{context_str}\n\n"
-                    f"Question: {request.prompt}")
-                logging.info("Augmented prompt with context from database.")
-            else:
-                logging.info(
-                    "No relevant documents found in database, using original prompt."
-                )
-
-        except exceptions.GoogleAPIError as e:
-            logging.error(
-                f"Failed to generate embedding or search database: {e}",
-                exc_info=True)
-        except ConnectionError as e:
-            logging.error(f"Database connection error: {e}", exc_info=True)
-        except Exception as e:
-            logging.error(f"Unexpected error in RAG pipeline: {e}",
-                          exc_info=True)
-
+async def generate_prediction(augmented_prompt: str) -> tuple[str, bool]:
+    """
+    Calls the LLM with the (potentially augmented) prompt. Returns the
+    prediction text and whether it is a real answer worth caching.
+    """
     try:
-        response = genai_client.models.generate_content(
+        response = await genai_client.aio.models.generate_content(
             model=MODEL_NAME,
             contents=[augmented_prompt],
             config=MODEL_CONFIG,
@@ -169,30 +124,262 @@ async def predict_route(request: Prompt,
 
         if not prediction_text:
             logging.warning("Received an empty prediction from Vertex AI.")
-            prediction_text = "I could not generate a response based on the input."
+            return "I could not generate a response based on the input.", False
 
         logging.info(
             "Successfully received prediction from Vertex AI: %s...",
             prediction_text[:100],
         )
+        return prediction_text, True
 
     except exceptions.GoogleAPIError as e:
         logging.error(f"Vertex AI API call failed: {e}", exc_info=True)
-        prediction_text = f"Failed to get an answer from the model: {e}"
+        return f"Failed to get an answer from the model: {e}", False
     except Exception as e:
         logging.error(f"Unexpected error during model generation: {e}",
                       exc_info=True)
-        prediction_text = "An unexpected error occurred while trying to get an answer."
+        return "An unexpected error occurred while trying to get an answer.", False
+
+
+class RetrievedContext(NamedTuple):
+    """The outcome of the retrieval for a prompt."""
+    augmented_prompt: str
+    context: str
+    context_ids: list[str]
+    embedding: list[float] | None
+    # Why the prompt is answered without context, or None if it is not.
+    fallback_reason: str | None = None
+
+
+async def retrieve_context(
+        prompt: str,
+        db: AsyncSession,
+        filters: MetadataFilters | None = None) -> RetrievedContext:
+    """
+    Retrieves the documents most similar to the prompt from Cloud SQL,
+    among the documents that match the metadata filters.
+
+    Retrieval runs within a total latency budget (RETRIEVAL_TIMEOUT_SECONDS)
+    and each stage has its own timeout. If a stage fails or misses its
+    deadline, the prompt is answered without context and the fallback
+    reason says why.
+    """
+    if not database.engine:
+        return RetrievedContext(prompt, "", [], None, "not configured")
+
+    embedding_response = None
+    stage = "embedding"
+    try:
+        async with asyncio.timeout(config.RETRIEVAL_TIMEOUT_SECONDS):
+            logging.info(
+                f"Generating embedding for prompt using model: {config.EMBEDDING_MODEL_NAME}"
+            )
+            async with asyncio.timeout(config.EMBEDDING_TIMEOUT_SECONDS):
+                embedding_response = await embeddings.get_query_embedding(
+                    genai_client, prompt)
+
+            logging.info(
+                f"Generated query embedding (first 3 dimensions): {embedding_response[:3]}..."
+            )
 
+            # Cancelling the query makes asyncpg cancel it on the server too.
+            stage = "search"
+            async with asyncio.timeout(config.SEARCH_TIMEOUT_SECONDS):
+                similar_docs = await database.search_similar_documents(
+                    db, embedding_response, config.RETRIEVER_TOP_K, prompt,
+                    filters)
+
+    except TimeoutError:
+        logging.warning(
+            f"Retrieval timed out during {stage}, using original prompt.")
+        return RetrievedContext(prompt, "", [], embedding_response,
+                                f"{stage} timed out")
+    except exceptions.GoogleAPIError as e:
+        logging.error(f"Failed to generate embedding or search database: {e}",
+                      exc_info=True)
+        return RetrievedContext(prompt, "", [], embedding_response,
+                                f"{stage} failed")
+    except ConnectionError as e:
+        logging.error(f"Database connection error: {e}", exc_info=True)
+        return RetrievedContext(prompt, "", [], embedding_response,
+                                f"{stage} failed")
+    except Exception as e:
+        logging.error(f"Unexpected error in RAG pipeline: {e}", exc_info=True)
+        return RetrievedContext(prompt, "", [], embedding_response,
+                                f"{stage} failed")
+
+    if not similar_docs:
+        logging.info(
+            "No relevant documents found in database, using original prompt.")
+        return RetrievedContext(prompt, "", [], embedding_response,
+                                "no documents found")
+
+    context_ids = [doc_id for doc_id, _ in similar_docs]
+    context_str = "\n\n".join(doc for _, doc in similar_docs)
+    # Bump ANSWER_CACHE_PROMPT_VERSION when changing this template.
+    augmented_prompt = (
+        f"Based on the following context, answer the question.\n\n"
+        f"Context:\n{context_str}\n\n"
+        f"Question: {prompt}")
+    logging.info("Augmented prompt with context from database.")
+    return RetrievedContext(augmented_prompt, context_str, context_ids,
+                            embedding_response)
+
+
+def format_context(prompt: str, retrieved: RetrievedContext) -> dict:
+    """Describes the context a prompt is answered with, for responses."""
     return {
-        "prompt": request.prompt,
-        "augmented_prompt":
-        augmented_prompt if context_str else request.prompt,
-        "retrieved_context": context_str,
-        "prediction": prediction_text
+        "prompt": prompt,
+        "augmented_prompt": retrieved.augmented_prompt,
+        "retrieved_context": retrieved.context,
+        "context_fallback": retrieved.fallback_reason is not None,
+        "fallback_reason": retrieved.fallback_reason,
     }
 
 
+def format_sse_event(event: str, data: dict) -> str:
+    """Formats a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_prediction_events(
+        prompt: str, retrieved: RetrievedContext) -> AsyncIterator[str]:
+    """
+    Streams a prediction as Server-Sent Events: a `context` event with the
+    retrieved context first, then `token` events with the text deltas as
+    the model generates them, and a final `done` (or `error`) event.
+    """
+    context = format_context(prompt, retrieved)
+    context["context_ids"] = retrieved.context_ids
+    yield format_sse_event("context", context)
+    augmented_prompt = retrieved.augmented_prompt
+    embedding_response = retrieved.embedding
+
+    prediction_text = answer_cache.get_answer(embedding_response,
+                                              retrieved.context)
+    if prediction_text is not None:
+        yield format_sse_event("token", {"text": prediction_text})
+        yield format_sse_event("done", {
+            "prediction": prediction_text,
+            "cached": True
+        })
+        return
+
+    chunks = []
+    try:
+        async for chunk in await genai_client.aio.models.generate_content_stream(
+                model=MODEL_NAME,
+                contents=[augmented_prompt],
+                config=MODEL_CONFIG,
+        ):
+            if chunk.text:
+                chunks.append(chunk.text)
+                yield format_sse_event("token", {"text": chunk.text})
+    except exceptions.GoogleAPIError as e:
+        logging.error(f"Vertex AI API call failed: {e}", exc_info=True)
+        yield format_sse_event(
+            "error",
+            {"detail": f"Failed to get an answer from the model: {e}"})
+        return
+    except Exception as e:
+        logging.error(f"Unexpected error during model generation: {e}",
+                      exc_info=True)
+        yield format_sse_event(
+            "error", {
+                "detail":
+                "An unexpected error occurred while trying to get an answer."
+            })
+        return
+
+    prediction_text = "".join(chunks)
+    if prediction_text:
+        logging.info("Successfully streamed prediction from Vertex AI: %s...",
+                     prediction_text[:100])
+        answer_cache.set_answer(embedding_response, retrieved.context,
+                                prediction_text)
+    else:
+        logging.warning("Received an empty prediction from Vertex AI.")
+    yield format_sse_event("done", {
+        "prediction": prediction_text,
+        "cached": False
+    })
+
+
+@app.post("/predict")
+async def predict_route(request: Prompt,
+                        db: AsyncSession = Depends(database.get_db_session)):
+    """Endpoint to make a prediction using Vertex AI, augmented with context from Cloud SQL."""
+
+    if not genai_client:
+        logging.error("GenAI client not initialized.")
+        raise HTTPException(status_code=503,
+                            detail="GenAI client not available.")
+    if config.LLM_MODEL_NAME is None or MODEL_CONFIG is None:
+        logging.error("Vertex AI model or config not initialized.")
+        raise HTTPException(
+            status_code=500,
+            detail="Internal server error: Model or config not initialized.")
+
+    logging.info("Received prediction request with prompt: '%s...'",
+                 request.prompt[:100])
+
+    # With speculative generation, the prompt is answered without context
+    # while retrieval runs. The answer is used if retrieval falls back, and
+    # cancelled otherwise.
+    speculative_prediction = None
+    if config.SPECULATIVE_GENERATION:
+        speculative_prediction = asyncio.create_task(
+            generate_prediction(request.prompt))
+    try:
+        retrieved = await retrieve_context(request.prompt, db, request.filters)
+
+        prediction_text = answer_cache.get_answer(retrieved.embedding,
+                                                  retrieved.context)
+        if prediction_text is None:
+            if speculative_prediction and retrieved.fallback_reason:
+                logging.info("Using the speculative answer without context.")
+                prediction_text, _ = await speculative_prediction
+            else:
+                prediction_text, valid = await generate_prediction(
+                    retrieved.augmented_prompt)
+                if valid:
+                    answer_cache.set_answer(retrieved.embedding,
+                                            retrieved.context, prediction_text)
+    finally:
+        if speculative_prediction and not speculative_prediction.done():
+            speculative_prediction.cancel()
+
+    response = format_context(request.prompt, retrieved)
+    response["prediction"] = prediction_text
+    return response
+
+
+@app.post("/predict_stream")
+async def predict_stream_route(request: Prompt,
+                               db: AsyncSession = Depends(
+                                   database.get_db_session)):
+    """
+    Endpoint to stream a prediction from Vertex AI as Server-Sent Events,
+    augmented with context from Cloud SQL.
+    """
+
+    if not genai_client:
+        logging.error("GenAI client not initialized.")
+        raise HTTPException(status_code=503,
+                            detail="GenAI client not available.")
+
+    logging.info("Received streaming prediction request with prompt: '%s...'",
+                 request.prompt[:100])
+
+    # Retrieval completes before the response starts, so the context is
+    # always the first event.
+    retrieved = await retrieve_context(request.prompt, db, request.filters)
+    return StreamingResponse(stream_prediction_events(request.prompt,
+                                                      retrieved),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
 if __name__ == "__main__":
     server_port = int(os.environ.get("PORT", 8080))
     # uvicorn.run("main:app", host="0.0.0.0", port=server_port, log_level="info", reload=True) # For local dev
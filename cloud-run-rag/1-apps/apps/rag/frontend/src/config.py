@@ -30,14 +30,77 @@ EMBEDDING_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_NAME",
                                       "text-multilingual-embedding-002")
 EMBEDDING_TASK_TYPE = "RETRIEVAL_QUERY"
 
+# Cache Configuration
+EMBEDDING_CACHE_MAX_SIZE = int(
+    os.environ.get("EMBEDDING_CACHE_MAX_SIZE", 10000))
+EMBEDDING_CACHE_TTL_SECONDS = int(
+    os.environ.get("EMBEDDING_CACHE_TTL_SECONDS", 3600))
+# Optional Redis / Memorystore URL (e.g. redis://10.0.0.3:6379/0) to share
+# cache entries across instances. Caches are in-process only if unset.
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL")
+CACHE_REDIS_TIMEOUT_SECONDS = float(
+    os.environ.get("CACHE_REDIS_TIMEOUT_SECONDS", 0.2))
+# Semantic answer cache: a prediction is reused for a new prompt whose
+# embedding is at least this cosine-similar to an answered prompt with the
+# same retrieved context.
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED",
+                                      "true").lower() == "true"
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(
+    os.environ.get("ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.95))
+ANSWER_CACHE_MAX_SIZE = int(os.environ.get("ANSWER_CACHE_MAX_SIZE", 1000))
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", 600))
+# Part of the answer cache key, with the model and its generation settings.
+# Bump it when the prompt template changes, or to stop serving the answers
+# cached so far.
+ANSWER_CACHE_PROMPT_VERSION = os.environ.get("ANSWER_CACHE_PROMPT_VERSION",
+                                             "1")
+
 # DB configuration
 DB_HOST = os.environ.get("DB_HOST", "127.0.0.1")
 DB_PORT = int(os.environ.get("DB_PORT", 5432))
 DB_NAME = os.environ.get("DB_NAME")
 DB_SA = os.environ.get("DB_SA")
 DB_TABLE = os.environ.get("DB_TABLE", "movie_embeddings")
+DB_COLUMN_ID = os.environ.get("DB_COLUMN_ID", "id")
 DB_COLUMN_TEXT = os.environ.get("DB_COLUMN_TEXT", "content_to_embed")
 DB_COLUMN_EMBEDDING = os.environ.get("DB_COLUMN_EMBEDDING", "embedding")
+DB_COLUMN_SEARCH_VECTOR = os.environ.get("DB_COLUMN_SEARCH_VECTOR",
+                                         "search_vector")
+# Metadata columns used by the request filters
+DB_COLUMN_GENRE = os.environ.get("DB_COLUMN_GENRE", "genre")
+DB_COLUMN_RANK = os.environ.get("DB_COLUMN_RANK", "rank")
+DB_COLUMN_RATING = os.environ.get("DB_COLUMN_RATING", "rating")
+DB_COLUMN_YEAR = os.environ.get("DB_COLUMN_YEAR", "year")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_POOL_MAX_OVERFLOW = int(os.environ.get("DB_POOL_MAX_OVERFLOW", 5))
 
 # Retriever Configuration
 RETRIEVER_TOP_K = int(os.environ.get("RETRIEVER_TOP_K", 10))
+# "vector" ranks by embedding distance only. "hybrid" also runs a full-text
+# search on the ingestion's search_vector column and merges both candidate
+# lists with reciprocal rank fusion, which finds exact titles and years.
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "vector").lower()
+# Candidates fetched by each side of a hybrid search before fusion
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", 40))
+# Reciprocal rank fusion constant: higher values flatten the rank weights
+RRF_K = int(os.environ.get("RRF_K", 60))
+# Must match the ingestion's TEXT_SEARCH_CONFIG
+TEXT_SEARCH_CONFIG = os.environ.get("TEXT_SEARCH_CONFIG", "english")
+# Latency budget for the whole retrieval, and timeouts of its stages. A
+# prompt is answered without context when retrieval misses its deadline.
+RETRIEVAL_TIMEOUT_SECONDS = float(
+    os.environ.get("RETRIEVAL_TIMEOUT_SECONDS", 2))
+EMBEDDING_TIMEOUT_SECONDS = float(
+    os.environ.get("EMBEDDING_TIMEOUT_SECONDS", 1))
+SEARCH_TIMEOUT_SECONDS = float(os.environ.get("SEARCH_TIMEOUT_SECONDS", 1))
+# Answer the prompt without context while retrieval runs, and use that
+# answer if retrieval falls back. Costs an extra LLM call per request.
+SPECULATIVE_GENERATION = os.environ.get("SPECULATIVE_GENERATION",
+                                        "false").lower() == "true"
+# ANN index search settings, applied per query (higher = better recall, slower)
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", 40))
+IVFFLAT_PROBES = int(os.environ.get("IVFFLAT_PROBES", 10))
+# HNSW iterative scan used by filtered queries (pgvector 0.8+):
+# "strict_order", "relaxed_order", or "off" for older pgvector versions
+VECTOR_ITERATIVE_SCAN = os.environ.get("VECTOR_ITERATIVE_SCAN",
+                                       "strict_order").lower()
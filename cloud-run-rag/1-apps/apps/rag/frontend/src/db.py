@@ -14,13 +14,16 @@
 
 import logging
 import sys
+from collections.abc import AsyncIterator
 
 import sqlalchemy
-from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy import text
+from sqlalchemy.ext.asyncio import (AsyncEngine, AsyncSession,
+                                    async_sessionmaker, create_async_engine)
 
 from google.cloud.sql.connector import Connector, IPTypes
 from src import config
+from src.request_model import MetadataFilters
 
 # Configure logging
 logging.basicConfig(
@@ -30,13 +33,14 @@ logging.basicConfig(
 
 # Global connector and engine to be initialized at startup
 connector: Connector = None
-engine: sqlalchemy.engine.Engine = None
+engine: AsyncEngine = None
+session_factory: async_sessionmaker[AsyncSession] = None
 
 
 def init_db_connection_pool():
     """Initializes the Cloud SQL (PostgreSQL) connector
-    and SQLAlchemy engine using IAM authentication."""
-    global connector, engine
+    and the async SQLAlchemy engine (asyncpg) using IAM authentication."""
+    global connector, engine, session_factory
     if not all([config.DB_HOST, config.DB_NAME, config.DB_PORT, config.DB_SA]):
         logging.warning(
             "Database configuration (DB_HOST, DB_NAME, DB_PORT, DB_SA) "
@@ -45,16 +49,19 @@ def init_db_connection_pool():
     try:
         connector = Connector()
         db_url = sqlalchemy.engine.url.URL.create(
-            drivername="postgresql+pg8000",
+            drivername="postgresql+asyncpg",
             host=config.DB_HOST,
             port=config.DB_PORT,
             username=config.DB_SA,
             database=config.DB_NAME)
-        engine = sqlalchemy.create_engine(db_url,
-                                          pool_size=5,
-                                          max_overflow=2,
-                                          pool_timeout=30,
-                                          pool_recycle=1800)
+        engine = create_async_engine(db_url,
+                                     pool_size=config.DB_POOL_SIZE,
+                                     max_overflow=config.DB_POOL_MAX_OVERFLOW,
+                                     pool_timeout=30,
+                                     pool_recycle=1800)
+        session_factory = async_sessionmaker(engine,
+                                             autoflush=False,
+                                             expire_on_commit=False)
         logging.info("Database connection pool initialized successfully.")
     except Exception as e:
         logging.error(f"Failed to initialize database connection pool: {e}",
@@ -62,27 +69,119 @@ def init_db_connection_pool():
         engine = None  # Ensure engine is None if init fails
 
 
-def get_db_session() -> Session:
-    """Dependency to get a database session."""
+async def get_db_session() -> AsyncIterator[AsyncSession]:
+    """Dependency to get an async database session."""
     if not engine:
         # Raise an error or handle as appropriate
         # if the DB connection is critical
         logging.error(
             "Database engine not initialized. Cannot provide DB session.")
         raise ConnectionError("Database engine not initialized.")
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db = SessionLocal()
-    try:
+    async with session_factory() as db:
         yield db
-    finally:
-        db.close()
 
 
-def search_similar_documents(db: Session, embedding: list[float],
-                             top_k: int) -> list[str]:
+def _escape_like(value: str) -> str:
+    """Escapes the wildcards of a LIKE pattern."""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _build_filter_clause(filters: MetadataFilters | None) -> tuple[str, dict]:
+    """
+    Builds the SQL condition of the metadata filters and its parameters.
+    The condition is "TRUE" when there is nothing to filter on.
+    """
+    if filters is None:
+        return "TRUE", {}
+    conditions = []
+    params = {}
+    if filters.genres:
+        # The genre column holds the list of genres as text.
+        conditions.append(
+            f'"{config.DB_COLUMN_GENRE}" ILIKE ANY(CAST(:genre_patterns AS text[]))'
+        )
+        params["genre_patterns"] = [
+            f"%{_escape_like(genre)}%" for genre in filters.genres
+        ]
+    for name, column in (("rank", config.DB_COLUMN_RANK),
+                         ("rating", config.DB_COLUMN_RATING),
+                         ("year", config.DB_COLUMN_YEAR)):
+        minimum = getattr(filters, f"min_{name}")
+        maximum = getattr(filters, f"max_{name}")
+        if minimum is not None:
+            conditions.append(f'"{column}" >= :min_{name}')
+            params[f"min_{name}"] = minimum
+        if maximum is not None:
+            conditions.append(f'"{column}" <= :max_{name}')
+            params[f"max_{name}"] = maximum
+    if not conditions:
+        return "TRUE", {}
+    return " AND ".join(conditions), params
+
+
+def _build_hybrid_search_query(filter_sql: str) -> sqlalchemy.TextClause:
+    """
+    Builds a query that ranks vector and lexical candidates separately and
+    merges them with reciprocal rank fusion: each document scores
+    1 / (RRF_K + rank) per candidate list it appears in.
+
+    The lexical query ORs the lexemes of the prompt, so a document matching
+    a title or a year ranks high without having to match every word.
+    """
+    table = f'"{config.DB_TABLE}"'
+    id_column = f'"{config.DB_COLUMN_ID}"'
+    distance = f'"{config.DB_COLUMN_EMBEDDING}" <=> CAST(CAST(:embedding AS text) AS vector)'
+    lexical_rank = f'ts_rank_cd("{config.DB_COLUMN_SEARCH_VECTOR}", keyword_query.query)'
+    return text(f"""
+        WITH vector_matches AS (
+            SELECT {id_column} AS id, RANK() OVER (ORDER BY {distance}) AS rank
+            FROM {table}
+            WHERE {filter_sql}
+            ORDER BY {distance}
+            LIMIT :candidates
+        ),
+        keyword_query AS (
+            SELECT CAST(string_agg(quote_literal(replace(lexeme, '\\', '')), ' | ') AS tsquery) AS query
+            FROM unnest(to_tsvector(CAST(:text_search_config AS regconfig), :query_text))
+        ),
+        keyword_matches AS (
+            SELECT {id_column} AS id, RANK() OVER (ORDER BY {lexical_rank} DESC) AS rank
+            FROM {table}, keyword_query
+            WHERE "{config.DB_COLUMN_SEARCH_VECTOR}" @@ keyword_query.query
+            AND {filter_sql}
+            ORDER BY {lexical_rank} DESC
+            LIMIT :candidates
+        ),
+        fused_matches AS (
+            SELECT COALESCE(vector_matches.id, keyword_matches.id) AS id,
+                   COALESCE(1.0 / (:rrf_k + vector_matches.rank), 0.0)
+                   + COALESCE(1.0 / (:rrf_k + keyword_matches.rank), 0.0) AS score
+            FROM vector_matches
+            FULL OUTER JOIN keyword_matches ON vector_matches.id = keyword_matches.id
+        )
+        SELECT {table}.{id_column}, {table}."{config.DB_COLUMN_TEXT}"
+        FROM fused_matches
+        JOIN {table} ON {table}.{id_column} = fused_matches.id
+        ORDER BY fused_matches.score DESC
+        LIMIT :top_k
+        """)
+
+
+async def search_similar_documents(
+        db: AsyncSession,
+        embedding: list[float],
+        top_k: int,
+        query_text: str | None = None,
+        filters: MetadataFilters | None = None) -> list[tuple[str, str]]:
     """
     Searches for documents with embeddings similar to
     the query_embedding in PostgreSQL using pgvector.
+    With RETRIEVAL_MODE=hybrid and a query_text, the vector candidates are
+    fused with full-text search candidates in the same query.
+    Metadata filters are applied in the WHERE clause, so the ANN index scan
+    keeps going until it finds top_k matching rows.
+    Returns (id, text) pairs, most similar first. Raises on database
+    errors.
     """
     if not engine:
         logging.warning("Database not configured. Skipping document search.")
@@ -90,40 +189,74 @@ def search_similar_documents(db: Session, embedding: list[float],
 
     try:
         embedding_str = str(embedding)
+        hybrid = config.RETRIEVAL_MODE == "hybrid" and bool(query_text)
+        # The vector side of a hybrid query fetches more candidates than top_k.
+        candidates = max(top_k, config.HYBRID_CANDIDATES) if hybrid else top_k
+        filter_sql, filter_params = _build_filter_clause(filters)
+
+        # Tune the ANN index scan for this transaction only. ef_search below
+        # top_k would return fewer than top_k rows.
+        await db.execute(
+            text("SELECT set_config('hnsw.ef_search', :ef_search, true), "
+                 "set_config('ivfflat.probes', :probes, true)"), {
+                     "ef_search": str(max(config.HNSW_EF_SEARCH, candidates)),
+                     "probes": str(config.IVFFLAT_PROBES)
+                 })
+        if filter_params and config.VECTOR_ITERATIVE_SCAN != "off":
+            # Without an iterative scan (pgvector 0.8+), the index returns
+            # ef_search candidates and the filter may leave fewer than top_k.
+            # IVFFlat only supports relaxed ordering.
+            await db.execute(
+                text(
+                    "SELECT set_config('hnsw.iterative_scan', :hnsw, true), "
+                    "set_config('ivfflat.iterative_scan', 'relaxed_order', true)"
+                ), {"hnsw": config.VECTOR_ITERATIVE_SCAN})
 
         # Using <=> for cosine distance (pgvector specific).
         # Lower distance = more similar.
-        query = text(f"""
-            SELECT "{config.DB_COLUMN_TEXT}"
-            FROM "{config.DB_TABLE}"
-            ORDER BY "{config.DB_COLUMN_EMBEDDING}" <=> :embedding
-            LIMIT :top_k
-            """)
-
-        result = db.execute(query, {
-            "embedding": embedding_str,
-            "top_k": top_k
-        })
-        documents = [row[0] for row in result.fetchall()]
+        # asyncpg has no codec for the vector type: bind the embedding as text.
+        if hybrid:
+            result = await db.execute(
+                _build_hybrid_search_query(filter_sql), {
+                    "embedding": embedding_str,
+                    "query_text": query_text,
+                    "text_search_config": config.TEXT_SEARCH_CONFIG,
+                    "candidates": candidates,
+                    "rrf_k": config.RRF_K,
+                    "top_k": top_k,
+                    **filter_params
+                })
+        else:
+            query = text(f"""
+                SELECT "{config.DB_COLUMN_ID}", "{config.DB_COLUMN_TEXT}"
+                FROM "{config.DB_TABLE}"
+                WHERE {filter_sql}
+                ORDER BY "{config.DB_COLUMN_EMBEDDING}" <=> CAST(CAST(:embedding AS text) AS vector)
+                LIMIT :top_k
+                """)
+            result = await db.execute(query, {
+                "embedding": embedding_str,
+                "top_k": top_k,
+                **filter_params
+            })
+        documents = [(str(row[0]), row[1]) for row in result.fetchall()]
         logging.info(f"Retrieved {len(documents)} similar documents from DB.")
         return documents
     except sqlalchemy.exc.SQLAlchemyError as e:
-        logging.error(f"Database error during similarity search: {e}",
-                      exc_info=True)
-        return []
-    except Exception as e:
-        logging.error(f"Unexpected error during similarity search: {e}",
-                      exc_info=True)
-        return []
+        # Raised rather than returning no documents, so that a failed search
+        # is not reported as an empty one.
+        logging.error(f"Database error during similarity search: {e}")
+        raise
 
 
-def close_db_connection_pool():
+async def close_db_connection_pool():
     """Closes the Cloud SQL connector and disposes the SQLAlchemy engine."""
-    global connector, engine
+    global connector, engine, session_factory
     if engine:
-        engine.dispose()
+        await engine.dispose()
         logging.info("Database connection pool disposed.")
         engine = None
+        session_factory = None
     if connector:
         connector.close()
         logging.info("Cloud SQL connector closed.")
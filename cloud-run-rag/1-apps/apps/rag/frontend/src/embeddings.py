@@ -0,0 +1,126 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import hashlib
+import logging
+import sys
+
+from google import genai
+
+from src import cache
+from src import config
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(name)s - %(levelname)s - %(message)s',
+                    handlers=[logging.StreamHandler(sys.stdout)])
+
+_REDIS_KEY_PREFIX = "query-embedding:"
+# Maximum number of texts in a single embedding request.
+_MAX_TEXTS_PER_REQUEST = 250
+
+_embedding_cache = cache.TTLCache(
+    max_size=config.EMBEDDING_CACHE_MAX_SIZE,
+    ttl_seconds=config.EMBEDDING_CACHE_TTL_SECONDS)
+_shared_hits = 0
+
+
+def _normalize_prompt(prompt: str) -> str:
+    """Normalizes case and whitespace so that trivial variants share a key."""
+    return " ".join(prompt.split()).lower()
+
+
+def _cache_key(prompt: str) -> str:
+    """Builds the cache key from the embedding model and normalized prompt."""
+    return hashlib.sha256(
+        f"{config.EMBEDDING_MODEL_NAME}\n{_normalize_prompt(prompt)}".encode(
+            "utf-8")).hexdigest()
+
+
+async def get_query_embedding(genai_client: genai.Client,
+                              prompt: str) -> list[float]:
+    """
+    Returns the embedding of a prompt, from the in-process cache, the shared
+    Redis cache (if configured) or the embedding model, in this order.
+    """
+    return (await get_query_embeddings(genai_client, [prompt]))[0]
+
+
+async def get_query_embeddings(genai_client: genai.Client,
+                               prompts: list[str]) -> list[list[float]]:
+    """
+    Returns the embeddings of several prompts, in input order. Prompts
+    missing from the caches are embedded together, in as few embedding
+    requests as possible.
+    """
+    global _shared_hits
+    keys = [_cache_key(prompt) for prompt in prompts]
+    results: list[list[float]
+                  | None] = [_embedding_cache.get(key) for key in keys]
+    missing = [i for i, embedding in enumerate(results) if embedding is None]
+
+    redis_client = cache.get_redis_client()
+    if missing and redis_client is not None:
+        try:
+            values = await redis_client.mget(
+                [_REDIS_KEY_PREFIX + keys[i] for i in missing])
+            for i, value in zip(missing, values):
+                if value is not None:
+                    results[i] = array.array("d", value).tolist()
+                    _embedding_cache.set(keys[i], results[i])
+                    _shared_hits += 1
+            missing = [i for i in missing if results[i] is None]
+        except Exception as e:
+            logging.warning(f"Shared embedding cache lookup failed: {e}")
+
+    # Identical prompts in the batch are embedded once.
+    unique_keys = list(dict.fromkeys(keys[i] for i in missing))
+    texts = {keys[i]: prompts[i] for i in missing}
+    computed: dict[str, list[float]] = {}
+    for start in range(0, len(unique_keys), _MAX_TEXTS_PER_REQUEST):
+        chunk = unique_keys[start:start + _MAX_TEXTS_PER_REQUEST]
+        response = await genai_client.aio.models.embed_content(
+            model=config.EMBEDDING_MODEL_NAME,
+            contents=[texts[key] for key in chunk])
+        embeddings = response.embeddings or []
+        if len(embeddings) != len(chunk):
+            raise ValueError(
+                f"Embedding count mismatch! Model '{config.EMBEDDING_MODEL_NAME}' returned {len(embeddings)} embeddings for {len(chunk)} prompts."
+            )
+        for key, embedding in zip(chunk, embeddings):
+            computed[key] = embedding.values
+            _embedding_cache.set(key, embedding.values)
+    for i in missing:
+        results[i] = computed[keys[i]]
+
+    if computed and redis_client is not None:
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for key, embedding in computed.items():
+                    pipe.set(_REDIS_KEY_PREFIX + key,
+                             array.array("d", embedding).tobytes(),
+                             ex=int(config.EMBEDDING_CACHE_TTL_SECONDS))
+                await pipe.execute()
+        except Exception as e:
+            logging.warning(f"Shared embedding cache update failed: {e}")
+    return results
+
+
+def get_cache_stats() -> dict:
+    """Returns the embedding cache counters for the status endpoint."""
+    stats = _embedding_cache.stats()
+    stats["shared_backend"] = "redis" if cache.get_redis_client() else "none"
+    stats["shared_hits"] = _shared_hits
+    return stats
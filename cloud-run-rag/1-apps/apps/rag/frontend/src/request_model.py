@@ -12,9 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import Annotated
+
 from pydantic import BaseModel, Field
 
 
+class MetadataFilters(BaseModel):
+    """
+    Optional filters on the document metadata. Only the documents that match
+    every given filter are ranked; bounds are inclusive.
+    """
+
+    genres: list[Annotated[str, Field(min_length=1)]] | None = Field(
+        default=None,
+        description="Only documents with at least one of these genres.",
+        min_length=1,
+    )
+    min_rank: int | None = None
+    max_rank: int | None = None
+    min_rating: float | None = None
+    max_rating: float | None = None
+    min_year: int | None = None
+    max_year: int | None = None
+
+
 class Prompt(BaseModel):
     """
     Represents the request body for the prediction endpoint.
@@ -28,3 +49,8 @@ class Prompt(BaseModel):
         "The text prompt to send to the generative model for a response.",
         min_length=1,
     )
+    filters: MetadataFilters | None = Field(
+        default=None,
+        title="Metadata Filters",
+        description="Restricts the retrieved context to matching documents.",
+    )
@@ -12,16 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import os
 import logging
 import sys
 
+import google.api_core.exceptions as exceptions
 from google.cloud import bigquery
-from vertexai.language_models import TextEmbeddingModel
+from google.cloud import bigquery_storage
 from google.cloud import aiplatform  # For aiplatform.init()
 
+from src import checkpoint
 from src import config
 from src import db as database
+from src import embeddings
+from src import pipeline
+from src import record_batches
 
 try:
     BQ_TEXT_COLUMNS = [
@@ -51,12 +57,29 @@ try:
         )
         sys.exit(1)
 
+    BQ_KEY_COLUMNS = [
+        col.strip() for col in config.BQ_KEY_COLUMNS_STR.split(',')
+        if col.strip()
+    ]
+    if config.ID_STRATEGY not in ("row_number", "natural_key", "fingerprint"):
+        raise ValueError(f"Invalid ID_STRATEGY: {config.ID_STRATEGY}")
+    if config.ID_STRATEGY == "natural_key" and len(BQ_KEY_COLUMNS) != 1:
+        raise ValueError(
+            "ID_STRATEGY 'natural_key' requires exactly one BQ_KEY_COLUMNS column"
+        )
+    # A fingerprint of the content would give an edited row a new ID, and
+    # its previous version would never be deleted.
+    if config.ID_STRATEGY == "fingerprint" and not BQ_KEY_COLUMNS:
+        raise ValueError(
+            "ID_STRATEGY 'fingerprint' requires the BQ_KEY_COLUMNS identifying a row"
+        )
+
 except KeyError as e:
     logging.error(f"Missing required environment variable: {e}")
     sys.exit(1)
 except ValueError as e:
     logging.error(
-        f"Error parsing numeric environment variable (e.g., DB_PORT, BATCH_SIZE_*, EMBEDDING_DIMENSIONS): {e}"
+        f"Error parsing environment variable (e.g., DB_PORT, BATCH_SIZE_*, EMBEDDING_DIMENSIONS, ID_STRATEGY): {e}"
     )
     sys.exit(1)
 
@@ -74,6 +97,17 @@ except Exception as e:
     logger.error(f"Error initializing BigQuery client: {e}")
     sys.exit(1)
 
+# Without a BigQuery Storage client, results are read with REST paging.
+bqstorage_client = None
+if config.BQ_USE_STORAGE_API:
+    try:
+        bqstorage_client = bigquery_storage.BigQueryReadClient()
+        logger.info("BigQuery Storage client initialized.")
+    except Exception as e:
+        logger.warning(
+            f"Error initializing BigQuery Storage client, falling back to REST paging: {e}"
+        )
+
 try:
     aiplatform.init(project=config.PROJECT_ID, location=config.REGION)
     logger.info(
@@ -83,62 +117,366 @@ except Exception as e:
     logger.error(f"Error initializing Vertex AI SDK: {e}")
     sys.exit(1)
 
+# How metadata columns are cast for the discrete SQL columns; other
+# columns are stored as text.
+METADATA_CASTS = {"rank": int, "rating": float, "year": int}
 
-def format_bq_value_for_embedding(value) -> str:
+
+def compute_content_hash(text_to_embed: str) -> str:
     """
-    Formats a BigQuery value for inclusion in
-    the 'content_to_embed' string.
+    Hashes the text to embed together with the embedding model name,
+    so that switching models invalidates every stored embedding.
     """
-    if value is None:
-        return "None"  # Represent SQL NULL as the string "None"
-    if isinstance(value, list):  # For ARRAY types from BigQuery
-        return ",".join(str(v_item).strip() for v_item in value)
-    if isinstance(value, bool):
-        return str(value)  # "True" or "False"
-    return str(value).strip()
-
-
-def safe_cast(value, cast_type, default=None):
-    """Safely casts a value to a type, returning default on failure."""
-    if value is None:
-        return default
-    try:
-        return cast_type(value)
-    except (ValueError, TypeError):
-        logger.warning(
-            f"Could not cast '{value}' to {cast_type}. Using default: {default}"
-        )
-        return default
+    return hashlib.sha256(
+        f"{config.EMBEDDING_MODEL_NAME}\n{text_to_embed}".encode(
+            "utf-8")).hexdigest()
 
 
-def get_embeddings_batch_vertexai(texts: list[str],
-                                  model_id_name: str) -> list[list[float]]:
-    """Gets embeddings for a batch of texts using Vertex AI TextEmbeddingModel."""
-    if not texts:
-        return []
-    try:
-        model = TextEmbeddingModel.from_pretrained(model_id_name)
-        response = model.get_embeddings(
-            texts)  # Max batch size is 250 for many models
-        embeddings_values = [embedding.values for embedding in response]
+def prepare_record_batch(record_batch,
+                         first_row_number: int) -> list[tuple[int, dict]]:
+    """
+    Builds the items to embed from an Arrow record batch of BigQuery rows:
+    their ID, the 'content_to_embed' string and the metadata for the
+    discrete SQL columns. The strings and metadata are built column by
+    column with Arrow kernels rather than row by row.
 
-        if not embeddings_values:
+    Returns (row number, item) pairs. Rows without an ID are skipped.
+    """
+    ids = record_batch.column(config.GENERATED_ID_COLUMN_NAME).to_pylist()
+    texts = record_batches.build_content_column(
+        record_batch, ALL_BQ_COLUMNS_TO_FETCH).to_pylist()
+    metadata_columns = [
+        record_batches.cast_metadata_column(record_batch.column(col),
+                                            METADATA_CASTS.get(col, str))
+        for col in TARGET_BQ_COLUMNS
+    ]
+
+    items = []
+    for i, (item_id, text, metadata_values) in enumerate(
+            zip(ids, texts, zip(*metadata_columns))):
+        if item_id is None:
             logger.warning(
-                f"Received empty embeddings list from Vertex AI model '{model_id_name}'."
+                f"Skipping BQ row number {first_row_number + i}: generated ID '{config.GENERATED_ID_COLUMN_NAME}' is null."
+            )
+            continue
+        items.append((first_row_number + i, {
+            "id": str(item_id),
+            "text_to_embed": text,
+            "content_hash": compute_content_hash(text),
+            "metadata": dict(zip(TARGET_BQ_COLUMNS, metadata_values)),
+            "embedding": None
+        }))
+    return items
+
+
+def iter_embedding_batches(arrow_batches, progress: dict, skip_rows: int = 0):
+    """
+    Turns Arrow record batches of BigQuery rows into batches of
+    EMBEDDING_BATCH_SIZE items, skipping the first `skip_rows` rows.
+    The number of rows read (or skipped) so far is kept in
+    progress["bq_rows"], and
+    the number of rows read up to the last item of each batch is appended
+    to progress["batch_end_rows"] before the batch is yielded.
+    """
+    log_interval = config.BQ_BATCH_SIZE * 2
+    batch = []
+    for record_batch in arrow_batches:
+        if skip_rows:
+            skipped = min(skip_rows, record_batch.num_rows)
+            record_batch = record_batch.slice(skipped)
+            skip_rows -= skipped
+            progress["bq_rows"] += skipped
+        if not record_batch.num_rows:
+            continue
+        rows_read = progress["bq_rows"]
+        items = prepare_record_batch(record_batch, rows_read + 1)
+        progress["bq_rows"] += record_batch.num_rows
+        for row_number, item in items:
+            batch.append(item)
+            if len(batch) >= config.EMBEDDING_BATCH_SIZE:
+                progress["batch_end_rows"].append(row_number)
+                yield batch
+                batch = []
+
+        if progress["bq_rows"] // log_interval > rows_read // log_interval:
+            logger.info(f"Read {progress['bq_rows']} BQ rows.")
+
+    # Flush any remaining items in the last batch
+    if batch:
+        progress["batch_end_rows"].append(progress["bq_rows"])
+        yield batch
+
+
+def embed_batch(batch: list[dict]) -> list[dict]:
+    """
+    Attaches embeddings to the items of a batch.
+    Items the embedding API rejects are dropped from the returned batch, and
+    so are unchanged items when incremental indexing is enabled.
+    """
+    if config.INCREMENTAL_INDEXING:
+        stored_hashes = database.get_content_hashes(
+            [item["id"] for item in batch])
+        changed_batch = [
+            item for item in batch
+            if stored_hashes.get(item["id"]) != item["content_hash"]
+        ]
+        if len(changed_batch) < len(batch):
+            logger.info(
+                f"Skipping {len(batch) - len(changed_batch)} unchanged rows of batch (first ID {batch[0]['id']})."
             )
+        if not changed_batch:
             return []
-        if embeddings_values[0] and len(
-                embeddings_values[0]) != config.EMBEDDING_DIMENSIONS:
+        batch = changed_batch
+
+    texts_for_api = [item["text_to_embed"] for item in batch]
+    logger.info(
+        f"Requesting embeddings for batch of {len(texts_for_api)} texts (first ID {batch[0]['id']})..."
+    )
+    embeddings_list_result = embeddings.get_embeddings(texts_for_api)
+
+    embedded_batch = []
+    for item, embedding in zip(batch, embeddings_list_result):
+        if embedding is None:
             logger.error(
-                f"Embedding dimension mismatch! Model '{model_id_name}' returned {len(embeddings_values[0])} dims, expected {config.EMBEDDING_DIMENSIONS}. Exiting."
-            )
-            sys.exit(1)
-        return embeddings_values
-    except Exception as e:
+                f"No embedding for ID {item['id']}. Skipping DB insert.")
+            continue
+        item["embedding"] = embedding
+        embedded_batch.append(item)
+    return embedded_batch
+
+
+def build_id_expression() -> str:
+    """Returns the BigQuery expression computing the ID of a row for ID_STRATEGY."""
+    if config.ID_STRATEGY == "natural_key":
+        # validate_natural_key_column() checks that it is an INT64 column.
+        return f"`{BQ_KEY_COLUMNS[0]}`"
+    key_cols_str = ", ".join([f"`{col}`" for col in BQ_KEY_COLUMNS])
+    return f"FARM_FINGERPRINT(TO_JSON_STRING(STRUCT({key_cols_str})))"
+
+
+def validate_natural_key_column():
+    """
+    Exits if the BQ_KEY_COLUMNS column of ID_STRATEGY "natural_key" is not
+    an INT64 column of the source table: other values cannot be used as
+    IDs as they are, and casting them would drop or merge rows.
+    """
+    key_column = BQ_KEY_COLUMNS[0]
+    table = bq_client.get_table(
+        f"{config.PROJECT_ID}.{config.BQ_DATASET}.{config.BQ_TABLE}")
+    field = next((f for f in table.schema if f.name == key_column), None)
+    if field is None:
+        logger.error(
+            f"Key column '{key_column}' not found in {config.BQ_DATASET}.{config.BQ_TABLE}."
+        )
+        sys.exit(1)
+    is_int64 = (field.field_type in ("INTEGER", "INT64")
+                and field.mode != "REPEATED")
+    if not is_int64:
         logger.error(
-            f"Error getting embeddings from Vertex AI (model: {model_id_name}): {e}"
+            f"ID_STRATEGY 'natural_key' requires an INT64 key column, but '{key_column}' is {field.mode} {field.field_type}. Use ID_STRATEGY 'fingerprint' instead."
+        )
+        sys.exit(1)
+
+
+def build_row_number_query() -> str:
+    """
+    Builds the BigQuery query numbering every source row, for ID_STRATEGY
+    "row_number" with more than one task. Rows are numbered in the order of
+    a fingerprint of their content, so the IDs do not depend on which task
+    runs the query.
+    """
+    select_cols_str = ", ".join(
+        [f"`{col}`" for col in ALL_BQ_COLUMNS_TO_FETCH])
+    source_table = f"`{config.PROJECT_ID}.{config.BQ_DATASET}.{config.BQ_TABLE}`"
+    return f"""
+    SELECT
+        ROW_NUMBER() OVER(ORDER BY FARM_FINGERPRINT(TO_JSON_STRING(t))) AS {config.GENERATED_ID_COLUMN_NAME},
+        {select_cols_str}
+    FROM
+        {source_table} AS t
+    """
+
+
+def number_source_rows() -> str:
+    """
+    Numbers the source rows once per job execution and returns the table
+    holding the numbered rows, for ID_STRATEGY "row_number" with more than
+    one task.
+
+    Every task of the execution submits the numbering query with the same
+    job ID: BigQuery runs it once, and the other tasks wait for that job.
+    All the tasks read the same IDs, and the table is sorted only once.
+    """
+    query = build_row_number_query()
+    if not config.RUN_ID:
+        query_job = bq_client.query(query)
+    else:
+        location = bq_client.get_dataset(
+            f"{config.PROJECT_ID}.{config.BQ_DATASET}").location
+        attempt = 0
+        while True:
+            job_id = f"rag-ingestion-{config.RUN_ID}-row-numbers-{attempt}"
+            try:
+                query_job = bq_client.query(query,
+                                            job_id=job_id,
+                                            location=location)
+                break
+            except exceptions.Conflict:
+                query_job = bq_client.get_job(job_id, location=location)
+            # A failed numbering job is replaced by the next one, which
+            # every task then waits for.
+            if not (query_job.done() and query_job.error_result):
+                break
+            attempt += 1
+    logger.info(
+        f"Numbering the source rows in BigQuery job {query_job.job_id}...")
+    query_job.result()
+    destination = query_job.destination
+    return f"`{destination.project}.{destination.dataset_id}.{destination.table_id}`"
+
+
+def build_source_query(task_index: int,
+                       task_count: int,
+                       numbered_rows_table: str | None = None) -> str:
+    """
+    Builds the BigQuery query returning the rows assigned to this task.
+
+    With a stable ID_STRATEGY, each task keeps the rows whose ID falls into
+    its shard. With "row_number" and more than one task, the rows are read
+    from `numbered_rows_table` (see `number_source_rows`), and each task
+    keeps the rows whose number falls into its shard. A single task numbers
+    the rows itself, in no particular order, which avoids sorting them.
+    """
+    select_cols_str = ", ".join(
+        [f"`{col}`" for col in ALL_BQ_COLUMNS_TO_FETCH])
+
+    source_table = f"`{config.PROJECT_ID}.{config.BQ_DATASET}.{config.BQ_TABLE}`"
+    if config.ID_STRATEGY == "row_number" and task_count <= 1:
+        return f"""
+    SELECT
+        ROW_NUMBER() OVER() AS {config.GENERATED_ID_COLUMN_NAME},
+        {select_cols_str}
+    FROM
+        {source_table}
+    """
+
+    if config.ID_STRATEGY == "row_number":
+        query = f"""
+    SELECT
+        {config.GENERATED_ID_COLUMN_NAME},
+        {select_cols_str}
+    FROM
+        {numbered_rows_table}
+    """
+        if task_count > 1:
+            query += f"""WHERE
+        MOD({config.GENERATED_ID_COLUMN_NAME}, {task_count}) = {task_index}
+    """
+        return query
+
+    query = f"""
+    SELECT
+        *
+    FROM (
+        SELECT
+            {build_id_expression()} AS {config.GENERATED_ID_COLUMN_NAME},
+            {select_cols_str}
+        FROM
+            {source_table}
+    )
+    """
+    if task_count > 1:
+        query += f"""WHERE
+        MOD(MOD({config.GENERATED_ID_COLUMN_NAME}, {task_count}) + {task_count}, {task_count}) = {task_index}
+    """
+    return query
+
+
+def load_resume_checkpoint() -> dict | None:
+    """
+    Creates the checkpoint table and returns the checkpoint a retried task
+    resumes from, or None if the task starts from the beginning.
+    """
+    database.create_checkpoint_table_if_not_exists()
+    if config.TASK_ATTEMPT == 0:
+        return None
+    state = database.load_checkpoint(config.RUN_ID, config.TASK_INDEX)
+    if state is None:
+        logger.info(
+            f"Attempt {config.TASK_ATTEMPT} found no checkpoint, starting from the beginning."
+        )
+    return state
+
+
+def open_source_rows(state: dict | None, ordered: bool):
+    """
+    Returns the BigQuery query job of this task, an iterator over Arrow
+    record batches of its rows, the number of rows already done, and the
+    number of leading rows of the iterator that must be skipped.
+
+    Rows are read with the BigQuery Storage Read API when available. It
+    reads several streams in parallel, in no stable order, unless
+    `ordered` is set: checkpoints count rows, so they need one stream.
+
+    When resuming from a checkpoint, the results of the query job of the
+    previous attempt are read again: BigQuery keeps them for about a day.
+    REST paging starts right after the done rows, while the Storage Read
+    API reads them again to skip them. If the results are gone, the query
+    runs again from the beginning.
+    """
+    max_stream_count = 1 if ordered else (config.BQ_STORAGE_MAX_STREAMS
+                                          or None)
+    if state is not None:
+        try:
+            query_job = bq_client.get_job(state["job_id"],
+                                          location=state["location"])
+            # The Storage Read API cannot start at a row index.
+            start_index = state["rows"] if bqstorage_client is None else 0
+            arrow_batches = query_job.result(
+                page_size=config.BQ_BATCH_SIZE,
+                start_index=start_index).to_arrow_iterable(
+                    bqstorage_client=bqstorage_client,
+                    max_stream_count=max_stream_count)
+            logger.info(
+                f"Resuming after row {state['rows']} of BigQuery job {query_job.job_id}."
+            )
+            return (query_job, arrow_batches, state["rows"],
+                    state["rows"] - start_index)
+        except Exception as e:
+            logger.warning(
+                f"Cannot resume from checkpoint {state}: {e}. Starting from the beginning."
+            )
+
+    numbered_rows_table = None
+    if config.ID_STRATEGY == "row_number" and config.TASK_COUNT > 1:
+        numbered_rows_table = number_source_rows()
+    query = build_source_query(config.TASK_INDEX, config.TASK_COUNT,
+                               numbered_rows_table)
+    logger.info("Executing BigQuery query...")
+    query_job = bq_client.query(query)
+    arrow_batches = query_job.result(
+        page_size=config.BQ_BATCH_SIZE).to_arrow_iterable(
+            bqstorage_client=bqstorage_client,
+            max_stream_count=max_stream_count)
+    logger.info("BigQuery query submitted successfully, iterating results.")
+    return query_job, arrow_batches, 0, 0
+
+
+def is_last_task_to_complete() -> bool:
+    """
+    Records that this task has loaded its rows, and returns whether every
+    task of the job execution has, so that this task must build the indexes.
+    """
+    if config.TASK_COUNT <= 1:
+        return True
+    if not config.RUN_ID:
+        logger.warning(
+            "CLOUD_RUN_EXECUTION is not set: cannot tell whether the other tasks are done. Building the indexes."
         )
-        return []
+        return True
+    completed = database.mark_task_completed(config.RUN_ID, config.TASK_INDEX)
+    logger.info(f"{completed} of {config.TASK_COUNT} tasks are complete.")
+    return completed >= config.TASK_COUNT
 
 
 def run_indexer():
@@ -159,8 +497,14 @@ def run_indexer():
         f"Embedding Model: {config.EMBEDDING_MODEL_NAME} ({config.EMBEDDING_DIMENSIONS} dims)"
     )
     logger.info(
-        f"Batch sizes: BQ Page={config.BQ_BATCH_SIZE}, Embedding Request={config.EMBEDDING_BATCH_SIZE}"
+        f"Batch sizes: BQ Page={config.BQ_BATCH_SIZE}, Embedding Request={config.EMBEDDING_BATCH_SIZE}, DB Write={config.DB_WRITE_BATCH_SIZE}"
     )
+    logger.info(f"Shard: task {config.TASK_INDEX} of {config.TASK_COUNT}")
+    logger.info(
+        f"ID strategy: {config.ID_STRATEGY} (key columns: {', '.join(BQ_KEY_COLUMNS) or 'none'})"
+    )
+    if config.ID_STRATEGY == "natural_key":
+        validate_natural_key_column()
 
     try:
         database.init_db_connection_pool()
@@ -169,144 +513,68 @@ def run_indexer():
         logger.error(f"Halting job due to inability to setup database: {e}")
         sys.exit(1)
 
-    select_cols_str = ", ".join(
-        [f"`{col}`" for col in ALL_BQ_COLUMNS_TO_FETCH])
-    query = f"""
-    SELECT
-        ROW_NUMBER() OVER() AS {config.GENERATED_ID_COLUMN_NAME},
-        {select_cols_str}
-    FROM
-        `{config.PROJECT_ID}.{config.BQ_DATASET}.{config.BQ_TABLE}`
-    """
-
-    logger.info("Executing BigQuery query...")
+    checkpoints_enabled = (bool(config.RUN_ID)
+                           and config.CHECKPOINT_INTERVAL_SECONDS > 0)
+    if not checkpoints_enabled:
+        logger.info("Checkpoints are disabled.")
+    state = load_resume_checkpoint() if checkpoints_enabled else None
     try:
-        query_job = bq_client.query(query)
-        rows_iterator = query_job.result(page_size=config.BQ_BATCH_SIZE)
-        logger.info(
-            "BigQuery query submitted successfully, iterating results.")
+        query_job, arrow_batches, start_row, skip_rows = open_source_rows(
+            state, ordered=checkpoints_enabled)
     except Exception as e:
         logger.error(f"Error executing BigQuery query: {e}")
         sys.exit(1)
 
-    processed_bq_rows_count = 0
-    total_upserted_count = 0
-    batch_for_embedding_processing = []
-
-    for row_idx, row_data in enumerate(rows_iterator):
-        processed_bq_rows_count += 1
-
-        try:
-            item_id_val = row_data[config.GENERATED_ID_COLUMN_NAME]
-            if item_id_val is None:
-                raise ValueError("Generated ID is missing or null")
-            item_id_str = str(item_id_val)
-        except (KeyError, TypeError, ValueError) as e:
-            logger.warning(
-                f"Skipping BQ row number {processed_bq_rows_count} (iterator index {row_idx}): Cannot get generated ID '{config.GENERATED_ID_COLUMN_NAME}'. Error: {e}. Row keys: {list(row_data.keys()) if row_data else 'None'}"
-            )
-            continue
-
-        # 1. Construct 'content_to_embed'
-        content_parts = []
-        for col_name in ALL_BQ_COLUMNS_TO_FETCH:
-            value = row_data.get(col_name)
-            formatted_value = format_bq_value_for_embedding(value)
-            content_parts.append(f"{col_name}: {formatted_value}")
-        current_text_to_embed = "; ".join(content_parts)
-
-        if not current_text_to_embed.strip():
-            logger.warning(
-                f"Skipping row with ID {item_id_str} due to empty 'content_to_embed'. Original parts: {content_parts}"
-            )
-            continue
+    # Rows before the first one the iterator returns count as read.
+    progress = {"bq_rows": start_row - skip_rows, "batch_end_rows": []}
+    on_progress = None
+    checkpointer = None
+    if checkpoints_enabled:
+        checkpointer = checkpoint.Checkpointer(
+            lambda new_state: database.save_checkpoint(config.RUN_ID, config.
+                                                       TASK_INDEX, new_state),
+            config.CHECKPOINT_INTERVAL_SECONDS)
+
+        def on_progress(done_batches: int):
+            # Every row before the end of the last done batch is done.
+            checkpointer.update({
+                "job_id":
+                query_job.job_id,
+                "location":
+                query_job.location,
+                "rows":
+                progress["batch_end_rows"][done_batches - 1],
+            })
 
-        # 2. Extract Metadata for discrete SQL columns using TARGET_BQ_COLUMNS
-        current_metadata_for_sql = {}
-        try:
-            for target_col in TARGET_BQ_COLUMNS:
-                raw_value = row_data.get(target_col)
-                if target_col == 'rank':
-                    current_metadata_for_sql['rank'] = safe_cast(
-                        raw_value, int)
-                elif target_col == 'rating':
-                    current_metadata_for_sql['rating'] = safe_cast(
-                        raw_value, float)
-                elif target_col == 'year':
-                    current_metadata_for_sql['year'] = safe_cast(
-                        raw_value, int)
-                    # For text fields, ensure they are strings or None.
-                elif target_col in ['title', 'description', 'genre']:
-                    current_metadata_for_sql[target_col] = str(
-                        raw_value) if raw_value is not None else None
-                else:
-                    current_metadata_for_sql[target_col] = str(
-                        raw_value) if raw_value is not None else None
-        except Exception as e:
-            logger.warning(
-                f"Error processing metadata for ID {item_id_str}. Skipping row. Error: {e}. Row data sample: {dict(list(row_data.items())[:3])}"
-            )
-            continue
-
-        batch_for_embedding_processing.append({
-            "id": item_id_str,
-            "text_to_embed": current_text_to_embed,
-            "metadata": current_metadata_for_sql,
-            "embedding": None
-        })
-
-        # 3. Process batch for embeddings when full
-        if len(batch_for_embedding_processing) >= config.EMBEDDING_BATCH_SIZE:
-            texts_for_api = [
-                item["text_to_embed"]
-                for item in batch_for_embedding_processing
-            ]
-            logger.info(
-                f"Requesting embeddings for batch of {len(texts_for_api)} texts (Total BQ rows: {processed_bq_rows_count})..."
-            )
-            embeddings_list_result = get_embeddings_batch_vertexai(
-                texts_for_api, config.EMBEDDING_MODEL_NAME)
-
-            if embeddings_list_result and len(embeddings_list_result) == len(
-                    batch_for_embedding_processing):
-                for i, item in enumerate(batch_for_embedding_processing):
-                    item["embedding"] = embeddings_list_result[i]
-                upserted_in_batch = database.upsert_batch_to_db(
-                    batch_for_embedding_processing)
-                total_upserted_count += upserted_in_batch
-            else:
-                logger.error(
-                    f"Failed to get embeddings or length mismatch for batch (ID {batch_for_embedding_processing[0]['id']}). Expected {len(batch_for_embedding_processing)}, got {len(embeddings_list_result) if embeddings_list_result else 'None'}. Skipping DB insert."
-                )
-            batch_for_embedding_processing = []
-
-        if processed_bq_rows_count % (config.BQ_BATCH_SIZE * 2) == 0:
-            logger.info(
-                f"Processed {processed_bq_rows_count} BQ rows. Approx {total_upserted_count} records upserted."
-            )
-
-    # 4. Process any remaining items in the last batch
-    if batch_for_embedding_processing:
-        texts_for_api = [
-            item["text_to_embed"] for item in batch_for_embedding_processing
-        ]
+    logger.info(
+        f"Pipeline: {config.EMBEDDING_WORKERS} embedding workers, up to {config.PIPELINE_QUEUE_SIZE} batches buffered per stage."
+    )
+    try:
+        total_upserted_count = pipeline.run_pipeline(
+            batches=iter_embedding_batches(arrow_batches, progress, skip_rows),
+            embed_batch=embed_batch,
+            write_batch=database.upsert_batch_to_db,
+            num_workers=config.EMBEDDING_WORKERS,
+            queue_size=config.PIPELINE_QUEUE_SIZE,
+            write_batch_size=config.DB_WRITE_BATCH_SIZE,
+            on_progress=on_progress)
+    finally:
+        # Save the progress made before a failure, for the next attempt.
+        if checkpointer:
+            checkpointer.flush()
+    processed_bq_rows_count = progress["bq_rows"] - start_row
+
+    # Build the ANN and text search indexes once every task loaded its rows.
+    if is_last_task_to_complete():
+        database.create_or_update_vector_index()
+        database.create_text_search_index()
+    else:
         logger.info(
-            f"Requesting embeddings for final batch of {len(texts_for_api)} texts..."
+            "Other tasks are still loading rows: the last one builds the indexes."
         )
-        embeddings_list_result = get_embeddings_batch_vertexai(
-            texts_for_api, config.EMBEDDING_MODEL_NAME)
-
-        if embeddings_list_result and len(embeddings_list_result) == len(
-                batch_for_embedding_processing):
-            for i, item in enumerate(batch_for_embedding_processing):
-                item["embedding"] = embeddings_list_result[i]
-            upserted_in_batch = database.upsert_batch_to_db(
-                batch_for_embedding_processing)
-            total_upserted_count += upserted_in_batch
-        else:
-            logger.error(
-                f"Failed to get embeddings or mismatch for final batch (ID {batch_for_embedding_processing[0]['id']}). Skipping DB insert."
-            )
+
+    if checkpointer:
+        database.delete_checkpoint(config.RUN_ID, config.TASK_INDEX)
 
     logger.info(
         f"Indexer job finished. Processed {processed_bq_rows_count} rows from BigQuery."
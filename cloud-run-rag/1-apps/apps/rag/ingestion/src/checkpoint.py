@@ -0,0 +1,62 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import time
+from collections.abc import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpointer:
+    """
+    Keeps the latest progress state of a task and saves it with `save` at
+    most every `interval_seconds`, so that a retry of the task can resume
+    from it instead of starting over.
+
+    Saving is best effort: a failed save is logged, and the next update
+    tries again.
+    """
+
+    def __init__(self, save: Callable[[dict], None], interval_seconds: float):
+        self._save = save
+        self.interval_seconds = interval_seconds
+        self._lock = threading.Lock()
+        self._state: dict | None = None
+        self._saved_state: dict | None = None
+        self._last_save = time.monotonic()
+
+    def update(self, state: dict):
+        """Records the latest state, saving it if the interval has elapsed."""
+        with self._lock:
+            self._state = state
+            if time.monotonic() - self._last_save >= self.interval_seconds:
+                self._save_locked()
+
+    def flush(self):
+        """Saves the latest state if it has not been saved yet."""
+        with self._lock:
+            self._save_locked()
+
+    def _save_locked(self):
+        if self._state is None or self._state == self._saved_state:
+            return
+        self._last_save = time.monotonic()
+        try:
+            self._save(self._state)
+            self._saved_state = self._state
+            logger.info(f"Saved checkpoint {self._state}.")
+        except Exception as e:
+            logger.warning(f"Failed to save checkpoint {self._state}: {e}")
@@ -21,6 +21,13 @@ REGION = os.environ.get("REGION", "europe-west1")
 BQ_DATASET = os.environ.get("BQ_DATASET", "gf-rrag-0")
 BQ_TABLE = os.environ.get("BQ_TABLE", "gf-rrag-0")
 BQ_BATCH_SIZE = int(os.environ.get("BATCH_SIZE_BQ", 1000))
+# Read query results with the BigQuery Storage Read API (faster than REST
+# paging); requires the bigquery.readsessions.create permission
+BQ_USE_STORAGE_API = os.environ.get("BQ_USE_STORAGE_API",
+                                    "true").lower() == "true"
+# Maximum number of parallel Storage Read API streams (0 lets BigQuery
+# choose). Checkpoints need rows in a stable order, so they use a single one.
+BQ_STORAGE_MAX_STREAMS = int(os.environ.get("BQ_STORAGE_MAX_STREAMS", 0))
 
 # Generative Model Configuration
 LLM_MODEL_NAME = os.environ.get("MODEL_NAME", "gemini-2.0-flash")
@@ -35,6 +42,41 @@ EMBEDDING_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_NAME",
                                       "text-multilingual-embedding-002")
 EMBEDDING_DIMENSIONS = int(os.environ.get("EMBEDDING_DIMENSIONS", 768))
 EMBEDDING_BATCH_SIZE = int(os.environ.get("BATCH_SIZE_EMBEDDING", 200))
+EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", 5))
+EMBEDDING_RETRY_BASE_DELAY_SECONDS = float(
+    os.environ.get("EMBEDDING_RETRY_BASE_DELAY_SECONDS", 1.0))
+EMBEDDING_RETRY_MAX_DELAY_SECONDS = float(
+    os.environ.get("EMBEDDING_RETRY_MAX_DELAY_SECONDS", 60.0))
+
+# Incremental Indexing Configuration
+# Skip embedding rows whose content hash matches the one stored in the DB
+INCREMENTAL_INDEXING = os.environ.get("INCREMENTAL_INDEXING",
+                                      "true").lower() == "true"
+
+# Cloud Run Job Configuration (set by Cloud Run, used to shard the source rows)
+TASK_INDEX = int(os.environ.get("CLOUD_RUN_TASK_INDEX", 0))
+TASK_COUNT = int(os.environ.get("CLOUD_RUN_TASK_COUNT", 1))
+# Set by Cloud Run, shared by every task (and attempt) of a job execution
+RUN_ID = os.environ.get("CLOUD_RUN_EXECUTION")
+# 0 for the first attempt of a task, higher for its retries
+TASK_ATTEMPT = int(os.environ.get("CLOUD_RUN_TASK_ATTEMPT", 0))
+
+# Checkpoint Configuration
+# Each task saves its progress at most this often, and its retries resume
+# from it. 0 disables checkpoints. They are only saved within a Cloud Run
+# Job execution (when CLOUD_RUN_EXECUTION is set).
+# Tradeoff: checkpoints count rows, so they need the query results in a
+# stable order, and read them with a single Storage Read API stream
+# (BQ_STORAGE_MAX_STREAMS is ignored). For large tables that rarely fail,
+# disabling them reads the results faster, but a retried task starts over.
+CHECKPOINT_INTERVAL_SECONDS = float(
+    os.environ.get("CHECKPOINT_INTERVAL_SECONDS", 60))
+
+# Pipeline Configuration
+# Number of embedding requests in flight at the same time
+EMBEDDING_WORKERS = int(os.environ.get("EMBEDDING_WORKERS", 4))
+# Maximum number of batches buffered between pipeline stages (backpressure)
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 8))
 
 # DB configuration
 DB_HOST = os.environ.get("DB_HOST", "127.0.0.1")
@@ -42,6 +84,31 @@ DB_PORT = int(os.environ.get("DB_PORT", 5432))
 DB_NAME = os.environ.get("DB_NAME")
 DB_SA = os.environ.get("DB_SA")
 DB_TABLE = os.environ.get("DB_TABLE", "movie_embeddings")
+# Rows loaded with COPY and merged into DB_TABLE per statement
+DB_WRITE_BATCH_SIZE = int(os.environ.get("BATCH_SIZE_DB_WRITE", 2000))
+# Table holding the checkpoints of the indexer tasks
+DB_CHECKPOINT_TABLE = os.environ.get("DB_CHECKPOINT_TABLE",
+                                     "indexer_checkpoints")
+# Table recording the tasks that loaded their rows: the last one builds the
+# indexes
+DB_TASK_STATUS_TABLE = os.environ.get("DB_TASK_STATUS_TABLE",
+                                      "indexer_task_status")
+
+# Vector Index Configuration (built after the load; "none" disables it)
+VECTOR_INDEX_TYPE = os.environ.get("VECTOR_INDEX_TYPE", "hnsw").lower()
+# Must match the distance operator used by the frontend (<=> is cosine)
+VECTOR_INDEX_OPS = os.environ.get("VECTOR_INDEX_OPS", "vector_cosine_ops")
+HNSW_M = int(os.environ.get("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", 64))
+# 0 derives the number of lists from the row count
+IVFFLAT_LISTS = int(os.environ.get("IVFFLAT_LISTS", 0))
+# Optional maintenance_work_mem for the index build, e.g. "1GB"
+DB_INDEX_MAINTENANCE_WORK_MEM = os.environ.get("DB_INDEX_MAINTENANCE_WORK_MEM")
+
+# Text search configuration of the generated tsvector column used for
+# hybrid retrieval. Must match the frontend's TEXT_SEARCH_CONFIG. Changing
+# it requires dropping the search_vector column so that it is regenerated.
+TEXT_SEARCH_CONFIG = os.environ.get("TEXT_SEARCH_CONFIG", "english")
 
 if not DB_NAME or not DB_SA:
     raise ValueError("No env variables configure for DB_NAME or DB_SA")
@@ -49,6 +116,21 @@ if not DB_NAME or not DB_SA:
 # Columns Configuration
 GENERATED_ID_COLUMN_NAME = os.environ.get("GENERATED_ID_COLUMN_NAME", "id")
 BQ_TEXT_COLUMNS_STR = os.environ.get("BQ_TEXT_COLUMNS", "title,description")
+# How the ID column is generated:
+# - "row_number": ROW_NUMBER() over the source rows. A single task numbers
+#   them in no particular order; with several tasks, they are numbered once
+#   per execution in the order of a fingerprint of their content. IDs are
+#   not stable between runs.
+# - "natural_key": the single BQ_KEY_COLUMNS column, which must be INT64.
+# - "fingerprint": FARM_FINGERPRINT of the BQ_KEY_COLUMNS values, for keys
+#   of other types or spanning several columns. BQ_KEY_COLUMNS is required:
+#   the key must not change when a row is edited.
+# Use "fingerprint" or "natural_key" with INCREMENTAL_INDEXING, which
+# compares content hashes by ID (shifted IDs re-embed most rows), and with
+# the frontend's answer cache, so that the context IDs it returns keep
+# referring to the same documents across reloads.
+ID_STRATEGY = os.environ.get("ID_STRATEGY", "row_number")
+BQ_KEY_COLUMNS_STR = os.environ.get("BQ_KEY_COLUMNS", "")
 TARGET_BQ_COLUMNS_DEFAULT = [
     'rank', 'title', 'description', 'genre', 'rating', 'year'
 ]
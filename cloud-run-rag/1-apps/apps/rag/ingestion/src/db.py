@@ -12,7 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import json
 import logging
+import math
 import sqlalchemy
 
 from src import config
@@ -84,10 +87,26 @@ def dispose_db_pool():
         logger.info("Database connection pool disposed.")
 
 
+def _search_vector_expression() -> str:
+    """
+    Returns the expression of the generated tsvector column used for lexical
+    search. Titles weigh most, then genres and years, then descriptions.
+    """
+    text_search_config = f"'{config.TEXT_SEARCH_CONFIG}'::regconfig"
+    return (
+        f"setweight(to_tsvector({text_search_config}, coalesce(title, '')), 'A') || "
+        f"setweight(to_tsvector({text_search_config}, coalesce(genre, '')), 'B') || "
+        f"setweight(to_tsvector({text_search_config}, coalesce(year::text, '')), 'B') || "
+        f"setweight(to_tsvector({text_search_config}, coalesce(description, '')), 'C')"
+    )
+
+
 def create_table_if_not_exists():
     """Creates the target table with specific columns and pgvector if it doesn't exist."""
     engine = get_db_pool()
     table_name = config.DB_TABLE
+    # Postgres keeps the generated column up to date on every write.
+    search_vector_sql = f"tsvector GENERATED ALWAYS AS ({_search_vector_expression()}) STORED"
 
     create_table_sql = f"""
     CREATE TABLE IF NOT EXISTS "{table_name}" (
@@ -99,13 +118,22 @@ def create_table_if_not_exists():
         rating REAL,
         year INTEGER,
         content_to_embed TEXT,
-        embedding vector({config.EMBEDDING_DIMENSIONS})
+        content_hash TEXT,
+        embedding vector({config.EMBEDDING_DIMENSIONS}),
+        search_vector {search_vector_sql}
     );
+    ALTER TABLE "{table_name}" ADD COLUMN IF NOT EXISTS content_hash TEXT;
+    ALTER TABLE "{table_name}" ADD COLUMN IF NOT EXISTS search_vector {search_vector_sql};
     GRANT SELECT ON TABLE "{table_name}" TO PUBLIC;
     """
     try:
         with engine.connect() as connection:
             with connection.begin():  # Use transaction
+                # Serialize DDL across the tasks of a sharded job.
+                connection.execute(
+                    sqlalchemy.text(
+                        "SELECT pg_advisory_xact_lock(hashtext(:table_name));"
+                    ), {"table_name": table_name})
                 connection.execute(
                     sqlalchemy.text("CREATE EXTENSION IF NOT EXISTS vector;"))
                 connection.execute(sqlalchemy.text(create_table_sql))
@@ -117,11 +145,264 @@ def create_table_if_not_exists():
         raise
 
 
+def _get_ivfflat_lists(connection) -> int:
+    """
+    Derives the number of IVFFlat lists from the row count:
+    rows / 1000 up to 1M rows and sqrt(rows) above.
+    """
+    row_count = connection.execute(
+        sqlalchemy.text(
+            f'SELECT COUNT(*) FROM "{config.DB_TABLE}";')).scalar_one()
+    if row_count <= 1_000_000:
+        return max(10, row_count // 1000)
+    return int(math.sqrt(row_count))
+
+
+def _get_index_settings(connection, index_name: str) -> str | None:
+    """Returns the settings stored in the comment of an index, if it exists."""
+    return connection.execute(
+        sqlalchemy.text(
+            "SELECT obj_description(to_regclass(:index_name), 'pg_class');"), {
+                "index_name": f'"{index_name}"'
+            }).scalar_one_or_none()
+
+
+def _build_index_concurrently(index_name: str, create_sql: str,
+                              index_settings: str | None):
+    """
+    Builds an index with CREATE INDEX CONCURRENTLY under a temporary name,
+    then swaps it in place of `index_name`. The table stays readable and
+    writable during the build.
+    `create_sql` is the CREATE INDEX statement, with a {name} placeholder
+    and without CONCURRENTLY.
+    """
+    engine = get_db_pool()
+    new_index_name = f"{index_name}_new"
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction.
+    with engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as connection:
+        # Serializes builds of the same index, e.g. by a retried task.
+        connection.execute(
+            sqlalchemy.text("SELECT pg_advisory_lock(hashtext(:index_name));"),
+            {"index_name": index_name})
+        try:
+            if config.DB_INDEX_MAINTENANCE_WORK_MEM:
+                connection.execute(
+                    sqlalchemy.text(
+                        "SELECT set_config('maintenance_work_mem', :value, false);"
+                    ), {"value": config.DB_INDEX_MAINTENANCE_WORK_MEM})
+            # A failed concurrent build leaves an invalid index behind.
+            connection.execute(
+                sqlalchemy.text(
+                    f'DROP INDEX CONCURRENTLY IF EXISTS "{new_index_name}";'))
+            connection.execute(
+                sqlalchemy.text(
+                    create_sql.format(name=f'"{new_index_name}"').replace(
+                        "CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)))
+            if index_settings:
+                connection.execute(
+                    sqlalchemy.text(
+                        f"COMMENT ON INDEX \"{new_index_name}\" IS '{index_settings}';"
+                    ))
+            # The swap takes a short exclusive lock on the table.
+            with engine.connect() as swap_connection:
+                with swap_connection.begin():
+                    swap_connection.execute(
+                        sqlalchemy.text(
+                            f'DROP INDEX IF EXISTS "{index_name}";'))
+                    swap_connection.execute(
+                        sqlalchemy.text(
+                            f'ALTER INDEX "{new_index_name}" RENAME TO "{index_name}";'
+                        ))
+        finally:
+            if config.DB_INDEX_MAINTENANCE_WORK_MEM:
+                connection.execute(
+                    sqlalchemy.text("RESET maintenance_work_mem;"))
+            connection.execute(
+                sqlalchemy.text(
+                    "SELECT pg_advisory_unlock(hashtext(:index_name));"),
+                {"index_name": index_name})
+
+
+def create_or_update_vector_index():
+    """
+    Creates the ANN index (HNSW or IVFFlat) on the embedding column, or
+    rebuilds it if its settings changed. The settings are stored in the index
+    comment. Call this once every task has loaded its rows: building the
+    index once is much faster than updating it for every inserted row, and
+    IVFFlat needs all the data to compute its lists.
+
+    The index is built concurrently and swapped in, so the frontend keeps
+    reading the table, with the previous index, during the build.
+    """
+    engine = get_db_pool()
+    index_type = config.VECTOR_INDEX_TYPE
+    index_name = f"{config.DB_TABLE}_embedding_idx"
+
+    if index_type == "none":
+        logger.info("Vector index disabled (VECTOR_INDEX_TYPE=none).")
+        return
+    if index_type not in ("hnsw", "ivfflat"):
+        raise ValueError(f"Invalid VECTOR_INDEX_TYPE: {index_type}")
+
+    try:
+        with engine.connect() as connection:
+            current_settings = _get_index_settings(connection, index_name)
+            settings_prefix = f"{index_type} {config.VECTOR_INDEX_OPS}"
+            if index_type == "hnsw":
+                with_str = f"m = {config.HNSW_M}, ef_construction = {config.HNSW_EF_CONSTRUCTION}"
+            elif config.IVFFLAT_LISTS > 0:
+                with_str = f"lists = {config.IVFFLAT_LISTS}"
+            else:
+                # Derived lists follow the row count: data growth alone
+                # does not trigger a rebuild.
+                with_str = None
+            if current_settings and (
+                    current_settings == f"{settings_prefix} ({with_str})" or
+                (with_str is None
+                 and current_settings.startswith(f"{settings_prefix} ("))):
+                logger.info(
+                    f"Vector index '{index_name}' is up to date ({current_settings})."
+                )
+                return
+            if with_str is None:
+                with_str = f"lists = {_get_ivfflat_lists(connection)}"
+            connection.rollback()
+
+        index_settings = f"{settings_prefix} ({with_str})"
+        logger.info(
+            f"Building vector index '{index_name}' ({index_settings})...")
+        _build_index_concurrently(
+            index_name, f"""
+            CREATE INDEX {{name}} ON "{config.DB_TABLE}"
+            USING {index_type} (embedding {config.VECTOR_INDEX_OPS})
+            WITH ({with_str});
+            """, index_settings)
+        logger.info(f"Vector index '{index_name}' is ready.")
+    except Exception as e:
+        logger.error(f"Error creating vector index '{index_name}': {e}")
+        raise
+
+
+def create_text_search_index():
+    """
+    Creates the GIN index on the tsvector column that serves the lexical
+    side of hybrid retrieval. Like the vector index, it is built after the
+    load rather than updated for every inserted row, and concurrently.
+    """
+    engine = get_db_pool()
+    index_name = f"{config.DB_TABLE}_search_vector_idx"
+    try:
+        with engine.connect() as connection:
+            exists = connection.execute(
+                sqlalchemy.text(
+                    "SELECT to_regclass(:index_name) IS NOT NULL;"), {
+                        "index_name": f'"{index_name}"'
+                    }).scalar_one()
+            connection.rollback()
+        if exists:
+            logger.info(f"Text search index '{index_name}' exists.")
+            return
+        _build_index_concurrently(
+            index_name, f"""
+            CREATE INDEX {{name}} ON "{config.DB_TABLE}"
+            USING gin (search_vector);
+            """, None)
+        logger.info(f"Text search index '{index_name}' is ready.")
+    except Exception as e:
+        logger.error(f"Error creating text search index '{index_name}': {e}")
+        raise
+
+
+def mark_task_completed(run_id: str, task_index: int) -> int:
+    """
+    Records that a task of a job execution has loaded its rows, and returns
+    the number of tasks of the execution that have. Completions are
+    serialized, so only the last task to complete sees every task.
+    """
+    engine = get_db_pool()
+    table_name = config.DB_TASK_STATUS_TABLE
+    with engine.connect() as connection:
+        with connection.begin():
+            connection.execute(
+                sqlalchemy.text(
+                    "SELECT pg_advisory_xact_lock(hashtext(:table_name));"),
+                {"table_name": table_name})
+            connection.execute(
+                sqlalchemy.text(f"""
+                CREATE TABLE IF NOT EXISTS "{table_name}" (
+                    run_id TEXT NOT NULL,
+                    task_index INTEGER NOT NULL,
+                    completed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (run_id, task_index)
+                );
+                """))
+            connection.execute(
+                sqlalchemy.text(f"""
+                INSERT INTO "{table_name}" (run_id, task_index)
+                VALUES (:run_id, :task_index)
+                ON CONFLICT DO NOTHING;
+                """), {
+                    "run_id": run_id,
+                    "task_index": task_index
+                })
+            return connection.execute(
+                sqlalchemy.text(
+                    f'SELECT COUNT(*) FROM "{table_name}" WHERE run_id = :run_id;'
+                ), {
+                    "run_id": run_id
+                }).scalar_one()
+
+
+def get_content_hashes(ids: list[str]) -> dict[str, str]:
+    """
+    Returns the stored content hashes of the given IDs.
+    IDs that are not in the table (or have no hash yet) are left out.
+    """
+    engine = get_db_pool()
+    if not ids:
+        return {}
+
+    select_sql_stmt = sqlalchemy.text(f"""
+    SELECT "{config.GENERATED_ID_COLUMN_NAME}", content_hash
+    FROM "{config.DB_TABLE}"
+    WHERE "{config.GENERATED_ID_COLUMN_NAME}" IN :ids
+    AND content_hash IS NOT NULL;
+    """).bindparams(sqlalchemy.bindparam("ids", expanding=True))
+
+    with engine.connect() as connection:
+        result = connection.execute(select_sql_stmt,
+                                    {"ids": [int(item_id) for item_id in ids]})
+        return {str(row[0]): row[1] for row in result}
+
+
+def _format_copy_value(value) -> str:
+    """Formats a value for the text format of COPY, escaping special characters."""
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t").replace(
+        "\n", "\\n").replace("\r", "\\r"))
+
+
+def _format_vector(embedding: list[float]) -> str:
+    """
+    Formats an embedding as a compact pgvector literal. Nine significant
+    digits are enough to round-trip the float4 values pgvector stores.
+    """
+    return "[" + ",".join(format(v, ".9g") for v in embedding) + "]"
+
+
 def upsert_batch_to_db(batch_data: list[dict]) -> int:
     """
     Upserts a batch of data (including embeddings and specific columns) into Cloud SQL.
-    The `batch_data` items should have an 'id', 'text_to_embed', 'embedding',
-    and a 'metadata' dictionary containing keys like 'rank', 'title', etc.
+    The `batch_data` items should have an 'id', 'text_to_embed', 'content_hash',
+    'embedding' and a 'metadata' dictionary containing keys like 'rank', 'title', etc.
+
+    Rows are bulk loaded with COPY into a temporary (unlogged) staging table,
+    then merged into the target table with a single INSERT ... SELECT ...
+    ON CONFLICT statement. Existing rows whose content hash did not change
+    are left untouched.
+    Raises if the batch cannot be written.
     """
     engine = get_db_pool()
     if not batch_data:
@@ -129,24 +410,35 @@ def upsert_batch_to_db(batch_data: list[dict]) -> int:
 
     db_columns = [
         config.GENERATED_ID_COLUMN_NAME, 'rank', 'title', 'description',
-        'genre', 'rating', 'year', 'content_to_embed', 'embedding'
+        'genre', 'rating', 'year', 'content_to_embed', 'content_hash',
+        'embedding'
     ]
     cols_str = ", ".join([f'"{col}"' for col in db_columns])
-    placeholders = ", ".join([f":{col}" for col in db_columns])
     update_cols = [
         col for col in db_columns if col != config.GENERATED_ID_COLUMN_NAME
     ]
     update_statements = [f'"{col}" = EXCLUDED."{col}"' for col in update_cols]
     update_str = ", ".join(update_statements)
+    staging_table = f"{config.DB_TABLE}_staging"
 
-    upsert_sql_stmt = sqlalchemy.text(f"""
+    create_staging_sql_stmt = sqlalchemy.text(f"""
+    CREATE TEMP TABLE "{staging_table}"
+    (LIKE "{config.DB_TABLE}" INCLUDING DEFAULTS)
+    ON COMMIT DROP;
+    """)
+    copy_sql = f'COPY "{staging_table}" ({cols_str}) FROM STDIN'
+    merge_sql_stmt = sqlalchemy.text(f"""
     INSERT INTO "{config.DB_TABLE}" ({cols_str})
-    VALUES ({placeholders})
+    SELECT {cols_str}
+    FROM "{staging_table}"
     ON CONFLICT ("{config.GENERATED_ID_COLUMN_NAME}") DO UPDATE
-    SET {update_str};
+    SET {update_str}
+    WHERE "{config.DB_TABLE}".content_hash IS DISTINCT FROM EXCLUDED.content_hash;
     """)
 
-    prepared_batch = []
+    # Keyed by ID: ON CONFLICT cannot update a row twice in one statement, so
+    # an ID appearing twice in the batch keeps its last row only.
+    copy_lines = {}
     for item in batch_data:
         try:
             row_dict = {
@@ -158,8 +450,11 @@ def upsert_batch_to_db(batch_data: list[dict]) -> int:
                 int(item['id']),
                 'content_to_embed':
                 item['text_to_embed'],
+                'content_hash':
+                item.get('content_hash'),
                 'embedding':
-                str(item['embedding']) if item.get('embedding') else None,
+                _format_vector(item['embedding'])
+                if item.get('embedding') else None,
             })
 
             if 'metadata' in item and isinstance(item['metadata'], dict):
@@ -171,29 +466,116 @@ def upsert_batch_to_db(batch_data: list[dict]) -> int:
                     f"Missing or invalid 'metadata' in item with ID {item.get('id', 'N/A')}. Expected a dict."
                 )
 
-            prepared_batch.append(row_dict)
+            copy_lines[row_dict[config.GENERATED_ID_COLUMN_NAME]] = "\t".join(
+                _format_copy_value(row_dict[col]) for col in db_columns)
         except Exception as e:
             logger.error(
                 f"Error preparing row data for DB upsert (ID: {item.get('id', 'N/A')}). Skipping row. Error: {e}. Data text_to_embed[:50]='{str(item.get('text_to_embed'))[:50]}'"
             )
             continue
 
-    if not prepared_batch:
+    if not copy_lines:
         logger.warning("No valid rows prepared for DB upsert in this batch.")
         return 0
 
+    copy_data = io.BytesIO(
+        ("\n".join(copy_lines.values()) + "\n").encode("utf-8"))
     try:
         with engine.connect() as connection:
             with connection.begin():
-                connection.execute(upsert_sql_stmt, prepared_batch)
+                connection.execute(create_staging_sql_stmt)
+                # COPY is not exposed by SQLAlchemy: use the pg8000 cursor,
+                # which shares the connection and transaction.
+                cursor = connection.connection.cursor()
+                try:
+                    cursor.execute(copy_sql, stream=copy_data)
+                finally:
+                    cursor.close()
+                connection.execute(merge_sql_stmt)
         logger.info(
-            f"Successfully attempted upsert for {len(prepared_batch)} records into {config.DB_TABLE}."
+            f"Successfully attempted upsert for {len(copy_lines)} records into {config.DB_TABLE}."
         )
-        return len(prepared_batch)
+        return len(copy_lines)
     except Exception as e:
+        # Raised rather than reported as 0 rows written: the batch must not
+        # count as done, or a checkpoint could move past rows that were
+        # never committed. The task fails and its retry resumes from the
+        # last checkpoint.
         logger.error(f"Error during batch upsert to Cloud SQL: {e}")
-        if prepared_batch:
-            logger.error(
-                f"Problematic batch (first generated ID): {prepared_batch[0].get(config.GENERATED_ID_COLUMN_NAME)}"
-            )
-        return 0
+        logger.error(
+            f"Problematic batch (first generated ID): {batch_data[0].get('id')}"
+        )
+        raise
+
+
+def create_checkpoint_table_if_not_exists():
+    """Creates the table holding the progress of the indexer tasks."""
+    engine = get_db_pool()
+    table_name = config.DB_CHECKPOINT_TABLE
+    create_table_sql = f"""
+    CREATE TABLE IF NOT EXISTS "{table_name}" (
+        run_id TEXT NOT NULL,
+        task_index INTEGER NOT NULL,
+        state JSONB NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (run_id, task_index)
+    );
+    """
+    with engine.connect() as connection:
+        with connection.begin():
+            # Serialize DDL across the tasks of a sharded job.
+            connection.execute(
+                sqlalchemy.text(
+                    "SELECT pg_advisory_xact_lock(hashtext(:table_name));"),
+                {"table_name": table_name})
+            connection.execute(sqlalchemy.text(create_table_sql))
+    logger.info(f"Ensured checkpoint table '{table_name}' exists.")
+
+
+def load_checkpoint(run_id: str, task_index: int) -> dict | None:
+    """Returns the last checkpoint saved by a task, or None."""
+    engine = get_db_pool()
+    select_sql_stmt = sqlalchemy.text(f"""
+    SELECT state::text FROM "{config.DB_CHECKPOINT_TABLE}"
+    WHERE run_id = :run_id AND task_index = :task_index;
+    """)
+    with engine.connect() as connection:
+        state = connection.execute(select_sql_stmt, {
+            "run_id": run_id,
+            "task_index": task_index
+        }).scalar()
+    return json.loads(state) if state is not None else None
+
+
+def save_checkpoint(run_id: str, task_index: int, state: dict):
+    """Saves the checkpoint of a task, replacing the previous one."""
+    engine = get_db_pool()
+    upsert_sql_stmt = sqlalchemy.text(f"""
+    INSERT INTO "{config.DB_CHECKPOINT_TABLE}" (run_id, task_index, state)
+    VALUES (:run_id, :task_index, CAST(:state AS JSONB))
+    ON CONFLICT (run_id, task_index) DO UPDATE
+    SET state = EXCLUDED.state, updated_at = now();
+    """)
+    with engine.connect() as connection:
+        with connection.begin():
+            connection.execute(
+                upsert_sql_stmt, {
+                    "run_id": run_id,
+                    "task_index": task_index,
+                    "state": json.dumps(state)
+                })
+
+
+def delete_checkpoint(run_id: str, task_index: int):
+    """Deletes the checkpoint of a task once it has completed."""
+    engine = get_db_pool()
+    delete_sql_stmt = sqlalchemy.text(f"""
+    DELETE FROM "{config.DB_CHECKPOINT_TABLE}"
+    WHERE run_id = :run_id AND task_index = :task_index;
+    """)
+    with engine.connect() as connection:
+        with connection.begin():
+            connection.execute(delete_sql_stmt, {
+                "run_id": run_id,
+                "task_index": task_index
+            })
@@ -0,0 +1,184 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import queue
+import threading
+from collections.abc import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stream on a pipeline queue.
+_END_OF_STREAM = object()
+# How often blocked stages wake up to check whether the pipeline was aborted.
+_POLL_INTERVAL_SECONDS = 0.5
+
+
+def _put(q: queue.Queue, item, stop_event: threading.Event) -> bool:
+    """Puts an item on a bounded queue, giving up if the pipeline stopped."""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=_POLL_INTERVAL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q: queue.Queue, stop_event: threading.Event):
+    """Gets an item from a queue, returning _END_OF_STREAM if the pipeline stopped."""
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=_POLL_INTERVAL_SECONDS)
+        except queue.Empty:
+            continue
+    return _END_OF_STREAM
+
+
+def run_pipeline(batches: Iterable[list[dict]],
+                 embed_batch: Callable[[list[dict]], list[dict]],
+                 write_batch: Callable[[list[dict]], int],
+                 num_workers: int,
+                 queue_size: int,
+                 write_batch_size: int = 1,
+                 on_progress: Callable[[int], None] | None = None) -> int:
+    """
+    Runs batches through a bounded producer / consumer pipeline.
+
+    The calling thread consumes `batches` (e.g. BigQuery pages) and feeds
+    `num_workers` embedding threads, which hand their results to a single
+    writer thread. Both queues hold at most `queue_size` batches, so a slow
+    stage throttles the stages in front of it instead of buffering the
+    whole source in memory.
+
+    The writer concatenates embedded batches until it holds at least
+    `write_batch_size` rows, so that each write can be larger than an
+    embedding request.
+
+    Batches can complete out of order. `on_progress` is called from the
+    writer thread with the number of leading source batches that are done,
+    i.e. written or dropped by `embed_batch`, every time it grows. This is
+    what checkpoints must record: the batches after it may or may not have
+    been written yet.
+
+    Args:
+        batches: An iterable of batches to process.
+        embed_batch: Returns the batch with embeddings attached. An empty
+            list means the batch failed and must not be written.
+        write_batch: Persists a batch and returns the number of rows written.
+        num_workers: The number of concurrent embedding workers.
+        queue_size: The maximum number of batches buffered between stages.
+        write_batch_size: The minimum number of rows passed to `write_batch`,
+            except for the last write.
+        on_progress: Called with the number of leading batches done.
+
+    Returns:
+        The total number of rows reported by `write_batch`.
+    """
+    num_workers = max(1, num_workers)
+    queue_size = max(1, queue_size)
+    embed_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    write_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors: list[BaseException] = []
+    total_written = 0
+
+    def fail(e: BaseException):
+        # Remember the first fatal error and unblock every other stage.
+        if not errors:
+            errors.append(e)
+        stop_event.set()
+
+    def embed_worker():
+        try:
+            while True:
+                item = _get(embed_queue, stop_event)
+                if item is _END_OF_STREAM:
+                    break
+                sequence, batch = item
+                # Empty batches are passed on too, so that the writer knows
+                # they are done.
+                if not _put(write_queue,
+                            (sequence, embed_batch(batch)), stop_event):
+                    break
+        except BaseException as e:  # Includes sys.exit() from the embedder.
+            logger.error(f"Embedding worker failed: {e!r}")
+            fail(e)
+        finally:
+            _put(write_queue, _END_OF_STREAM, stop_event)
+
+    def writer():
+        nonlocal total_written
+        finished_workers = 0
+        pending: list[dict] = []
+        pending_sequences: list[int] = []
+        done_sequences: set[int] = set()
+        next_sequence = 0
+
+        def complete(sequences: list[int]):
+            nonlocal next_sequence
+            done_sequences.update(sequences)
+            completed = next_sequence
+            while next_sequence in done_sequences:
+                done_sequences.remove(next_sequence)
+                next_sequence += 1
+            if on_progress is not None and next_sequence > completed:
+                on_progress(next_sequence)
+
+        try:
+            while finished_workers < num_workers:
+                item = _get(write_queue, stop_event)
+                if item is _END_OF_STREAM:
+                    finished_workers += 1
+                    continue
+                sequence, batch = item
+                pending.extend(batch)
+                pending_sequences.append(sequence)
+                if not pending or len(pending) >= write_batch_size:
+                    if pending:
+                        total_written += write_batch(pending)
+                    complete(pending_sequences)
+                    pending, pending_sequences = [], []
+            if pending_sequences and not stop_event.is_set():
+                if pending:
+                    total_written += write_batch(pending)
+                complete(pending_sequences)
+        except BaseException as e:
+            logger.error(f"Writer failed: {e!r}")
+            fail(e)
+
+    threads = [
+        threading.Thread(target=embed_worker,
+                         name=f"embed-worker-{i}",
+                         daemon=True) for i in range(num_workers)
+    ]
+    threads.append(threading.Thread(target=writer, name="writer", daemon=True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        for item in enumerate(batches):
+            if not _put(embed_queue, item, stop_event):
+                break
+        for _ in range(num_workers):
+            _put(embed_queue, _END_OF_STREAM, stop_event)
+    except BaseException as e:
+        fail(e)
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return total_written
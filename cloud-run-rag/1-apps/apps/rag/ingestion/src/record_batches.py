@@ -0,0 +1,113 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+logger = logging.getLogger(__name__)
+
+
+def format_bq_value_for_embedding(value) -> str:
+    """
+    Formats a BigQuery value for inclusion in
+    the 'content_to_embed' string.
+    """
+    if value is None:
+        return "None"  # Represent SQL NULL as the string "None"
+    if isinstance(value, list):  # For ARRAY types from BigQuery
+        return ",".join(str(v_item).strip() for v_item in value)
+    if isinstance(value, bool):
+        return str(value)  # "True" or "False"
+    return str(value).strip()
+
+
+def safe_cast(value, cast_type, default=None):
+    """Safely casts a value to a type, returning default on failure."""
+    if value is None:
+        return default
+    try:
+        return cast_type(value)
+    except (ValueError, TypeError):
+        logger.warning(
+            f"Could not cast '{value}' to {cast_type}. Using default: {default}"
+        )
+        return default
+
+
+def format_column_for_embedding(column: pa.Array) -> pa.Array:
+    """
+    Formats every value of a column like `format_bq_value_for_embedding`,
+    into a string array without nulls.
+
+    Strings, integers and booleans are formatted with Arrow kernels. Other
+    types are formatted value by value: Arrow formats floats differently
+    from Python (8.0 becomes "8"), and the content must stay the same for
+    its hash to match the stored one.
+    """
+    column_type = column.type
+    if pa.types.is_string(column_type) or pa.types.is_large_string(
+            column_type):
+        formatted = pc.utf8_trim_whitespace(column)
+    elif pa.types.is_integer(column_type):
+        formatted = pc.cast(column, pa.string())
+    elif pa.types.is_boolean(column_type):
+        formatted = pc.if_else(column, "True", "False")
+    elif pa.types.is_decimal(column_type):
+        # Arrow pads NUMERIC values to their scale (2 -> 2.000000000),
+        # while the REST API returns them as written.
+        values = [
+            format(v.normalize(), "f") if v is not None else "None"
+            for v in column.to_pylist()
+        ]
+        return pa.array(values, type=pa.string())
+    else:
+        values = [format_bq_value_for_embedding(v) for v in column.to_pylist()]
+        return pa.array(values, type=pa.string())
+    return pc.fill_null(formatted, "None")
+
+
+def build_content_column(batch: pa.RecordBatch,
+                         column_names: list[str]) -> pa.Array:
+    """
+    Builds the 'content_to_embed' string of every row of a record batch:
+    "col1: value1; col2: value2; ..." for the given columns, in order.
+    """
+    parts = []
+    for i, column_name in enumerate(column_names):
+        parts.append(f"; {column_name}: " if i else f"{column_name}: ")
+        parts.append(format_column_for_embedding(batch.column(column_name)))
+    # The last argument is the separator.
+    return pc.binary_join_element_wise(*parts, "")
+
+
+def cast_metadata_column(column: pa.Array, cast_type: type) -> list:
+    """
+    Returns the values of a column cast to int, float or str, like
+    `safe_cast` (or `str`) does value by value. Columns that already have
+    a matching Arrow type are converted as a whole.
+    """
+    column_type = column.type
+    if cast_type is int and pa.types.is_integer(column_type):
+        return column.to_pylist()
+    if cast_type is float and (pa.types.is_floating(column_type)
+                               or pa.types.is_integer(column_type)):
+        return pc.cast(column, pa.float64()).to_pylist()
+    if cast_type is str:
+        if pa.types.is_string(column_type) or pa.types.is_large_string(
+                column_type):
+            return column.to_pylist()
+        return [str(v) if v is not None else None for v in column.to_pylist()]
+    return [safe_cast(v, cast_type) for v in column.to_pylist()]
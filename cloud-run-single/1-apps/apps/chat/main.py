@@ -12,9 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import logging
 import os
+from collections.abc import AsyncIterator
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 import google.api_core.exceptions as exceptions
 from google import genai
 from google.genai import types
@@ -99,6 +102,68 @@ async def predict_route(request: Prompt):
     return {"prompt": request.prompt, "prediction": prediction_text}
 
 
+def format_sse_event(event: str, data: dict) -> str:
+    """Formats a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_prediction_events(prompt: str) -> AsyncIterator[str]:
+    """
+    Streams a prediction as Server-Sent Events: `token` events with the text
+    deltas as the model generates them, then a final `done` (or `error`)
+    event with the complete prediction.
+    """
+    chunks = []
+    try:
+        async for chunk in await genai_client.aio.models.generate_content_stream(
+                model=MODEL_NAME,
+                contents=prompt,
+                config=MODEL_CONFIG,
+        ):
+            if chunk.text:
+                chunks.append(chunk.text)
+                yield format_sse_event("token", {"text": chunk.text})
+    except exceptions.GoogleAPIError as e:
+        logger.error("Vertex AI API call failed: %s", e, exc_info=True)
+        yield format_sse_event(
+            "error", {"detail": "Failed to get an answer, please try again."})
+        return
+    except Exception as e:
+        # The response has already started: report any other failure, e.g.
+        # a google.genai APIError, as an event too.
+        logger.error("Unexpected error during model generation: %s",
+                     e,
+                     exc_info=True)
+        yield format_sse_event(
+            "error", {"detail": "Failed to get an answer, please try again."})
+        return
+
+    prediction_text = "".join(chunks)
+    logger.info(
+        "Successfully streamed prediction from Vertex AI: %s",
+        prediction_text[:100],
+    )
+    yield format_sse_event("done", {"prediction": prediction_text})
+
+
+@app.post("/predict_stream")
+async def predict_stream_route(request: Prompt):
+    """Endpoint to stream a prediction from Vertex AI as Server-Sent Events."""
+
+    if MODEL_NAME is None or MODEL_CONFIG is None:
+        logger.error("Vertex AI model not initialized.")
+        raise HTTPException(
+            status_code=500,
+            detail="Internal server error: Model not initialized.")
+
+    logger.info("Received streaming prediction request with prompt: '%s...'",
+                request.prompt[:100])
+
+    return StreamingResponse(stream_prediction_events(request.prompt),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
 if __name__ == "__main__":
     server_port = int(os.environ.get("PORT", 8080))
     uvicorn.run("main:app", host="0.0.0.0", port=server_port, log_level="info")